@@ -535,8 +535,9 @@ class USBClass(DeviceClass):
                     if retry == 3:
                         return False
         
-        # 校验发送数据（调试模式）
-        self.verify_data(bytearray(command), "TX:")
+        # 校验发送数据（调试模式），非调试模式下不复制数据
+        if self._logger.level == logging.DEBUG:
+            self.verify_data(bytearray(command), "TX:")
         return True
 
     def usb_read(self, resp_len: int = None, time_out: int = 1) -> bytes:
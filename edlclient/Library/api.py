@@ -3,6 +3,7 @@
 from typing import Any
 
 from edlclient import edl
+from edlclient.Library.blockdev import BlockDevice
 
 default_edl_args = {
     # -------------------------- 调试/基础配置类参数 --------------------------
@@ -15,6 +16,24 @@ default_edl_args = {
     "--genxml": False,
     # 是否生成XML配置文件：开启后会根据当前参数自动生成EDL操作所需的XML配置（如分区烧录的rawprogram.xml）
 
+    "--allocated": False,
+    # 是否只转储已分配块：开启后r/rl会解析ext4/f2fs的位图，仅读取已使用的块并输出Android sparse镜像
+
+    "--skipzero": False,
+    # 是否跳过全零块：开启后w/wl会扫描原始镜像，对大段全零（NAND为0xFF）区域使用erase代替写入，只写入有数据的部分
+
+    "--nandlayout": None,
+    # NAND转储的输出格式（流式协议）：raw为原始页数据，linux为Linux MTD可挂载的纯数据镜像，yaffs2为每页附带完整OOB的YAFFS2镜像
+
+    "--memrange": None,
+    # 内存转储的地址范围：memorydump时只读取"起始-结束"或"起始+长度"（逗号分隔）范围内的内存区域，部分覆盖的区域会被截取
+
+    "--dumpcompress": None,
+    # 内存转储的压缩方式：memorydump时以gzip/xz/bz2/zstd压缩写出各内存区域，None表示不压缩（全零块写为稀疏文件空洞）
+
+    "--elfcore": None,
+    # ELF核心转储文件：memorydump时将所有内存区域按物理地址（每个区域一个PT_LOAD段）写入单个ELF core文件（32位设备为ELF32，64位为ELF64），可直接mmap分析
+
     # -------------------------- GPT分区表配置类参数 --------------------------
     "--gpt-num-part-entries": "0",
     # GPT分区表的条目数量：指定GPT（GUID Partition Table）中分区条目的总数，0表示使用设备默认值
@@ -61,6 +80,18 @@ default_edl_args = {
     "--tcpport": "1340",
     # TCP端口号：EDL模式下网络调试/传输的TCP端口，默认1340，用于远程EDL操作
 
+    "--unixsocket": None,
+    # Unix套接字路径：指定后服务器改为监听该Unix套接字，None表示使用TCP端口
+
+    "--socket": "/tmp/edl-nbd.sock",
+    # NBD套接字路径：nbd命令导出块设备时监听的Unix套接字路径
+
+    "--cachesize": "0x2000000",
+    # 块缓存大小（字节）：nbd命令使用的LRU块缓存总大小，默认32MB
+
+    "--blocksize": "0x4000",
+    # 缓存块大小（字节）：nbd命令块缓存中单个对齐块的大小，默认16KB
+
     # -------------------------- 操作行为控制类参数 --------------------------
     "--resetmode": None,
     # 重置模式：指定EDL操作完成后的设备重置方式（如"cold"冷重启、"warm"热重启），None表示不重置
@@ -243,8 +274,9 @@ class EDL_API:
     def server(self):
         """启动TCP/IP服务器模式
 
-        启动一个TCP服务器，允许通过网络连接与EDL设备通信。
-        服务器默认监听端口1340，可以通过--tcpport参数修改。
+        启动一个异步任务服务器，设备会话保持打开，多个客户端的任务按优先级排队执行。
+        服务器默认监听端口1340，可以通过--tcpport参数修改，或通过--unixsocket改用Unix套接字。
+        通信协议见 edlclient.Library.rpc_server。
 
         Returns:
             int: 服务器运行状态码，0表示成功，非0表示失败
@@ -252,6 +284,24 @@ class EDL_API:
         """
         return self.edl.fh.handle_firehose("server", self.edl.args)
 
+    def nbd(self, lun: int = 0, socket: str = "/tmp/edl-nbd.sock"):
+        """将LUN导出为网络块设备（NBD）
+
+        在Unix套接字上运行NBD服务器，可通过 nbd-client -unix <socket> /dev/nbd0 挂载。
+        支持读、写和trim（映射为<erase>），读取经过LRU块缓存，--skipwrite时以只读方式导出。
+
+        Args:
+            lun: 逻辑单元号
+            socket: Unix套接字路径
+
+        Returns:
+            bool: 服务器运行结果
+
+        """
+        self.set_arg("--lun", str(lun))
+        self.set_arg("--socket", socket)
+        return self.edl.fh.handle_firehose("nbd", self.edl.args)
+
     def memory_dump(self):
         """执行内存转储
 
@@ -374,6 +424,55 @@ class EDL_API:
         self.set_arg("<filename>", filename)
         return self.edl.fh.handle_firehose("rs", self.edl.args)
 
+    def open_partition(self, partitionname: str, mode: str = "rb"):
+        """以类文件对象方式打开分区
+
+        返回的对象支持 read(n)、readinto、write、seek 和 tell，读写会自动分块为
+        <read>/<program> 命令，不会一次性把整个分区读入内存。
+
+        Args:
+            partitionname: 分区名称（如"boot", "system"等）
+            mode: 打开模式，"rb"只读、"wb"只写、"r+b"读写
+
+        Returns:
+            sector_stream: 类文件对象，找不到分区时返回None
+
+        """
+        return self.edl.fh.firehose.open_partition(partitionname, mode, self.edl.args)
+
+    def open_sectors(self, lun: int, start: int, count: int = None, mode: str = "rb"):
+        """以类文件对象方式打开扇区范围
+
+        Args:
+            lun: 逻辑单元号
+            start: 起始扇区号
+            count: 扇区数量，None表示不限制长度
+            mode: 打开模式，"rb"只读、"wb"只写、"r+b"读写
+
+        Returns:
+            sector_stream: 类文件对象
+
+        """
+        return self.edl.fh.firehose.open_sectors(lun, start, count, mode)
+
+    def block_device(self, lun: int = 0, start_sector: int = 0, sectors: int = None, **kwargs):
+        """获取带LRU缓存的随机访问块设备视图
+
+        适合解析文件系统、boot镜像头或LP元数据等需要大量小块随机读取的场景，
+        相邻的缺失块会合并为一次<read>，顺序读取时自动预读。
+
+        Args:
+            lun: 逻辑单元号
+            start_sector: 视图起始扇区
+            sectors: 视图扇区数量，None表示不限制
+            **kwargs: 传递给BlockDevice的缓存参数（blocksize, cachesize, readahead, coalesce）
+
+        Returns:
+            BlockDevice: 块设备对象，通过pread(offset, length)读取，stats()获取命中统计
+
+        """
+        return BlockDevice(self.edl.fh.firehose, lun, start_sector, sectors, **kwargs)
+
     def w(self, partitionname: str, filename: str):
         """写入文件到指定分区
 
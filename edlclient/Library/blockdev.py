@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+from collections import OrderedDict
+
+
+class BlockDevice:
+    """
+    Random access view on a lun (or a sector window of it) via firehose.
+
+    Data is cached as fixed-size aligned blocks in an LRU cache. Missing blocks
+    of one request are fetched in as few <read> commands as possible: runs whose
+    gap is at most `coalesce` blocks are merged into one read. Sequential access
+    enables read-ahead, the window doubles on every sequential request up to
+    `readahead` blocks.
+    """
+
+    def __init__(self, fh, lun, start_sector=0, sectors=None, blocksize=16 * 1024,
+                 cachesize=32 * 1024 * 1024, readahead=64, coalesce=4):
+        self.fh = fh
+        self.lun = lun
+        self.start_sector = start_sector
+        self.sectors = sectors
+        self.sectorsize = fh.cfg.SECTOR_SIZE_IN_BYTES
+        blocksize = max(blocksize, self.sectorsize)
+        self.blocksize = blocksize - blocksize % self.sectorsize
+        self.sectors_per_block = self.blocksize // self.sectorsize
+        self.maxblocks = max(1, cachesize // self.blocksize)
+        self.readahead = readahead
+        self.coalesce = coalesce
+        self.size = None if sectors is None else sectors * self.sectorsize
+        self.cache = OrderedDict()
+        self.ra_window = 0
+        self.nextoffset = None
+        self.hits = 0
+        self.misses = 0
+        self.readahead_blocks = 0
+        self.reads = 0
+        self.bytes_read = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, readahead=self.readahead_blocks,
+                    reads=self.reads, bytes_read=self.bytes_read, cached=len(self.cache))
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.readahead_blocks = 0
+        self.reads = 0
+        self.bytes_read = 0
+
+    def numblocks(self):
+        if self.size is None:
+            return None
+        return (self.size + self.blocksize - 1) // self.blocksize
+
+    def invalidate(self, offset=0, length=None):
+        if length is None:
+            self.cache.clear()
+            return
+        first = offset // self.blocksize
+        last = (offset + length - 1) // self.blocksize
+        for blk in range(first, last + 1):
+            self.cache.pop(blk, None)
+
+    def store(self, blk, data):
+        self.cache[blk] = data
+        self.cache.move_to_end(blk)
+        while len(self.cache) > self.maxblocks:
+            self.cache.popitem(last=False)
+
+    def fetch(self, blk, count):
+        sector = blk * self.sectors_per_block
+        nsectors = count * self.sectors_per_block
+        if self.sectors is not None:
+            nsectors = min(nsectors, self.sectors - sector)
+        rsp = self.fh.cmd_read_buffer(self.lun, self.start_sector + sector, nsectors, False)
+        if not rsp.resp:
+            raise IOError(f"Error reading lun {self.lun} sector {self.start_sector + sector}: {rsp.error}")
+        self.reads += 1
+        self.bytes_read += len(rsp.data)
+        data = bytes(rsp.data)
+        blocks = {}
+        for i in range(count):
+            chunk = data[i * self.blocksize:(i + 1) * self.blocksize]
+            if not chunk:
+                break
+            blocks[blk + i] = chunk
+            self.store(blk + i, chunk)
+        return blocks
+
+    def plan(self, missing):
+        runs = []
+        for blk in missing:
+            if runs and blk - (runs[-1][0] + runs[-1][1]) <= self.coalesce:
+                runs[-1][1] = blk - runs[-1][0] + 1
+            else:
+                runs.append([blk, 1])
+        return runs
+
+    def pread(self, offset, length):
+        if offset < 0 or length < 0:
+            raise ValueError("Negative offset or length")
+        if self.size is not None:
+            length = min(length, max(0, self.size - offset))
+        if length == 0:
+            return b""
+        bs = self.blocksize
+        first = offset // bs
+        last = (offset + length - 1) // bs
+        blocks = {}
+        missing = []
+        for blk in range(first, last + 1):
+            data = self.cache.get(blk)
+            if data is None:
+                missing.append(blk)
+            else:
+                self.cache.move_to_end(blk)
+                blocks[blk] = data
+        self.hits += len(blocks)
+        self.misses += len(missing)
+
+        if self.nextoffset is not None and offset == self.nextoffset:
+            self.ra_window = min(self.readahead, max(1, self.ra_window * 2))
+        else:
+            self.ra_window = 0
+        self.nextoffset = offset + length
+
+        runs = self.plan(missing)
+        if self.ra_window:
+            end = last + 1 + self.ra_window
+            nblocks = self.numblocks()
+            if nblocks is not None:
+                end = min(end, nblocks)
+            ra = [blk for blk in range(last + 1, end) if blk not in self.cache]
+            if ra:
+                self.readahead_blocks += len(ra)
+                if runs and ra[0] - (runs[-1][0] + runs[-1][1]) <= self.coalesce:
+                    runs[-1][1] = ra[-1] - runs[-1][0] + 1
+                else:
+                    runs.append([ra[0], ra[-1] - ra[0] + 1])
+        for blk, count in runs:
+            for rblk, data in self.fetch(blk, count).items():
+                if first <= rblk <= last:
+                    blocks[rblk] = data
+
+        out = bytearray()
+        for blk in range(first, last + 1):
+            data = blocks.get(blk)
+            if data is None:
+                break
+            out.extend(data)
+        start = offset - first * bs
+        return bytes(out[start:start + length])
+
+    def pwrite(self, offset, data):
+        if offset < 0:
+            raise ValueError("Negative offset")
+        if self.size is not None and offset + len(data) > self.size:
+            raise IOError(f"Write of {len(data)} bytes at {offset} exceeds device size")
+        if not data:
+            return 0
+        ss = self.sectorsize
+        head = offset % ss
+        end = offset + len(data)
+        tail = (-end) % ss
+        buf = bytearray()
+        if head:
+            buf.extend(self.pread(offset - head, head))
+        buf.extend(data)
+        if tail:
+            buf.extend(self.pread(end, tail))
+        start = offset - head
+        if not self.fh.cmd_program_buffer(self.lun, self.start_sector + start // ss, buf, False):
+            raise IOError(f"Error writing lun {self.lun} sector {self.start_sector + start // ss}")
+        self.invalidate(start, len(buf))
+        return len(data)
+
+    def discard(self, offset, length):
+        ss = self.sectorsize
+        first = (offset + ss - 1) // ss
+        last = (offset + length) // ss
+        if last <= first:
+            return True
+        if not self.fh.cmd_erase(self.lun, self.start_sector + first, last - first, False):
+            raise IOError(f"Error erasing lun {self.lun} sector {self.start_sector + first}")
+        self.invalidate(first * ss, (last - first) * ss)
+        return True
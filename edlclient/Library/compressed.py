@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import bz2
+import gzip
+import lzma
+import os
+from queue import Queue, Empty
+from threading import Thread, Event
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_MAGICS = [
+    (b"\x1f\x8b", "gzip"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"BZh", "bz2"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+]
+COMPRESSION_EXTENSIONS = [".gz", ".xz", ".bz2", ".zst"]
+
+
+def detect_compression(filename):
+    try:
+        with open(filename, "rb") as rf:
+            magic = rf.read(6)
+    except OSError:
+        return None
+    for signature, kind in COMPRESSION_MAGICS:
+        if magic.startswith(signature):
+            return kind
+    return None
+
+
+def find_compressed(filename):
+    """ Returns filename or an existing compressed variant of it (filename.gz, ...) """
+    if os.path.exists(filename):
+        return filename
+    for ext in COMPRESSION_EXTENSIONS:
+        if os.path.exists(filename + ext):
+            return filename + ext
+    return filename
+
+
+def strip_compression_ext(filename):
+    for ext in COMPRESSION_EXTENSIONS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def open_compressed(filename, kind=None):
+    if kind is None:
+        kind = detect_compression(filename)
+    if kind == "gzip":
+        return gzip.open(filename, "rb")
+    elif kind == "xz":
+        return lzma.open(filename, "rb")
+    elif kind == "bz2":
+        return bz2.open(filename, "rb")
+    elif kind == "zstd":
+        if zstandard is None:
+            raise IOError("zstandard library is missing, can't decompress " + filename)
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+    return open(filename, "rb")
+
+
+def uncompressed_size(filename, kind=None, chunksize=0x100000):
+    """ Size of the decompressed data, found by decompressing once (the formats don't store it reliably) """
+    size = 0
+    with open_compressed(filename, kind) as rf:
+        while True:
+            data = rf.read(chunksize)
+            if not data:
+                return size
+            size += len(data)
+
+
+class background_reader:
+    """
+    Decompresses a stream in a worker thread into a bounded queue of chunks,
+    so decompression overlaps with the usb transfer. read(n) returns exactly
+    n bytes unless the end of the stream is reached.
+    """
+
+    def __init__(self, stream, chunksize=0x100000, depth=8):
+        self.stream = stream
+        self.chunksize = chunksize
+        self.queue = Queue(maxsize=depth)
+        self.stop = Event()
+        self.buffer = bytearray()
+        self.eof = False
+        self.exception = None
+        self.worker = Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                data = self.stream.read(self.chunksize)
+                if not data:
+                    break
+                self.queue.put(data)
+        except Exception as err:  # pylint: disable=broad-except
+            self.exception = err
+        finally:
+            self.queue.put(None)
+
+    def fill(self, length):
+        while len(self.buffer) < length and not self.eof:
+            data = self.queue.get()
+            if data is None:
+                self.eof = True
+                if self.exception is not None:
+                    raise IOError(str(self.exception))
+                break
+            self.buffer.extend(data)
+
+    def peek(self, length):
+        self.fill(length)
+        return bytes(self.buffer[:length])
+
+    def read(self, length=-1):
+        if length is None or length < 0:
+            while not self.eof:
+                self.fill(len(self.buffer) + self.chunksize)
+            length = len(self.buffer)
+        self.fill(length)
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return data
+
+    def close(self):
+        self.stop.set()
+        # Unblock a worker waiting on a full queue, the sentinel may already have been consumed
+        while not self.eof:
+            try:
+                if self.queue.get(timeout=0.1) is None:
+                    break
+            except Empty:
+                if not self.worker.is_alive():
+                    break
+        self.worker.join()
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+COMPRESSION_KINDS = {"gzip": ".gz", "gz": ".gz", "xz": ".xz", "bz2": ".bz2", "zstd": ".zst", "zst": ".zst"}
+
+
+def check_compressed_writer(kind):
+    """ Raises ValueError/IOError if open_compressed_writer can't write kind, before anything is opened """
+    if kind is None:
+        return
+    if kind not in COMPRESSION_KINDS:
+        raise ValueError(f"Unknown compression {kind}, use one of {', '.join(COMPRESSION_KINDS)}")
+    if kind in ("zstd", "zst") and zstandard is None:
+        raise IOError("zstandard library is missing, can't compress with " + kind)
+
+
+def open_compressed_writer(filename, kind=None):
+    """ Opens filename for writing, compressed with kind (gzip, xz, bz2, zstd) if given """
+    if kind in ("gzip", "gz"):
+        return gzip.open(filename, "wb", compresslevel=1)
+    elif kind == "xz":
+        return lzma.open(filename, "wb", preset=0)
+    elif kind == "bz2":
+        return bz2.open(filename, "wb", compresslevel=1)
+    elif kind in ("zstd", "zst"):
+        if zstandard is None:
+            raise IOError("zstandard library is missing, can't compress " + filename)
+        return zstandard.ZstdCompressor(level=1).stream_writer(open(filename, "wb"), closefd=True)
+    elif kind is not None:
+        raise ValueError(f"Unknown compression {kind}, use one of {', '.join(COMPRESSION_KINDS)}")
+    return open(filename, "wb")
+
+
+class background_writer:
+    """
+    Writes chunks to a file in a worker thread through a bounded queue, so disk writes overlap
+    with the usb transfer. With sparse, all zero chunks become holes instead of writes.
+    write() takes a buffer and a length, release(buffer) is called once it has been written.
+    """
+
+    def __init__(self, stream, depth=8, sparse=False, release=None):
+        self.stream = stream
+        self.sparse = sparse
+        self.release = release
+        self.queue = Queue(maxsize=depth)
+        self.hole = 0
+        self.written = 0
+        self.exception = None
+        self.worker = Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            buffer, length = item
+            try:
+                if self.exception is None:
+                    self.store(buffer, length)
+            except Exception as err:  # pylint: disable=broad-except
+                self.exception = err
+            finally:
+                if self.release is not None:
+                    self.release(buffer)
+
+    def store(self, buffer, length):
+        if self.sparse and buffer.count(0, 0, length) == length:
+            self.hole += length
+        else:
+            if self.hole:
+                self.stream.seek(self.hole, os.SEEK_CUR)
+                self.hole = 0
+            self.stream.write(memoryview(buffer)[:length])
+        self.written += length
+
+    def write(self, buffer, length=None):
+        if self.exception is not None:
+            raise IOError(str(self.exception))
+        self.queue.put((buffer, len(buffer) if length is None else length))
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+        if self.hole:
+            self.stream.seek(self.hole, os.SEEK_CUR)
+            self.stream.truncate()
+            self.hole = 0
+        if self.exception is not None:
+            raise IOError(str(self.exception))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
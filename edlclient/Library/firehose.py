@@ -13,14 +13,22 @@ import platform
 from binascii import hexlify
 from queue import Queue
 from threading import Thread
+from struct import pack
 from typing import Tuple, Optional
 
 from edlclient.Library.Modules.nothing import nothing
+from edlclient.Library.compressed import detect_compression, open_compressed, background_reader, \
+    uncompressed_size
 from edlclient.Library.gpt import gpt, AB_FLAG_OFFSET, AB_PARTITION_ATTR_SLOT_ACTIVE
-from edlclient.Library.sparse import QCSparse
+from edlclient.Library.partition_io import sector_stream
+from edlclient.Library.partindex import partition_index
+from edlclient.Library.sparse import QCSparse, sparse_stream_reader, SPARSE_HEADER_MAGIC
+from edlclient.Library.zeroscan import scan_extents, FILL_THRESHOLD
 from edlclient.Library.utils import *
 from edlclient.Library.utils import progress
 
+PROGRAM_SEGMENT_SIZE = 0x2000000  # 32 MiB per <program> if the image size isn't known upfront
+
 
 def writedata(filename, rq):
     pos = 0
@@ -195,6 +203,11 @@ class firehose(metaclass=LogBase):
         self.luns = luns
         self.supported_functions = []
         self.lunsizes = {}
+        self.native_erase = {}
+        self.partindex = None
+        self.partables = {}
+        self.tablesectors = {}
+        self.partindex_args = None
         self.rq = Queue()
         self.info = self.__logger.info
         self.error = self.__logger.error
@@ -210,28 +223,112 @@ class firehose(metaclass=LogBase):
         self.nandpart = nand_partition(parent=self, printer=print)
 
     def detect_partition(self, arguments, partitionname, send_full=False):
+        """ Looks up a partition by name through the cached partition index of all luns """
+        index = self.get_partition_index(arguments)
+        record = index.get(partitionname)
+        if record is not None:
+            data, guid_gpt = self.partables[record.lun]
+            return [True, record.lun, data, guid_gpt] if send_full else [True, record.lun,
+                                                                         guid_gpt.partentries[partitionname]]
+        fpartitions = {}
+        for lun, (data, guid_gpt) in self.partables.items():
+            fpartitions["Lun" + str(lun)] = list(guid_gpt.partentries)
+        return [False, fpartitions]
+
+    def get_partition_index(self, arguments=None, refresh=False):
+        """
+        构建（或返回缓存的）所有 LUN 的分区区间索引，用于扇区到分区的快速映射。
+
+        Args:
+            arguments (dict): 包含 GPT 参数的命令行参数，None 表示使用默认值。
+            refresh (bool): 是否重新读取分区表（例如写入 GPT 之后）。
+
+        Returns:
+            partition_index: 分区区间索引。
+        """
         if arguments is None:
             arguments = {
                 "--gpt-num-part-entries": 0,
                 "--gpt-part-entry-size": 0,
                 "--gpt-part-entry-start-lba": 0
             }
-        fpartitions = {}
+        gptargs = (int(arguments["--gpt-num-part-entries"]), int(arguments["--gpt-part-entry-size"]),
+                   int(arguments["--gpt-part-entry-start-lba"]))
+        if self.partindex is not None and not refresh and gptargs == self.partindex_args:
+            return self.partindex
+        index = partition_index()
+        self.partables = {}
+        self.tablesectors = {}
         for lun in self.luns:
-            lunname = "Lun" + str(lun)
-            fpartitions[lunname] = []
-            data, guid_gpt = self.get_gpt(lun, int(arguments["--gpt-num-part-entries"]),
-                                          int(arguments["--gpt-part-entry-size"]),
-                                          int(arguments["--gpt-part-entry-start-lba"]))
+            data, guid_gpt = self.get_gpt(lun, *gptargs)
             if guid_gpt is None:
                 break
-            else:
-                if partitionname in guid_gpt.partentries:
-                    return [True, lun, data, guid_gpt] if send_full else [True, lun,
-                                                                          guid_gpt.partentries[partitionname]]
-            for part in guid_gpt.partentries:
-                fpartitions[lunname].append(part)
-        return [False, fpartitions]
+            index.add_table(lun, guid_gpt.partentries)
+            self.partables[lun] = (data, guid_gpt)
+            header = getattr(guid_gpt, "header", None)
+            if header is not None:
+                # Primary GPT up to first_usable_lba, backup GPT after last_usable_lba
+                self.tablesectors[lun] = [(0, header.first_usable_lba), (header.last_usable_lba + 1, None)]
+            elif getattr(guid_gpt, "partitiontblsector", None) is not None:
+                # NAND: the table sector and the two sectors parsed after it
+                self.tablesectors[lun] = [(guid_gpt.partitiontblsector, guid_gpt.partitiontblsector + 3)]
+        self.partindex = index
+        self.partindex_args = gptargs
+        return index
+
+    def invalidate_partindex(self, lun, start_sector, sectors):
+        """
+        Drops the cached partition index if a write or erase may touch the partition table
+        sectors of the lun (primary and backup GPT, or the NAND partition table).
+        Luns without a cached table and symbolic sectors count as touching it.
+        """
+        if self.partindex is None:
+            return
+        ranges = self.tablesectors.get(lun)
+        try:
+            start_sector = int(start_sector)
+        except (TypeError, ValueError):
+            ranges = None
+        if ranges is None or any(start_sector + sectors > tstart and (tend is None or start_sector < tend)
+                                 for tstart, tend in ranges):
+            self.partindex = None
+
+    def open_sectors(self, lun, start_sector, sectors=None, mode="rb", chunksize=None):
+        """
+        打开 LUN 上的扇区范围，返回类文件对象（支持 read/readinto/write/seek）。
+
+        Args:
+            lun (int): 逻辑单元号 (LUN)。
+            start_sector (int): 起始扇区。
+            sectors (int): 扇区数量，None 表示不限制长度。
+            mode (str): 打开模式，"rb"、"wb" 或 "r+b"。
+            chunksize (int): 单次 <read>/<program> 的最大字节数，默认使用 MaxPayloadSizeToTargetInBytes。
+
+        Returns:
+            sector_stream: 类文件对象。
+        """
+        return sector_stream(self, lun, start_sector, sectors, mode, chunksize=chunksize)
+
+    def open_partition(self, partitionname, mode="rb", arguments=None, chunksize=None):
+        """
+        按分区名打开分区，返回类文件对象。
+
+        Args:
+            partitionname (str): 分区名称。
+            mode (str): 打开模式，"rb"、"wb" 或 "r+b"。
+            arguments (dict): 用于 GPT 解析的参数，None 表示使用默认值。
+            chunksize (int): 单次 <read>/<program> 的最大字节数。
+
+        Returns:
+            Optional[sector_stream]: 类文件对象，找不到分区时返回 None。
+        """
+        res = self.detect_partition(arguments, partitionname)
+        if not res[0]:
+            return None
+        lun = res[1]
+        partition = res[2]
+        return sector_stream(self, lun, partition.sector, partition.sectors, mode, name=partitionname,
+                             chunksize=chunksize)
 
     def getstatus(self, resp):
         if "value" in resp:
@@ -356,6 +453,7 @@ class firehose(metaclass=LogBase):
     def cmd_xml(self, filename):
         with open(filename, 'rb') as rf:
             data = rf.read()
+            self.partindex = None
             val = self.xmlsend(data)
             if val.resp:
                 self.info("Command succeeded." + str(val.data))
@@ -442,6 +540,7 @@ class firehose(metaclass=LogBase):
         if self.modules is not None:
             data += self.modules.addpatch()
         data += f"/>\n</data>"
+        self.invalidate_partindex(physical_partition_number, start_sector, 1)
 
         rsp = self.xmlsend(data)
         if rsp.resp:
@@ -471,13 +570,22 @@ class firehose(metaclass=LogBase):
             return f" PAGES_PER_BLOCK=\"{self.cfg.PAGES_PER_BLOCK}\""
         return ""
 
-    def cmd_program(self, physical_partition_number, start_sector, filename, display=True):
+    def cmd_program(self, physical_partition_number, start_sector, filename, display=True, max_sectors=None,
+                    skipfill=False):
+        compression = detect_compression(filename)
+        if compression is not None:
+            return self.cmd_program_compressed(physical_partition_number, start_sector, filename, compression,
+                                               display, max_sectors)
         total = os.stat(filename).st_size
         sparse = QCSparse(filename, self.loglevel)
         sparseformat = False
         if sparse.readheader():
             sparseformat = True
             total = sparse.getsize()
+        elif skipfill:
+            if "erase" in self.supported_functions:
+                return self.cmd_program_skipfill(physical_partition_number, start_sector, filename, display)
+            self.info("Native erase isn't supported, programming the whole image.")
         bytestowrite = total
         progbar = progress(self.cfg.SECTOR_SIZE_IN_BYTES)
         with open(filename, "rb") as rf:
@@ -498,6 +606,7 @@ class firehose(metaclass=LogBase):
             if self.modules is not None:
                 data += self.modules.addprogram()
             data += f"/>\n</data>"
+            self.invalidate_partindex(physical_partition_number, start_sector, num_partition_sectors)
             rsp = self.xmlsend(data, self.skipresponse)
             progbar.show_progress(prefix="Write", pos=0, total=total, display=display)
             if rsp.resp:
@@ -534,6 +643,167 @@ class firehose(metaclass=LogBase):
                     return False
         return True
 
+    def cmd_program_skipfill(self, physical_partition_number, start_sector, filename, display=True):
+        """
+        Programs only the data extents of a raw image. Runs of at least FILL_THRESHOLD bytes
+        of the erase pattern (0xFF on NAND, zeros otherwise) are erased via <erase> instead.
+        With several such runs and a working native erase, the whole target area is erased once
+        up front, so only the data extents have to be programmed afterwards. If native erase is
+        unknown, the first run is erased on its own to find out. Without native erase only the
+        runs are written with the fill byte, never the whole area.
+        """
+        sectorsize = self.cfg.SECTOR_SIZE_IN_BYTES
+        blocksize = max(sectorsize, 4096)
+        fill = 0xFF if self.cfg.MemoryName.lower() == "nand" else 0x00
+        total = os.stat(filename).st_size
+        with open(filename, "rb") as rf:
+            extents = scan_extents(rf, total, blocksize, FILL_THRESHOLD, fill)
+            datasize = sum(length for _, length, isfill in extents if not isfill)
+            fillranges = [(start_sector + offset // sectorsize, length // sectorsize)
+                          for offset, length, isfill in extents if isfill]
+            if display:
+                self.info(f"\nWriting to physical partition {str(physical_partition_number)}, " +
+                          f"sector {str(start_sector)}, {hex(datasize)} of {hex(total)} bytes are data")
+            erased = False
+            done = 0
+            if len(fillranges) > 1 and self.native_erase_usable(physical_partition_number):
+                if self.native_erase.get(physical_partition_number) is None:
+                    # A rejected native erase only costs a fill write of this run
+                    if not self.cmd_erase_ranges(physical_partition_number, fillranges[:1], display, fill):
+                        return False
+                    done = 1
+                if self.native_erase.get(physical_partition_number):
+                    sectors = (total + sectorsize - 1) // sectorsize
+                    if not self.cmd_erase_ranges(physical_partition_number, [(start_sector, sectors)], display,
+                                                 fill):
+                        return False
+                    erased = True
+            progbar = progress(sectorsize)
+            written = 0
+            for offset, length, isfill in extents:
+                if isfill:
+                    continue
+                rf.seek(offset)
+                if not self.cmd_program_stream(physical_partition_number, start_sector + offset // sectorsize, rf,
+                                               length, False):
+                    return False
+                written += length
+                progbar.show_progress(prefix="Write", pos=written, total=datasize, display=display)
+        if not erased and fillranges[done:]:
+            return self.cmd_erase_ranges(physical_partition_number, fillranges[done:], False, fill)
+        return True
+
+    def cmd_program_compressed(self, physical_partition_number, start_sector, filename, compression, display=True,
+                               max_sectors=None):
+        """
+        Decompresses gzip/xz/bz2/zstd images on the fly while programming, sparse images inside
+        the compressed stream are expanded as well. Nothing is unpacked to disk.
+        """
+        try:
+            stream = background_reader(open_compressed(filename, compression),
+                                       max(self.cfg.MaxPayloadSizeToTargetInBytes, 0x100000))
+        except IOError as err:
+            self.error(str(err))
+            return False
+        try:
+            total = None
+            rf = stream
+            if stream.peek(4) == pack("<I", SPARSE_HEADER_MAGIC):
+                sparse = sparse_stream_reader(stream)
+                if sparse.readheader():
+                    self.info("Sparse Format detected. Using unpacked image.")
+                    total = sparse.getsize()
+                    rf = sparse
+            if total is None and max_sectors is not None:
+                # Check the size before the first segment gets written, not after the target is half full
+                if display:
+                    self.info(f"Checking the decompressed size of {filename}")
+                total = uncompressed_size(filename, compression)
+            if display:
+                self.info(f"Decompressing {compression} image {filename}")
+            return self.cmd_program_stream(physical_partition_number, start_sector, rf, total, display,
+                                           max_sectors)
+        except IOError as err:
+            self.error(str(err))
+            return False
+        finally:
+            stream.close()
+
+    def cmd_program_stream(self, physical_partition_number, start_sector, rf, total=None, display=True,
+                           max_sectors=None):
+        """
+        Programs data read from a stream. If the total size is unknown, the stream is written
+        in segments of PROGRAM_SEGMENT_SIZE with one <program> per segment.
+        """
+        sectorsize = self.cfg.SECTOR_SIZE_IN_BYTES
+        progbar = progress(sectorsize)
+        written = 0
+        pending = b""
+        while True:
+            if total is not None:
+                length = total - written
+                if length <= 0:
+                    break
+            else:
+                pending = rf.read(PROGRAM_SEGMENT_SIZE)
+                if not pending:
+                    break
+                length = len(pending)
+            num_partition_sectors = (length + sectorsize - 1) // sectorsize
+            sector = start_sector + written // sectorsize
+            if max_sectors is not None and written // sectorsize + num_partition_sectors > max_sectors:
+                self.error(f"Image is larger than the target ({max_sectors} sectors), aborting.")
+                return False
+            if display and (total is not None or written == 0):
+                self.info(f"\nWriting to physical partition {str(physical_partition_number)}, " +
+                          f"sector {str(sector)}" +
+                          (f", sectors {str(num_partition_sectors)}" if total is not None else ""))
+            data = f"<?xml version=\"1.0\" ?><data>\n" + \
+                   f"<program SECTOR_SIZE_IN_BYTES=\"{sectorsize}\"" + \
+                   f" num_partition_sectors=\"{num_partition_sectors}\"" + \
+                   f" physical_partition_number=\"{physical_partition_number}\"" + \
+                   f" start_sector=\"{sector}\""
+            data += self.nand_pages_attr() + " "
+            if self.modules is not None:
+                data += self.modules.addprogram()
+            data += f"/>\n</data>"
+            self.invalidate_partindex(physical_partition_number, sector, num_partition_sectors)
+            rsp = self.xmlsend(data, self.skipresponse)
+            if not rsp.resp:
+                self.error(f"Error:{rsp.error}")
+                return False
+            pos = 0
+            while pos < length:
+                wlen = min(length - pos, self.cfg.MaxPayloadSizeToTargetInBytes)
+                if total is not None:
+                    wdata = rf.read(wlen)
+                    if len(wdata) != wlen:
+                        self.error("Unexpected end of image data")
+                        return False
+                else:
+                    wdata = pending[pos:pos + wlen]
+                pos += wlen
+                if wlen % sectorsize != 0:
+                    wdata += b"\x00" * (sectorsize - wlen % sectorsize)
+                self.cdc.write(wdata)
+                progbar.show_progress(prefix="Write", pos=written + pos,
+                                      total=total if total is not None else written + length, display=display)
+                self.cdc.write(b'')
+            written += num_partition_sectors * sectorsize
+            wd = self.wait_for_data()
+            log = self.xml.getlog(wd)
+            rsp = self.xml.getresponse(wd)
+            if "value" in rsp:
+                if rsp["value"] != "ACK":
+                    self.error(f"Error:")
+                    for line in log:
+                        self.error(line)
+                    return False
+            else:
+                self.error(f"Error:{rsp}")
+                return False
+        return True
+
     def cmd_program_buffer(self, physical_partition_number, start_sector, wfdata, display=True):
         bytestowrite = len(wfdata)
         total = bytestowrite
@@ -554,6 +824,7 @@ class firehose(metaclass=LogBase):
         if self.modules is not None:
             data += self.modules.addprogram()
         data += f"/>\n</data>"
+        self.invalidate_partindex(physical_partition_number, start_sector, num_partition_sectors)
         rsp = self.xmlsend(data, self.skipresponse)
         progbar = progress(self.cfg.SECTOR_SIZE_IN_BYTES)
         progbar.show_progress(prefix="Write", pos=0, total=total, display=display)
@@ -594,26 +865,92 @@ class firehose(metaclass=LogBase):
         return True
 
     def cmd_erase(self, physical_partition_number, start_sector, num_partition_sectors, display=True):
-        if display:
-            self.info(f"\nErasing from physical partition {str(physical_partition_number)}, " +
-                      f"sector {str(start_sector)}, sectors {str(num_partition_sectors)}")
+        return self.cmd_erase_ranges(physical_partition_number, [(start_sector, num_partition_sectors)], display)
 
-        if "erase" in self.supported_functions:
-            data = f"<?xml version=\"1.0\" ?><data>\n" + \
-                   f"<erase SECTOR_SIZE_IN_BYTES=\"{self.cfg.SECTOR_SIZE_IN_BYTES}\"" + \
-                   f" num_partition_sectors=\"{num_partition_sectors}\"" + \
-                   f" physical_partition_number=\"{physical_partition_number}\"" + \
-                   f" start_sector=\"{start_sector}\""
-            data += self.nand_pages_attr() + " "
-            if self.modules is not None:
-                data += self.modules.addprogram()
-            data += f"/>\n</data>"
-            rsp = self.xmlsend(data, self.skipresponse)
-            if rsp.resp:
-                return True
-            self.error(f"Error:{rsp.error}")
-            return False
+    def erase_alignment(self):
+        """ Native erases on UFS are aligned to the erase block size, the fringes are written instead """
+        if self.cfg.MemoryName.lower() == "ufs" and self.cfg.block_size > self.cfg.SECTOR_SIZE_IN_BYTES:
+            return self.cfg.block_size // self.cfg.SECTOR_SIZE_IN_BYTES
+        return 1
+
+    def native_erase_usable(self, physical_partition_number):
+        """ False once the loader lacks <erase> or rejected it on this lun, True if it worked or is untested """
+        return "erase" in self.supported_functions and self.native_erase.get(physical_partition_number, True)
+
+    def plan_erase(self, physical_partition_number, ranges):
+        """
+        Merges adjacent/overlapping (start_sector, sectors) ranges and splits them into
+        [start_sector, sectors, native] operations: aligned parts use a native <erase>,
+        unaligned fringes are written with the fill byte. Without (working) native erase
+        everything is written.
+        """
+        merged = []
+        for start, sectors in sorted((int(start), int(sectors)) for start, sectors in ranges if int(sectors) > 0):
+            if merged and start <= merged[-1][0] + merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], start + sectors - merged[-1][0])
+            else:
+                merged.append([start, sectors])
+        if not self.native_erase_usable(physical_partition_number):
+            return [[start, sectors, False] for start, sectors in merged]
+        align = self.erase_alignment()
+        plan = []
+        for start, sectors in merged:
+            end = start + sectors
+            astart = (start + align - 1) // align * align
+            aend = end // align * align
+            if aend <= astart:
+                plan.append([start, sectors, False])
+                continue
+            if astart > start:
+                plan.append([start, astart - start, False])
+            plan.append([astart, aend - astart, True])
+            if end > aend:
+                plan.append([aend, end - aend, False])
+        return plan
+
+    def cmd_erase_ranges(self, physical_partition_number, ranges, display=True, fill=0x00):
+        """
+        Erases several sector ranges of one lun, for example multiple partitions, using as few
+        commands as possible. If a native erase gets rejected, the lun is marked as not
+        supporting it and the range is written with the fill byte instead, so callers relying
+        on the erase pattern (0xFF on NAND) get that pattern and not zeros.
+        """
+        for start_sector, sectors, native in self.plan_erase(physical_partition_number, ranges):
+            if display:
+                self.info(f"\nErasing from physical partition {str(physical_partition_number)}, " +
+                          f"sector {str(start_sector)}, sectors {str(sectors)}")
+            if native:
+                if self.cmd_erase_native(physical_partition_number, start_sector, sectors):
+                    self.native_erase[physical_partition_number] = True
+                    continue
+                if self.native_erase.get(physical_partition_number) is not None:
+                    return False
+                self.warning(f"Native erase failed on physical partition {str(physical_partition_number)}, " +
+                             f"writing {hex(fill)} instead.")
+                self.native_erase[physical_partition_number] = False
+            if not self.cmd_erase_fill(physical_partition_number, start_sector, sectors, display, fill):
+                return False
+        return True
+
+    def cmd_erase_native(self, physical_partition_number, start_sector, num_partition_sectors):
+        data = f"<?xml version=\"1.0\" ?><data>\n" + \
+               f"<erase SECTOR_SIZE_IN_BYTES=\"{self.cfg.SECTOR_SIZE_IN_BYTES}\"" + \
+               f" num_partition_sectors=\"{num_partition_sectors}\"" + \
+               f" physical_partition_number=\"{physical_partition_number}\"" + \
+               f" start_sector=\"{start_sector}\""
+        data += self.nand_pages_attr() + " "
+        if self.modules is not None:
+            data += self.modules.addprogram()
+        data += f"/>\n</data>"
+        self.invalidate_partindex(physical_partition_number, start_sector, num_partition_sectors)
+        rsp = self.xmlsend(data, self.skipresponse)
+        if rsp.resp:
+            return True
+        self.error(f"Error:{rsp.error}")
+        return False
 
+    def cmd_erase_fill(self, physical_partition_number, start_sector, num_partition_sectors, display=True,
+                       fill=0x00):
         data = f"<?xml version=\"1.0\" ?><data>\n" + \
                f"<program SECTOR_SIZE_IN_BYTES=\"{self.cfg.SECTOR_SIZE_IN_BYTES}\"" + \
                f" num_partition_sectors=\"{num_partition_sectors}\"" + \
@@ -623,9 +960,10 @@ class firehose(metaclass=LogBase):
         if self.modules is not None:
             data += self.modules.addprogram()
         data += f"/>\n</data>"
+        self.invalidate_partindex(physical_partition_number, start_sector, num_partition_sectors)
 
         rsp = self.xmlsend(data, self.skipresponse)
-        empty = b"\x00" * self.cfg.MaxPayloadSizeToTargetInBytes
+        empty = bytes([fill]) * self.cfg.MaxPayloadSizeToTargetInBytes
         pos = 0
         bytestowrite = self.cfg.SECTOR_SIZE_IN_BYTES * num_partition_sectors
         total = self.cfg.SECTOR_SIZE_IN_BYTES * num_partition_sectors
@@ -1467,21 +1805,10 @@ class firehose(metaclass=LogBase):
             return False
 
         def ensure_gpt_hdr_consistency(guid_gpt, backup_guid_gpt, gpt_data, backup_gpt_data):
-            headeroffset = guid_gpt.sectorsize
-            prim_corrupted, backup_corrupted = False, False
-
-            prim_hdr = gpt_data[headeroffset: headeroffset + guid_gpt.header.header_size]
-            test_hdr = guid_gpt.fix_gpt_crc(gpt_data)[headeroffset: headeroffset + guid_gpt.header.header_size]
-            prim_hdr_crc, test_hdr_crc = prim_hdr[0x10: 0x10 + 4], test_hdr[0x10: 0x10 + 4]
-            prim_part_table_crc, test_part_table_crc = prim_hdr[0x58: 0x58 + 4], test_hdr[0x58: 0x58 + 4]
-            prim_corrupted = prim_hdr_crc != test_hdr_crc or prim_part_table_crc != test_part_table_crc
-
-            backup_hdr = backup_gpt_data[headeroffset: headeroffset + backup_guid_gpt.header.header_size]
-            test_hdr = backup_guid_gpt.fix_gpt_crc(backup_gpt_data)[
-                       headeroffset: headeroffset + backup_guid_gpt.header.header_size]
-            backup_hdr_crc, test_hdr_crc = backup_hdr[0x10: 0x10 + 4], test_hdr[0x10: 0x10 + 4]
-            backup_part_table_crc, test_part_table_crc = backup_hdr[0x58: 0x58 + 4], test_hdr[0x58: 0x58 + 4]
-            backup_corrupted = backup_hdr_crc != test_hdr_crc or backup_part_table_crc != test_part_table_crc
+            prim_corrupted = not all(guid_gpt.check_crc(gpt_data))
+            backup_corrupted = not all(backup_guid_gpt.check_crc(backup_gpt_data))
+            prim_part_table_crc = guid_gpt.header.crc32_part_entries
+            backup_part_table_crc = backup_guid_gpt.header.crc32_part_entries
 
             prim_backup_consistent = prim_part_table_crc == backup_part_table_crc
             if prim_corrupted or not prim_backup_consistent:
@@ -1780,6 +2107,7 @@ class firehose(metaclass=LogBase):
         return False
 
     def cmd_rawxml(self, data, response=True):
+        self.partindex = None
         if response:
             val = self.xmlsend(data)
             if val.resp:
@@ -8,26 +8,26 @@
 
 import os
 import sys
+import shutil
 import logging
 import json
 from binascii import hexlify, unhexlify
 from struct import unpack, pack
 from edlclient.Library.firehose import firehose
 from edlclient.Library.xmlparser import xmlparser
-from edlclient.Library.utils import do_tcp_server
-from edlclient.Library.utils import LogBase, getint
+from edlclient.Library.rpc_server import rpc_server
+from edlclient.Library.nbd_server import nbd_server
+from edlclient.Library.fsdump import fsdump
+from edlclient.Library.rawprogram import load as load_rawprogram, merge_plans as rawprogram_plan
+from edlclient.Library.compressed import detect_compression, find_compressed, strip_compression_ext
+from edlclient.Library.lpmetadata import lp_metadata, LP_SECTOR_SIZE
+from edlclient.Library.sparse import QCSparse
+from edlclient.Library.utils import LogBase, binary_stdout, getint
 from edlclient.Library.gpt import AB_FLAG_OFFSET, AB_PARTITION_ATTR_SLOT_ACTIVE
 from edlclient.Config.qualcomm_config import memory_type
 from edlclient.Config.qualcomm_config import infotbl, msmids, secureboottbl, sochw
 import fnmatch
 
-try:
-    import xml.etree.cElementTree as ET
-    from xml.etree import cElementTree as ElementTree
-except ImportError:
-    import xml.etree.ElementTree as ET
-    from xml.etree import ElementTree
-
 try:
     from edlclient.Library.Modules.init import modules
 except ImportError as e:
@@ -41,6 +41,7 @@ class firehose_client(metaclass=LogBase):
         self.arguments = arguments
         self.printer = printer
         self.info = self.__logger.info
+        self.debug = self.__logger.debug
         self.error = self.__logger.error
         self.warning = self.__logger.warning
         self.__logger.setLevel(loglevel)
@@ -141,16 +142,12 @@ class firehose_client(metaclass=LogBase):
     def find_bootable_partition(self, imagedir, rawprogram):
         part = -1
         for xml in rawprogram:
-            filename = os.path.join(imagedir, xml)
-            with open(filename, "r") as fl:
-                for evt, elem in ET.iterparse(fl, events=["end"]):
-                    if elem.tag == "program":
-                        label = elem.get("label")
-                        if label in ['xbl', 'xbl_a', 'sbl1']:
-                            if part != -1:
-                                self.error("[FIREHOSE] multiple bootloader found!")
-                                return -1
-                            part = elem.get("physical_partition_number")
+            lun = load_rawprogram(os.path.join(imagedir, xml)).bootable_lun()
+            if lun is None or (lun != -1 and part != -1):
+                self.error("[FIREHOSE] multiple bootloader found!")
+                return -1
+            if lun != -1:
+                part = lun
         return part
 
     def getluns(self, argument):
@@ -191,6 +188,137 @@ class firehose_client(metaclass=LogBase):
                     return info
         return False
 
+    def report_partitions(self, options, lun, start, sectors):
+        """ Logs which partitions a raw sector range touches """
+        index = self.firehose.get_partition_index(options)
+        touched = index.overlaps(lun, start, sectors)
+        if not touched:
+            self.info(f"Sectors {str(start)}-{str(start + sectors - 1)} of lun {str(lun)} aren't part of a partition.")
+            return touched
+        names = []
+        for partition in touched:
+            partial = partition.sector < start or partition.end > start + sectors
+            names.append(partition.name + (" (partially)" if partial else ""))
+        self.info(f"Sectors {str(start)}-{str(start + sectors - 1)} of lun {str(lun)} touch: " + ", ".join(names))
+        return touched
+
+    def read_to_stdout(self, lun, start, sectors):
+        try:
+            with self.firehose.open_sectors(lun, start, sectors, "rb") as rf:
+                shutil.copyfileobj(rf, binary_stdout(), rf.chunksize)
+            binary_stdout().flush()
+        except (IOError, OSError) as err:
+            self.error(str(err))
+            return False
+        return True
+
+    def write_from_stdin(self, lun, start, sectors=None):
+        try:
+            with self.firehose.open_sectors(lun, start, sectors, "wb") as wf:
+                shutil.copyfileobj(sys.stdin.buffer, wf, wf.chunksize)
+        except (IOError, OSError) as err:
+            self.error(str(err))
+            return False
+        return True
+
+    def dump_allocated(self, lun, partition, filename):
+        try:
+            return fsdump(self.firehose, self.__logger.level).dump(lun, partition.sector, partition.sectors, filename)
+        except (IOError, OSError) as err:
+            self.error(str(err))
+            return False
+
+    def detect_logical_partition(self, options, partitionname):
+        res = self.firehose.detect_partition(options, "super")
+        if not res[0]:
+            return None
+        lun = res[1]
+        superpart = res[2]
+        slot = 1 if partitionname.endswith("_b") else 0
+        try:
+            with self.firehose.open_sectors(lun, superpart.sector, superpart.sectors, "rb") as rf:
+                lp = lp_metadata.read(rf, slot)
+        except (ValueError, IOError) as err:
+            self.debug(str(err))
+            return None
+        partition = lp.get_partition(partitionname)
+        if partition is None:
+            return None
+        return lun, superpart, lp, partition
+
+    def read_logical_partition(self, logical, filename):
+        lun, superpart, lp, partition = logical
+        chunk = self.cfg.MaxPayloadSizeToTargetInBytes
+        wf = binary_stdout() if filename == "-" else open(filename, "wb")
+        try:
+            with self.firehose.open_sectors(lun, superpart.sector, superpart.sectors, "rb") as rf:
+                for _, phys, sectors in lp.extent_map(partition):
+                    length = sectors * LP_SECTOR_SIZE
+                    if phys is not None:
+                        rf.seek(phys * LP_SECTOR_SIZE)
+                    while length > 0:
+                        size = min(chunk, length)
+                        wf.write(rf.read(size) if phys is not None else b"\x00" * size)
+                        length -= size
+        except (ValueError, IOError, OSError) as err:
+            self.error(str(err))
+            return False
+        finally:
+            if filename == "-":
+                wf.flush()
+            else:
+                wf.close()
+        return True
+
+    def write_logical_partition(self, logical, filename):
+        lun, superpart, lp, partition = logical
+        chunk = self.cfg.MaxPayloadSizeToTargetInBytes
+        sparse = QCSparse(filename, self.__logger.level)
+        if sparse.readheader():
+            size = sparse.getsize()
+            read = sparse.read
+        else:
+            sparse.rf.close()
+            sparse = None
+            size = os.stat(filename).st_size
+        try:
+            with self.firehose.open_sectors(lun, superpart.sector, superpart.sectors, "r+b") as wf, \
+                    open(filename, "rb") as rf:
+                if sparse is None:
+                    read = rf.read
+                sectors = (size + LP_SECTOR_SIZE - 1) // LP_SECTOR_SIZE
+                grown = sectors > partition.sectors
+                if grown:
+                    # Only resized in memory, the metadata is committed once the data is in place
+                    self.info(f"Growing logical partition {partition.name} to {sectors} sectors")
+                    lp.resize_partition(partition.name, sectors)
+                for _, phys, sectors in lp.extent_map(partition):
+                    if size <= 0:
+                        break
+                    length = min(size, sectors * LP_SECTOR_SIZE)
+                    size -= length
+                    if phys is None:
+                        read(length)
+                        continue
+                    wf.seek(phys * LP_SECTOR_SIZE)
+                    while length > 0:
+                        data = read(min(chunk, length))
+                        if not data:
+                            break
+                        wf.write(data)
+                        length -= len(data)
+                    if length > 0:
+                        raise IOError(f"Unexpected end of {filename}")
+                if grown:
+                    lp.write(wf)
+        except (ValueError, IOError, OSError) as err:
+            self.error(str(err))
+            return False
+        finally:
+            if sparse is not None:
+                sparse.rf.close()
+        return True
+
     def handle_firehose(self, cmd, options):
         """
         处理与Firehose协议相关的命令。
@@ -285,11 +413,21 @@ class firehose_client(metaclass=LogBase):
                 if res[0]:
                     lun = res[1]
                     rpartition = res[2]
-                    if self.firehose.cmd_read(lun, rpartition.sector, rpartition.sectors, partfilename):
+                    if partfilename == "-":
+                        if not self.read_to_stdout(lun, rpartition.sector, rpartition.sectors):
+                            return False
+                    elif options.get("--allocated") and self.dump_allocated(lun, rpartition, partfilename):
+                        self.printer(f"Dumped allocated blocks of {partition} as sparse image {partfilename}.")
+                    elif self.firehose.cmd_read(lun, rpartition.sector, rpartition.sectors, partfilename):
                         self.printer(
                             f"Dumped sector {str(rpartition.sector)} with sector count {str(rpartition.sectors)} " +
                             f"as {partfilename}.")
                 else:
+                    logical = self.detect_logical_partition(options, partition)
+                    if logical is not None:
+                        if self.read_logical_partition(logical, partfilename):
+                            self.printer(f"Dumped logical partition {partition} from super as {partfilename}.")
+                        continue
                     fpartitions = res[1]
                     self.error(f"Error: Couldn't detect partition: {partition}\nAvailable partitions:")
                     for lun in fpartitions:
@@ -353,7 +491,9 @@ class firehose_client(metaclass=LogBase):
                     self.info(
                         f"Dumping partition {str(partition.name)} with sector count {str(partition.sectors)} " +
                         f"as {filename}.")
-                    if self.firehose.cmd_read(lun, partition.sector, partition.sectors, filename):
+                    if options.get("--allocated") and self.dump_allocated(lun, partition, filename):
+                        self.info(f"Dumped allocated blocks of {str(partition.name)} as sparse image {filename}.")
+                    elif self.firehose.cmd_read(lun, partition.sector, partition.sectors, filename):
                         self.info(f"Dumped partition {str(partition.name)} with sector count " +
                                   f"{str(partition.sectors)} as {filename}.")
             return True
@@ -550,9 +690,14 @@ class firehose_client(metaclass=LogBase):
             start = int(options["<start_sector>"])
             sectors = int(options["<sectors>"])
             filename = options["<filename>"]
+            if filename == "-":
+                return self.read_to_stdout(lun, start, sectors)
             if self.firehose.cmd_read(lun, start, sectors, filename, True):
                 self.printer(f"Dumped sector {str(start)} with sector count {str(sectors)} as {filename}.")
                 return True
+            self.error(f"Error reading sector {str(start)} with sector count {str(sectors)}.")
+            self.report_partitions(options, lun, start, sectors)
+            return False
 
         elif cmd == "peek":
             if not self.check_param(["<offset>", "<length>", "<filename>"]):
@@ -749,6 +894,19 @@ class firehose_client(metaclass=LogBase):
                 startsector = 0
                 filename = filenames[i]
                 i += 1
+                if filename == "-":
+                    res = self.firehose.detect_partition(options, partitionname)
+                    if not res[0]:
+                        self.error(f"Error: Couldn't detect partition: {partitionname}")
+                        bad = True
+                        continue
+                    if self.firehose.modules is not None:
+                        self.firehose.modules.writeprepare()
+                    if self.write_from_stdin(res[1], res[2].sector, res[2].sectors):
+                        self.printer(f"Wrote stdin to partition {partitionname}.")
+                    else:
+                        bad = True
+                    continue
                 if not os.path.exists(filename):
                     self.error(f"Error: Couldn't find file: {filename}")
                     bad = True
@@ -760,9 +918,13 @@ class firehose_client(metaclass=LogBase):
                     res = self.firehose.detect_partition(options, partitionname)
                 if res[0]:
                     lun = res[1]
+                    max_sectors = None
                     sectors = os.stat(filename).st_size // self.firehose.cfg.SECTOR_SIZE_IN_BYTES
                     if (os.stat(filename).st_size % self.firehose.cfg.SECTOR_SIZE_IN_BYTES) > 0:
                         sectors += 1
+                    if detect_compression(filename) is not None:
+                        # Unpacked size is unknown, cmd_program checks against max_sectors while writing
+                        sectors = 0
                     if partitionname.lower() != "gpt":
                         partition = res[2]
                         if sectors > partition.sectors:
@@ -771,14 +933,25 @@ class firehose_client(metaclass=LogBase):
                             bad = True
                             continue
                         startsector = partition.sector
+                        max_sectors = partition.sectors
                     if self.firehose.modules is not None:
                         self.firehose.modules.writeprepare()
-                    if self.firehose.cmd_program(lun, startsector, filename):
+                    if self.firehose.cmd_program(lun, startsector, filename, max_sectors=max_sectors,
+                                                 skipfill=options.get("--skipzero", False)):
                         self.printer(f"Wrote {filename} to sector {str(startsector)}.")
                     else:
                         self.printer(f"Error writing {filename} to sector {str(startsector)}.")
                         bad = True
                 else:
+                    logical = self.detect_logical_partition(options, partitionname)
+                    if logical is not None:
+                        if self.firehose.modules is not None:
+                            self.firehose.modules.writeprepare()
+                        if self.write_logical_partition(logical, filename):
+                            self.printer(f"Wrote {filename} to logical partition {partitionname} in super.")
+                        else:
+                            bad = True
+                        continue
                     if len(res) > 0:
                         fpartitions = res[1]
                         self.error(f"Error: Couldn't detect partition: {partitionname}\nAvailable partitions:")
@@ -820,7 +993,7 @@ class firehose_client(metaclass=LogBase):
                         "Error: Can not fetch GPT table from device, you may need to use `edl w gpt` to write a partition table first.`")
                     break
                 for filename in filenames:
-                    partname = os.path.basename(filename)
+                    partname = strip_compression_ext(os.path.basename(filename))
                     if ".bin" in partname[-4:] or ".img" in partname[-4:] or ".mbn" in partname[-4:]:
                         partname = partname[:-4]
                     if partname in skip:
@@ -830,12 +1003,15 @@ class firehose_client(metaclass=LogBase):
                         sectors = os.stat(filename).st_size // self.firehose.cfg.SECTOR_SIZE_IN_BYTES
                         if (os.stat(filename).st_size % self.firehose.cfg.SECTOR_SIZE_IN_BYTES) > 0:
                             sectors += 1
+                        if detect_compression(filename) is not None:
+                            sectors = 0
                         if sectors > partition.sectors:
                             self.error(f"Error: {filename} has {sectors} sectors but partition " +
                                        f"only has {partition.sectors}.")
                             return False
                         self.printer(f"Writing {filename} to partition {str(partition.name)}.")
-                        self.firehose.cmd_program(lun, partition.sector, filename)
+                        self.firehose.cmd_program(lun, partition.sector, filename, max_sectors=partition.sectors,
+                                                  skipfill=options.get("--skipzero", False))
                     else:
                         if partname[0:3] == "gpt" or partname[-3:] == "xml":
                             self.printer(f"Can't find a partition named {partname} in the gpt, but continuing anyway.")
@@ -853,9 +1029,20 @@ class firehose_client(metaclass=LogBase):
                 lun = 0
             start = int(options["<start_sector>"])
             filename = options["<filename>"]
+            if filename == "-":
+                if self.firehose.modules is not None:
+                    self.firehose.modules.writeprepare()
+                if self.write_from_stdin(lun, start):
+                    self.printer(f"Wrote stdin to sector {str(start)}.")
+                    return True
+                return False
             if not os.path.exists(filename):
                 self.error(f"Error: Couldn't find file: {filename}")
                 return False
+            if detect_compression(filename) is None:
+                size = os.stat(filename).st_size
+                sectorsize = self.firehose.cfg.SECTOR_SIZE_IN_BYTES
+                self.report_partitions(options, lun, start, (size + sectorsize - 1) // sectorsize)
             if self.firehose.modules is not None:
                 self.firehose.modules.writeprepare()
             if self.firehose.cmd_program(lun, start, filename):
@@ -892,25 +1079,34 @@ class firehose_client(metaclass=LogBase):
             luns = self.getluns(options)
             partitionname = options["<partitionname>"]
             partitions = partitionname.split(",")
+            found = set()
             for lun in luns:
                 data, guid_gpt = self.firehose.get_gpt(lun, int(options["--gpt-num-part-entries"]),
                                                        int(options["--gpt-part-entry-size"]),
                                                        int(options["--gpt-part-entry-start-lba"]))
                 if guid_gpt is None:
                     break
+                erase = [guid_gpt.partentries[name] for name in partitions
+                         if name in guid_gpt.partentries and name not in found]
+                if not erase:
+                    continue
                 if self.firehose.modules is not None:
                     self.firehose.modules.writeprepare()
-                for partitionname in partitions:
-                    if partitionname in guid_gpt.partentries:
-                        partition = guid_gpt.partentries[partitionname]
-                        self.firehose.cmd_erase(lun, partition.sector, partition.sectors)
-                        self.printer(
-                            f"Erased {partitionname} starting at sector {str(partition.sector)} " +
-                            f"with sector count {str(partition.sectors)}.")
-                        return True
-            self.error(
-                f"Couldn't erase partition {partitionname}. Either wrong memorytype given or no gpt partition.")
-            return False
+                if not self.firehose.cmd_erase_ranges(lun, [(partition.sector, partition.sectors)
+                                                             for partition in erase]):
+                    self.error(f"Error erasing partitions on lun {str(lun)}.")
+                    return False
+                for partition in erase:
+                    found.add(partition.name)
+                    self.printer(
+                        f"Erased {partition.name} starting at sector {str(partition.sector)} " +
+                        f"with sector count {str(partition.sectors)}.")
+            missing = [name for name in partitions if name not in found]
+            if missing:
+                self.error(
+                    f"Couldn't erase partition {','.join(missing)}. Either wrong memorytype given or no gpt partition.")
+                return False
+            return True
 
         elif cmd == "ep":
             if not self.check_param(["<partitionname>", "<sectors>"]):
@@ -977,7 +1173,24 @@ class firehose_client(metaclass=LogBase):
             return True
 
         elif cmd == "server":
-            return do_tcp_server(self, options, self.handle_firehose)
+            return rpc_server(self, options, self.handle_firehose, self.__logger.level).run()
+        elif cmd == "nbd":
+            if options["--lun"] is not None:
+                lun = int(options["--lun"])
+            else:
+                lun = 0
+            cacheopts = {}
+            if options.get("--cachesize") is not None:
+                cacheopts["cachesize"] = getint(options["--cachesize"])
+            if options.get("--blocksize") is not None:
+                cacheopts["blocksize"] = getint(options["--blocksize"])
+            try:
+                server = nbd_server(self.firehose, lun, options["--socket"], self.__logger.level,
+                                    readonly=bool(options.get("--skipwrite")), **cacheopts)
+            except IOError as err:
+                self.error(str(err))
+                return False
+            return server.run()
 
         elif cmd == "modules":
             if not self.check_param(["<command>", "<options>"]):
@@ -996,35 +1209,35 @@ class firehose_client(metaclass=LogBase):
             rawprogram = options["<rawprogram>"].split(",")
             imagedir = options["<imagedir>"]
             patch = options["<patch>"].split(",")
+            xmlfiles = []
             for xml in rawprogram:
                 filename = os.path.join(imagedir, xml)
                 if os.path.exists(filename):
                     self.info("[qfil] programming %s" % xml)
-                    fl = open(filename, "r")
-                    for evt, elem in ET.iterparse(fl, events=["end"]):
-                        if elem.tag == "program":
-                            if elem.get("filename", ""):
-                                filename = os.path.join(imagedir, elem.get("filename"))
-                                if not os.path.isfile(filename):
-                                    self.error("%s doesn't exist!" % filename)
-                                    success = False
-                                    continue
-                                partition_number = int(elem.get("physical_partition_number"))
-                                num_disk_sectors = self.firehose.getlunsize(partition_number)
-                                start_sector = elem.get("start_sector")
-                                if "NUM_DISK_SECTORS" in start_sector:
-                                    start_sector = start_sector.replace("NUM_DISK_SECTORS", str(num_disk_sectors))
-                                if "-" in start_sector or "*" in start_sector or "/" in start_sector or \
-                                        "+" in start_sector:
-                                    start_sector = start_sector.replace(".", "")
-                                    start_sector = eval(start_sector)
-                                self.info(f"[qfil] programming {filename} to partition({partition_number})" +
-                                          f"@sector({start_sector})...")
-
-                                self.firehose.cmd_program(int(partition_number), int(start_sector), filename)
+                    xmlfiles.append(filename)
                 else:
                     self.warning(f"File : {filename} not found.")
                     success = False
+            lunsizes = {}
+            for program in rawprogram_plan(xmlfiles):
+                if not program.filename:
+                    continue
+                filename = find_compressed(os.path.join(imagedir, program.filename))
+                if not os.path.isfile(filename):
+                    self.error("%s doesn't exist!" % filename)
+                    success = False
+                    continue
+                partition_number = program.lun
+                start_sector = program.sector()
+                if start_sector is None:
+                    if partition_number not in lunsizes:
+                        lunsizes[partition_number] = self.firehose.getlunsize(partition_number)
+                    start_sector = program.sector(lunsizes[partition_number])
+                self.info(f"[qfil] programming {filename} to partition({partition_number})" +
+                          f"@sector({start_sector})...")
+                max_sectors = program.num_partition_sectors
+                self.firehose.cmd_program(partition_number, start_sector, filename,
+                                          max_sectors=max_sectors if max_sectors > 0 else None)
             self.info("[qfil] raw programming ok.")
 
             self.info("[qfil] patching...")
@@ -1032,22 +1245,14 @@ class firehose_client(metaclass=LogBase):
                 filename = os.path.join(imagedir, xml)
                 self.info("[qfil] patching with %s" % xml)
                 if os.path.exists(filename):
-                    fl = open(filename, "r")
-                    for evt, elem in ET.iterparse(fl, events=["end"]):
-                        if elem.tag == "patch":
-                            filename = elem.get("filename")
-                            if filename != "DISK":
-                                continue
-                            start_sector = elem.get("start_sector")
-                            size_in_bytes = elem.get("size_in_bytes")
-                            self.info(
-                                f"[qfil] patching {filename} sector({start_sector}), size={size_in_bytes}".format(
-                                    filename=filename, start_sector=start_sector, size_in_bytes=size_in_bytes))
-                            content = ElementTree.tostring(elem).decode("utf-8")
-                            CMD = "<?xml version=\"1.0\" ?><data>\n {content} </data>".format(
-                                content=content)
-                            print(CMD)
-                            self.firehose.xmlsend(CMD)
+                    for record in load_rawprogram(filename).patches:
+                        if record.filename != "DISK":
+                            continue
+                        self.info(f"[qfil] patching {record.filename} sector({record.get('start_sector')}), " +
+                                  f"size={record.get('size_in_bytes')}")
+                        CMD = f"<?xml version=\"1.0\" ?><data>\n {record.toxml()} </data>"
+                        self.debug(CMD)
+                        self.firehose.xmlsend(CMD)
                 else:
                     self.warning(f"File : {filename} not found.")
                     success = False
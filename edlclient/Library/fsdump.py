@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import logging
+import re
+from struct import unpack, unpack_from
+
+from edlclient.Library.blockdev import BlockDevice
+from edlclient.Library.sparse import sparse_writer
+from edlclient.Library.utils import LogBase, progress
+
+EXT4_SUPER_MAGIC = 0xEF53
+EXT4_FEATURE_COMPAT_SPARSE_SUPER2 = 0x200
+EXT4_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x1
+EXT4_FEATURE_INCOMPAT_META_BG = 0x10
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+EXT4_BG_BLOCK_UNINIT = 0x2
+
+F2FS_SUPER_MAGIC = 0xF2F52010
+F2FS_SUPER_OFFSET = 0x400
+F2FS_BLKSIZE = 4096
+F2FS_SIT_ENTRY_SIZE = 74
+F2FS_SIT_ENTRY_PER_BLOCK = F2FS_BLKSIZE // F2FS_SIT_ENTRY_SIZE
+F2FS_SUM_ENTRIES_SIZE = 7 * 512
+F2FS_SUM_JOURNAL_SIZE = 507
+CP_COMPACT_SUM_FLAG = 0x4
+CP_LARGE_NAT_BITMAP_FLAG = 0x400
+
+_uniform = re.compile(b"\x00+|\xff+", re.DOTALL)
+
+
+def bitmap_runs(bitmap, nbits, msb_first=False):
+    """
+    Yields (start, count) of set bits. Runs of 0x00/0xff bytes are handled in
+    bulk, only mixed bytes are looked at bit by bit.
+    """
+    runstart = None
+    pos = 0
+
+    def setbits(byte, base):
+        for i in range(8):
+            bit = (byte >> (7 - i)) & 1 if msb_first else (byte >> i) & 1
+            yield base + i, bit
+
+    def mixed(start, end):
+        for idx in range(start, end):
+            for bitpos, bit in setbits(bitmap[idx], idx * 8):
+                yield bitpos, bit
+
+    events = []
+    nbytes = (nbits + 7) // 8
+    for m in _uniform.finditer(bitmap, 0, nbytes):
+        if m.start() > pos:
+            events.append((pos, m.start(), None))
+        events.append((m.start(), m.end(), bitmap[m.start()] == 0xFF))
+        pos = m.end()
+    if pos < nbytes:
+        events.append((pos, nbytes, None))
+
+    for start, end, value in events:
+        if value is None:
+            for bitpos, bit in mixed(start, end):
+                if bitpos >= nbits:
+                    break
+                if bit and runstart is None:
+                    runstart = bitpos
+                elif not bit and runstart is not None:
+                    yield runstart, bitpos - runstart
+                    runstart = None
+        elif value:
+            if runstart is None:
+                runstart = start * 8
+        else:
+            if runstart is not None:
+                yield runstart, min(start * 8, nbits) - runstart
+                runstart = None
+    if runstart is not None and runstart < nbits:
+        yield runstart, nbits - runstart
+
+
+def merge_extents(extents):
+    merged = []
+    for start, count in sorted(extents):
+        if count <= 0:
+            continue
+        if merged and start <= merged[-1][0] + merged[-1][1]:
+            end = max(merged[-1][0] + merged[-1][1], start + count)
+            merged[-1][1] = end - merged[-1][0]
+        else:
+            merged.append([start, count])
+    return [(start, count) for start, count in merged]
+
+
+class ext4_allocation:
+    def __init__(self, bdev):
+        self.bdev = bdev
+        sb = bdev.pread(1024, 1024)
+        if len(sb) < 1024 or unpack_from("<H", sb, 0x38)[0] != EXT4_SUPER_MAGIC:
+            raise ValueError("No ext4 superblock found")
+        self.blocks_count = unpack_from("<I", sb, 0x4)[0]
+        self.first_data_block = unpack_from("<I", sb, 0x14)[0]
+        self.blocksize = 1024 << unpack_from("<I", sb, 0x18)[0]
+        self.blocks_per_group = unpack_from("<I", sb, 0x20)[0]
+        self.feature_compat = unpack_from("<I", sb, 0x5C)[0]
+        self.feature_incompat = unpack_from("<I", sb, 0x60)[0]
+        self.feature_ro_compat = unpack_from("<I", sb, 0x64)[0]
+        self.reserved_gdt_blocks = unpack_from("<H", sb, 0xCE)[0]
+        self.desc_size = 32
+        if self.feature_incompat & EXT4_FEATURE_INCOMPAT_64BIT:
+            self.desc_size = unpack_from("<H", sb, 0xFE)[0]
+            self.blocks_count |= unpack_from("<I", sb, 0x150)[0] << 32
+        self.backup_bgs = unpack_from("<2I", sb, 0x24C)
+        self.first_meta_bg = unpack_from("<I", sb, 0x104)[0]
+        self.group_count = (self.blocks_count - self.first_data_block + self.blocks_per_group - 1) // \
+                           self.blocks_per_group
+        self.gdt_blocks = (self.group_count * self.desc_size + self.blocksize - 1) // self.blocksize
+
+    def descriptor_block(self, index):
+        """ Location of group descriptor block index, with META_BG they sit in their metagroup """
+        if not self.feature_incompat & EXT4_FEATURE_INCOMPAT_META_BG or index < self.first_meta_bg:
+            return self.first_data_block + 1 + index
+        group = index * (self.blocksize // self.desc_size)
+        return self.first_data_block + group * self.blocks_per_group + (1 if self.has_super(group) else 0)
+
+    def read_descriptors(self):
+        contiguous = self.gdt_blocks
+        if self.feature_incompat & EXT4_FEATURE_INCOMPAT_META_BG:
+            contiguous = min(contiguous, self.first_meta_bg)
+        data = self.bdev.pread((self.first_data_block + 1) * self.blocksize, contiguous * self.blocksize)
+        for index in range(contiguous, self.gdt_blocks):
+            data += self.bdev.pread(self.descriptor_block(index) * self.blocksize, self.blocksize)
+        desc = []
+        for i in range(self.group_count):
+            off = i * self.desc_size
+            block_bitmap, inode_bitmap, inode_table = unpack_from("<3I", data, off)
+            flags = unpack_from("<H", data, off + 0x12)[0]
+            if self.desc_size >= 64:
+                hi = unpack_from("<3I", data, off + 0x20)
+                block_bitmap |= hi[0] << 32
+                inode_bitmap |= hi[1] << 32
+                inode_table |= hi[2] << 32
+            desc.append((block_bitmap, inode_bitmap, inode_table, flags))
+        return desc
+
+    def has_super(self, group):
+        if group == 0:
+            return True
+        if self.feature_compat & EXT4_FEATURE_COMPAT_SPARSE_SUPER2:
+            return group in self.backup_bgs
+        if not self.feature_ro_compat & EXT4_FEATURE_RO_COMPAT_SPARSE_SUPER or group == 1:
+            return True
+        for base in [3, 5, 7]:
+            value = base
+            while value < group:
+                value *= base
+            if value == group:
+                return True
+        return False
+
+    def extents(self):
+        """ Returns the allocated extents as list of (block, count) """
+        desc = self.read_descriptors()
+        sb = self.bdev.pread(1024, 1024)
+        inodes_per_group = unpack_from("<I", sb, 0x28)[0]
+        inode_size = unpack_from("<H", sb, 0x58)[0] or 128
+        inode_table_blocks = (inodes_per_group * inode_size + self.blocksize - 1) // self.blocksize
+        extents = []
+        # Block group metadata is always kept, uninitialised groups only have metadata
+        for group, (block_bitmap, inode_bitmap, inode_table, flags) in enumerate(desc):
+            extents.append((block_bitmap, 1))
+            extents.append((inode_bitmap, 1))
+            extents.append((inode_table, inode_table_blocks))
+            if self.has_super(group):
+                start = self.first_data_block + group * self.blocks_per_group
+                meta = 1
+                if not self.feature_incompat & EXT4_FEATURE_INCOMPAT_META_BG:
+                    meta += self.gdt_blocks + self.reserved_gdt_blocks
+                extents.append((start, meta))
+        extents.append((0, self.first_data_block + 1 + self.gdt_blocks + self.reserved_gdt_blocks))
+        if self.feature_incompat & EXT4_FEATURE_INCOMPAT_META_BG:
+            # Descriptor blocks of a metagroup are in its first, second and last group
+            per = self.blocksize // self.desc_size
+            for index in range(self.first_meta_bg, self.gdt_blocks):
+                for group in (index * per, index * per + 1, (index + 1) * per - 1):
+                    if group < self.group_count:
+                        extents.append((self.first_data_block + group * self.blocks_per_group +
+                                        (1 if self.has_super(group) else 0), 1))
+        for group, (block_bitmap, _, _, flags) in enumerate(desc):
+            if flags & EXT4_BG_BLOCK_UNINIT:
+                continue
+            start = self.first_data_block + group * self.blocks_per_group
+            nbits = min(self.blocks_per_group, self.blocks_count - start)
+            bitmap = self.bdev.pread(block_bitmap * self.blocksize, self.blocksize)
+            for bit, count in bitmap_runs(bitmap, nbits):
+                extents.append((start + bit, count))
+        return merge_extents([(s, c) for s, c in extents if s < self.blocks_count])
+
+
+class f2fs_allocation:
+    def __init__(self, bdev):
+        self.bdev = bdev
+        sb = bdev.pread(F2FS_SUPER_OFFSET, 0xC00)
+        if len(sb) < 0xC00 or unpack_from("<I", sb, 0)[0] != F2FS_SUPER_MAGIC:
+            raise ValueError("No f2fs superblock found")
+        self.blocksize = 1 << unpack_from("<I", sb, 16)[0]
+        self.log_blocks_per_seg = unpack_from("<I", sb, 20)[0]
+        self.blocks_per_seg = 1 << self.log_blocks_per_seg
+        self.block_count = unpack_from("<Q", sb, 36)[0]
+        self.segment_count_sit = unpack_from("<I", sb, 56)[0]
+        self.segment_count_main = unpack_from("<I", sb, 68)[0]
+        (self.segment0_blkaddr, self.cp_blkaddr, self.sit_blkaddr, self.nat_blkaddr,
+         self.ssa_blkaddr, self.main_blkaddr) = unpack_from("<6I", sb, 72)
+        self.cp_payload = unpack_from("<I", sb, 1664)[0]
+
+    def read_block(self, blkaddr, count=1):
+        return self.bdev.pread(blkaddr * self.blocksize, count * self.blocksize)
+
+    def checkpoint(self):
+        best = None
+        for pack_start in [self.cp_blkaddr, self.cp_blkaddr + self.blocks_per_seg]:
+            cp = self.read_block(pack_start)
+            version = unpack_from("<Q", cp, 0)[0]
+            total = unpack_from("<I", cp, 136)[0]
+            if total == 0 or total > self.blocks_per_seg:
+                continue
+            last = self.read_block(pack_start + total - 1)
+            if unpack_from("<Q", last, 0)[0] != version:
+                continue
+            if best is None or version > best[0]:
+                best = (version, pack_start, cp)
+        if best is None:
+            raise ValueError("No valid f2fs checkpoint found")
+        return best[1], best[2]
+
+    def sit_bitmap(self, cp):
+        """ SIT version bitmap of the checkpoint, laid out like the kernel's __bitmap_ptr() """
+        flags = unpack_from("<I", cp, 132)[0]
+        sit_bytes = unpack_from("<I", cp, 156)[0]
+        if flags & CP_LARGE_NAT_BITMAP_FLAG:
+            # crc, nat bitmap, sit bitmap
+            nat_bytes = unpack_from("<I", cp, 160)[0]
+            return cp[192 + 4 + nat_bytes:192 + 4 + nat_bytes + sit_bytes]
+        if self.cp_payload > 0:
+            return cp[self.blocksize:self.blocksize + sit_bytes]
+        # sit bitmap, nat bitmap
+        return cp[192:192 + sit_bytes]
+
+    def sit_journal(self, pack_start, cp):
+        flags = unpack_from("<I", cp, 132)[0]
+        start_sum = unpack_from("<I", cp, 140)[0]
+        if flags & CP_COMPACT_SUM_FLAG:
+            block = self.read_block(pack_start + start_sum)
+            journal = block[F2FS_SUM_JOURNAL_SIZE:2 * F2FS_SUM_JOURNAL_SIZE]
+        else:
+            # SIT journal lives in the COLD_DATA summary block
+            block = self.read_block(pack_start + start_sum + 2)
+            journal = block[F2FS_SUM_ENTRIES_SIZE:F2FS_SUM_ENTRIES_SIZE + F2FS_SUM_JOURNAL_SIZE]
+        entries = {}
+        count = unpack_from("<H", journal, 0)[0]
+        for i in range(min(count, (F2FS_SUM_JOURNAL_SIZE - 2) // (4 + F2FS_SIT_ENTRY_SIZE))):
+            off = 2 + i * (4 + F2FS_SIT_ENTRY_SIZE)
+            segno = unpack_from("<I", journal, off)[0]
+            entries[segno] = journal[off + 4:off + 4 + F2FS_SIT_ENTRY_SIZE]
+        return entries
+
+    def extents(self):
+        """ Returns the allocated extents as list of (block, count) """
+        pack_start, cp = self.checkpoint()
+        if self.cp_payload > 0 and not unpack_from("<I", cp, 132)[0] & CP_LARGE_NAT_BITMAP_FLAG:
+            cp = cp + self.read_block(pack_start + 1, self.cp_payload)
+        bitmap = self.sit_bitmap(cp)
+        journal = self.sit_journal(pack_start, cp)
+        cursegs = set(unpack_from("<3I", cp, 36) + unpack_from("<3I", cp, 84))
+        sit_blocks = (self.segment_count_sit // 2) << self.log_blocks_per_seg
+
+        extents = [(0, self.main_blkaddr)]
+        nsitblocks = (self.segment_count_main + F2FS_SIT_ENTRY_PER_BLOCK - 1) // F2FS_SIT_ENTRY_PER_BLOCK
+        for sitblk in range(nsitblocks):
+            blkaddr = self.sit_blkaddr + sitblk
+            if bitmap and (bitmap[sitblk >> 3] >> (7 - (sitblk & 7))) & 1:
+                blkaddr += sit_blocks
+            data = self.read_block(blkaddr)
+            for i in range(F2FS_SIT_ENTRY_PER_BLOCK):
+                segno = sitblk * F2FS_SIT_ENTRY_PER_BLOCK + i
+                if segno >= self.segment_count_main:
+                    break
+                segstart = self.main_blkaddr + (segno << self.log_blocks_per_seg)
+                if segno in cursegs:
+                    extents.append((segstart, self.blocks_per_seg))
+                    continue
+                entry = journal.get(segno, data[i * F2FS_SIT_ENTRY_SIZE:(i + 1) * F2FS_SIT_ENTRY_SIZE])
+                if unpack_from("<H", entry, 0)[0] & 0x3FF == 0:
+                    continue
+                for bit, count in bitmap_runs(entry[2:2 + 64], self.blocks_per_seg, msb_first=True):
+                    extents.append((segstart + bit, count))
+        return merge_extents([(s, c) for s, c in extents if s < self.block_count])
+
+
+class fsdump(metaclass=LogBase):
+    """
+    Dumps only the allocated blocks of an ext4 or f2fs partition as an
+    Android sparse image, free space is stored as DONT_CARE chunks.
+    """
+
+    def __init__(self, fh, loglevel=logging.INFO):
+        self.fh = fh
+        self.__logger = self._logger
+        self.info = self.__logger.info
+        self.debug = self.__logger.debug
+        self.error = self.__logger.error
+        self.__logger.setLevel(loglevel)
+        if loglevel == logging.DEBUG:
+            logfilename = "log.txt"
+            fh_log = logging.FileHandler(logfilename)
+            self.__logger.addHandler(fh_log)
+
+    def allocation(self, bdev):
+        for fstype in [ext4_allocation, f2fs_allocation]:
+            try:
+                alloc = fstype(bdev)
+                return fstype.__name__.split("_")[0], alloc.blocksize, alloc.extents()
+            except (ValueError, IndexError) as err:
+                self.debug(str(err))
+        return None, 0, None
+
+    def dump(self, lun, start_sector, sectors, filename, display=True):
+        """
+        Returns False if no supported filesystem was found, the caller should
+        fall back to a full read then.
+        """
+        sectorsize = self.fh.cfg.SECTOR_SIZE_IN_BYTES
+        bdev = BlockDevice(self.fh, lun, start_sector, sectors, cachesize=4 * 1024 * 1024)
+        fstype, blocksize, extents = self.allocation(bdev)
+        if fstype is None or blocksize % sectorsize:
+            return False
+        total_blocks = sectors * sectorsize // blocksize
+        used = sum(count for _, count in extents)
+        self.info(f"Detected {fstype}, {used} of {total_blocks} blocks allocated")
+        maxblocks = max(1, self.fh.cfg.MaxPayloadSizeToTargetInBytes // blocksize)
+        spb = blocksize // sectorsize
+        progbar = progress(sectorsize)
+        progbar.show_progress(prefix="Read", pos=0, total=used * blocksize, display=display)
+        done = 0
+        with open(filename, "wb") as wf:
+            sw = sparse_writer(wf, blocksize)
+            pos = 0
+            for start, count in extents:
+                if start >= total_blocks:
+                    break
+                count = min(count, total_blocks - start)
+                sw.add_dont_care(start - pos)
+                blk = start
+                while blk < start + count:
+                    n = min(maxblocks, start + count - blk)
+                    rsp = self.fh.cmd_read_buffer(lun, start_sector + blk * spb, n * spb, False)
+                    if not rsp.resp:
+                        self.error(f"Error reading block {blk}: {rsp.error}")
+                        return False
+                    sw.add_raw(rsp.data)
+                    blk += n
+                    done += n
+                    progbar.show_progress(prefix="Read", pos=done * blocksize, total=used * blocksize,
+                                          display=display)
+                pos = start + count
+            sw.add_dont_care(total_blocks - pos)
+            sw.close()
+        return True
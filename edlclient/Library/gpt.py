@@ -13,9 +13,10 @@ import sys
 from binascii import crc32
 from binascii import hexlify
 from enum import Enum
-from struct import calcsize, unpack, pack
+from struct import calcsize, unpack, pack, unpack_from, iter_unpack
 
 from edlclient.Library.base import LogBase
+from edlclient.Library.rawprogram import program_record, write_rawprogram
 
 def read_object(data: object, definition: object) -> object:
     """
@@ -116,6 +117,9 @@ PART_ATT_MAX_RETRY_COUNT_VAL = 0x7 << PART_ATT_MAX_RETRY_CNT_BIT
 PART_ATT_SUCCESSFUL_VAL = 0x1 << PART_ATT_SUCCESS_BIT
 PART_ATT_UNBOOTABLE_VAL = 0x1 << PART_ATT_UNBOOTABLE_BIT
 
+GPT_PARTITION_ENTRY = "<16s16sQQQ72s"
+GPT_PARTITION_ENTRY_SIZE = calcsize(GPT_PARTITION_ENTRY)
+
 
 class gpt(metaclass=LogBase):
     class gpt_header:
@@ -240,7 +244,7 @@ class gpt(metaclass=LogBase):
     def __init__(self, num_part_entries=0, part_entry_size=0, part_entry_start_lba=0, loglevel=logging.INFO, *args,
                  **kwargs):
         self.num_part_entries = num_part_entries
-        self.__logger = self.__logger
+        self.__logger = self._logger
         self.part_entry_size = part_entry_size
         self.part_entry_start_lba = part_entry_start_lba
         self.totalsectors = None
@@ -255,6 +259,14 @@ class gpt(metaclass=LogBase):
             fh = logging.FileHandler(logfilename, encoding="utf-8")
             self.__logger.addHandler(fh)
 
+    @classmethod
+    def efi_type_names(cls):
+        names = cls.__dict__.get("_efi_type_names")
+        if names is None:
+            names = {member.value: member.name for member in cls.efi_type}
+            cls._efi_type_names = names
+        return names
+
     def parseheader(self, gptdata, sectorsize=512):
         return self.gpt_header(gptdata[sectorsize:sectorsize + 0x5C])
 
@@ -286,31 +298,30 @@ class gpt(metaclass=LogBase):
             entryoffset = 0
 
         num_part_entries = self.header.num_part_entries
+        table = gptdata[start:start + num_part_entries * entrysize]
+        num_part_entries = min(num_part_entries, len(table) // entrysize) if entrysize else 0
+        if entrysize == GPT_PARTITION_ENTRY_SIZE:
+            entries = iter_unpack(GPT_PARTITION_ENTRY, table[:num_part_entries * entrysize])
+        else:
+            entries = (unpack_from(GPT_PARTITION_ENTRY, table, idx * entrysize) for idx in range(num_part_entries))
+        efi_types = self.efi_type_names()
 
-        for idx in range(0, num_part_entries):
-            data = gptdata[start + (idx * entrysize):start + (idx * entrysize) + entrysize]
-            if int(hexlify(data[16:32]), 16) == 0:
+        for idx, (ptype, unique, first_lba, last_lba, flags, name) in enumerate(entries):
+            if unique == b"\x00" * 16:
                 break
-            partentry = self.gpt_partition(data)
             pa = partf()
-            guid1 = unpack("<I", partentry.unique[0:0x4])[0]
-            guid2 = unpack("<H", partentry.unique[0x4:0x6])[0]
-            guid3 = unpack("<H", partentry.unique[0x6:0x8])[0]
-            guid4 = unpack("<H", partentry.unique[0x8:0xA])[0]
-            guid5 = hexlify(partentry.unique[0xA:0x10]).decode('utf-8')
-            pa.unique = "{:08x}-{:04x}-{:04x}-{:04x}-{}".format(guid1, guid2, guid3, guid4, guid5)
-            pa.sector = partentry.first_lba
-            pa.sectors = partentry.last_lba - partentry.first_lba + 1
-            pa.flags = partentry.flags
+            guid1, guid2, guid3, guid4 = unpack_from("<IHHH", unique)
+            pa.unique = "{:08x}-{:04x}-{:04x}-{:04x}-{}".format(guid1, guid2, guid3, guid4,
+                                                              hexlify(unique[0xA:0x10]).decode('utf-8'))
+            pa.sector = first_lba
+            pa.sectors = last_lba - first_lba + 1
+            pa.flags = flags
             pa.entryoffset = (self.header.part_entry_start_lba * sectorsize) + (idx * entrysize)
-            type = int(unpack("<I", partentry.type[0:0x4])[0])
-            try:
-                pa.type = self.efi_type(type).name
-            except:
-                pa.type = hex(type)
-            pa.name = partentry.name.replace(b"\x00\x00", b"").decode('utf-16')
+            type = unpack_from("<I", ptype)[0]
+            pa.type = efi_types.get(type, hex(type))
             if pa.type == "EFI_UNUSED":
                 continue
+            pa.name = name.decode('utf-16-le', errors='replace').split("\x00", 1)[0]
             self.partentries[pa.name] = pa
         self.totalsectors = self.header.first_usable_lba + self.header.last_usable_lba
         return True
@@ -333,56 +344,33 @@ class gpt(metaclass=LogBase):
 
     def generate_rawprogram(self, lun, sectorsize, directory):
         fname = "rawprogram" + str(lun) + ".xml"
-        with open(os.path.join(directory, fname), "wb") as wf:
-            mstr = "<?xml version=\"1.0\" ?>\n<data>\n"
-            partofsingleimage = "false"
-            readbackverify = "false"
-            sparse = "false"
-            for partname in self.partentries:
-                partition = self.partentries[partname]
-                filename = partition.name + ".bin"
-                mstr += f"\t<program SECTOR_SIZE_IN_BYTES=\"{sectorsize}\" " + \
-                        f"file_sector_offset=\"0\" " \
-                        f"filename=\"{filename}\" " + \
-                        f"label=\"{partition.name}\" " \
-                        f"num_partition_sectors=\"{partition.sectors}\" " + \
-                        f"partofsingleimage=\"{partofsingleimage}\" " \
-                        f"physical_partition_number=\"{str(lun)}\" " + \
-                        f"readbackverify=\"{readbackverify}\" " \
-                        f"size_in_KB=\"{(partition.sectors * sectorsize / 1024):.1f}\" " \
-                        f"sparse=\"{sparse}\" " + \
-                        f"start_byte_hex=\"{hex(partition.sector * sectorsize)}\" " \
-                        f"start_sector=\"{partition.sector}\"/>\n"
-            partofsingleimage = "true"
-            sectors = self.header.first_usable_lba
-            mstr += f"\t<program SECTOR_SIZE_IN_BYTES=\"{sectorsize}\" " + \
-                    f"file_sector_offset=\"0\" " + \
-                    f"filename=\"gpt_main{str(lun)}.bin\" " + \
-                    f"label=\"PrimaryGPT\" " + \
-                    f"num_partition_sectors=\"{sectors}\" " + \
-                    f"partofsingleimage=\"{partofsingleimage}\" " + \
-                    f"physical_partition_number=\"{str(lun)}\" " + \
-                    f"readbackverify=\"{readbackverify}\" " + \
-                    f"size_in_KB=\"{(sectors * sectorsize / 1024):.1f}\" " + \
-                    f"sparse=\"{sparse}\" " + \
-                    f"start_byte_hex=\"0x0\" " + \
-                    f"start_sector=\"0\"/>\n"
-            sectors = self.header.first_usable_lba - 1
-            mstr += f"\t<program SECTOR_SIZE_IN_BYTES=\"{sectorsize}\" " + \
-                    f"file_sector_offset=\"0\" " + \
-                    f"filename=\"gpt_backup{str(lun)}.bin\" " + \
-                    f"label=\"BackupGPT\" " + \
-                    f"num_partition_sectors=\"{sectors}\" " + \
-                    f"partofsingleimage=\"{partofsingleimage}\" " + \
-                    f"physical_partition_number=\"{str(lun)}\" " + \
-                    f"readbackverify=\"{readbackverify}\" " + \
-                    f"size_in_KB=\"{(sectors * sectorsize / 1024):.1f}\" " + \
-                    f"sparse=\"{sparse}\" " + \
-                    f"start_byte_hex=\"({sectorsize}*NUM_DISK_SECTORS)-{sectorsize * sectors}.\" " + \
-                    f"start_sector=\"NUM_DISK_SECTORS-{sectors}.\"/>\n"
-            mstr += "</data>"
-            wf.write(bytes(mstr, "utf-8"))
-            print(f"Wrote partition xml as {fname}")
+        programs = []
+        for partname in self.partentries:
+            partition = self.partentries[partname]
+            programs.append(program_record(SECTOR_SIZE_IN_BYTES=sectorsize, file_sector_offset=0,
+                                           filename=partition.name + ".bin", label=partition.name,
+                                           num_partition_sectors=partition.sectors, partofsingleimage="false",
+                                           physical_partition_number=lun, readbackverify="false",
+                                           size_in_KB=f"{(partition.sectors * sectorsize / 1024):.1f}",
+                                           sparse="false", start_byte_hex=hex(partition.sector * sectorsize),
+                                           start_sector=partition.sector))
+        sectors = self.header.first_usable_lba
+        programs.append(program_record(SECTOR_SIZE_IN_BYTES=sectorsize, file_sector_offset=0,
+                                       filename=f"gpt_main{str(lun)}.bin", label="PrimaryGPT",
+                                       num_partition_sectors=sectors, partofsingleimage="true",
+                                       physical_partition_number=lun, readbackverify="false",
+                                       size_in_KB=f"{(sectors * sectorsize / 1024):.1f}", sparse="false",
+                                       start_byte_hex="0x0", start_sector=0))
+        sectors = self.header.first_usable_lba - 1
+        programs.append(program_record(SECTOR_SIZE_IN_BYTES=sectorsize, file_sector_offset=0,
+                                       filename=f"gpt_backup{str(lun)}.bin", label="BackupGPT",
+                                       num_partition_sectors=sectors, partofsingleimage="true",
+                                       physical_partition_number=lun, readbackverify="false",
+                                       size_in_KB=f"{(sectors * sectorsize / 1024):.1f}", sparse="false",
+                                       start_byte_hex=f"({sectorsize}*NUM_DISK_SECTORS)-{sectorsize * sectors}.",
+                                       start_sector=f"NUM_DISK_SECTORS-{sectors}."))
+        write_rawprogram(os.path.join(directory, fname), programs)
+        print(f"Wrote partition xml as {fname}")
 
     def print_gptfile(self, filename):
         try:
@@ -417,6 +405,59 @@ class gpt(metaclass=LogBase):
         data[headeroffset:headeroffset + self.header.header_size] = headerdata
         return data
 
+    def entry_array(self, gptdata):
+        start = 2 * self.sectorsize
+        return bytes(gptdata[start:start + self.header.num_part_entries * self.header.part_entry_size])
+
+    def check_crc(self, gptdata):
+        """ Returns (header crc valid, partition entry array crc valid) for the parsed gpt data """
+        headeroffset = self.sectorsize
+        headerdata = bytearray(gptdata[headeroffset:headeroffset + self.header.header_size])
+        headerdata[0x10:0x10 + 4] = b"\x00" * 4
+        header_ok = crc32(headerdata) == self.header.crc32
+        entries_ok = crc32(self.entry_array(gptdata)) == self.header.crc32_part_entries
+        return header_ok, entries_ok
+
+    def diff_entries(self, gptdata, other, otherdata):
+        """
+        Compares the partition entry arrays of two gpt copies (for example primary and backup),
+        returns the indices of the differing entries or None if the layouts don't match.
+        """
+        size = self.header.part_entry_size
+        if size != other.header.part_entry_size or self.header.num_part_entries != other.header.num_part_entries:
+            return None
+        entries = self.entry_array(gptdata)
+        otherentries = other.entry_array(otherdata)
+        if entries == otherentries:
+            return []
+        return [idx for idx in range(len(entries) // size)
+                if entries[idx * size:(idx + 1) * size] != otherentries[idx * size:(idx + 1) * size]]
+
+    def patch_list(self, gptdata, other, otherdata):
+        """
+        Returns [(disk byte offset, data)] patches which make the other gpt copy match the entries
+        of this one: the differing entries plus the other header with fixed crcs.
+        """
+        indices = self.diff_entries(gptdata, other, otherdata)
+        if indices is None:
+            raise ValueError("GPT copies have a different partition entry layout")
+        if not indices:
+            return []
+        size = self.header.part_entry_size
+        entries = self.entry_array(gptdata)
+        patches = []
+        for idx in indices:
+            patches.append((other.header.part_entry_start_lba * other.sectorsize + idx * size,
+                            entries[idx * size:(idx + 1) * size]))
+        fixed = bytearray(otherdata)
+        start = 2 * other.sectorsize
+        fixed[start:start + len(entries)] = entries
+        fixed = other.fix_gpt_crc(fixed)
+        headeroffset = other.sectorsize
+        patches.append((other.header.current_lba * other.sectorsize,
+                        bytes(fixed[headeroffset:headeroffset + other.header.header_size])))
+        return patches
+
     def get_flag(self, filename, imagename):
         if "." in imagename:
             imagename = imagename[:imagename.find(".")]
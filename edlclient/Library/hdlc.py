@@ -7,44 +7,12 @@
 # GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
 
 import logging
-import time
+from collections import deque
 from struct import unpack
 
-MAX_PACKET_LEN = 4096
+from edlclient.Library.crc import crc16
 
-crcTbl = (
-    0x0000, 0x1189, 0x2312, 0x329b, 0x4624, 0x57ad, 0x6536, 0x74bf,
-    0x8c48, 0x9dc1, 0xaf5a, 0xbed3, 0xca6c, 0xdbe5, 0xe97e, 0xf8f7,
-    0x1081, 0x0108, 0x3393, 0x221a, 0x56a5, 0x472c, 0x75b7, 0x643e,
-    0x9cc9, 0x8d40, 0xbfdb, 0xae52, 0xdaed, 0xcb64, 0xf9ff, 0xe876,
-    0x2102, 0x308b, 0x0210, 0x1399, 0x6726, 0x76af, 0x4434, 0x55bd,
-    0xad4a, 0xbcc3, 0x8e58, 0x9fd1, 0xeb6e, 0xfae7, 0xc87c, 0xd9f5,
-    0x3183, 0x200a, 0x1291, 0x0318, 0x77a7, 0x662e, 0x54b5, 0x453c,
-    0xbdcb, 0xac42, 0x9ed9, 0x8f50, 0xfbef, 0xea66, 0xd8fd, 0xc974,
-    0x4204, 0x538d, 0x6116, 0x709f, 0x0420, 0x15a9, 0x2732, 0x36bb,
-    0xce4c, 0xdfc5, 0xed5e, 0xfcd7, 0x8868, 0x99e1, 0xab7a, 0xbaf3,
-    0x5285, 0x430c, 0x7197, 0x601e, 0x14a1, 0x0528, 0x37b3, 0x263a,
-    0xdecd, 0xcf44, 0xfddf, 0xec56, 0x98e9, 0x8960, 0xbbfb, 0xaa72,
-    0x6306, 0x728f, 0x4014, 0x519d, 0x2522, 0x34ab, 0x0630, 0x17b9,
-    0xef4e, 0xfec7, 0xcc5c, 0xddd5, 0xa96a, 0xb8e3, 0x8a78, 0x9bf1,
-    0x7387, 0x620e, 0x5095, 0x411c, 0x35a3, 0x242a, 0x16b1, 0x0738,
-    0xffcf, 0xee46, 0xdcdd, 0xcd54, 0xb9eb, 0xa862, 0x9af9, 0x8b70,
-    0x8408, 0x9581, 0xa71a, 0xb693, 0xc22c, 0xd3a5, 0xe13e, 0xf0b7,
-    0x0840, 0x19c9, 0x2b52, 0x3adb, 0x4e64, 0x5fed, 0x6d76, 0x7cff,
-    0x9489, 0x8500, 0xb79b, 0xa612, 0xd2ad, 0xc324, 0xf1bf, 0xe036,
-    0x18c1, 0x0948, 0x3bd3, 0x2a5a, 0x5ee5, 0x4f6c, 0x7df7, 0x6c7e,
-    0xa50a, 0xb483, 0x8618, 0x9791, 0xe32e, 0xf2a7, 0xc03c, 0xd1b5,
-    0x2942, 0x38cb, 0x0a50, 0x1bd9, 0x6f66, 0x7eef, 0x4c74, 0x5dfd,
-    0xb58b, 0xa402, 0x9699, 0x8710, 0xf3af, 0xe226, 0xd0bd, 0xc134,
-    0x39c3, 0x284a, 0x1ad1, 0x0b58, 0x7fe7, 0x6e6e, 0x5cf5, 0x4d7c,
-    0xc60c, 0xd785, 0xe51e, 0xf497, 0x8028, 0x91a1, 0xa33a, 0xb2b3,
-    0x4a44, 0x5bcd, 0x6956, 0x78df, 0x0c60, 0x1de9, 0x2f72, 0x3efb,
-    0xd68d, 0xc704, 0xf59f, 0xe416, 0x90a9, 0x8120, 0xb3bb, 0xa232,
-    0x5ac5, 0x4b4c, 0x79d7, 0x685e, 0x1ce1, 0x0d68, 0x3ff3, 0x2e7a,
-    0xe70e, 0xf687, 0xc41c, 0xd595, 0xa12a, 0xb0a3, 0x8238, 0x93b1,
-    0x6b46, 0x7acf, 0x4854, 0x59dd, 0x2d62, 0x3ceb, 0x0e70, 0x1ff9,
-    0xf78f, 0xe606, 0xd49d, 0xc514, 0xb1ab, 0xa022, 0x92b9, 0x8330,
-    0x7bc7, 0x6a4e, 0x58d5, 0x495c, 0x3de3, 0x2c6a, 0x1ef1, 0x0f78)
+MAX_PACKET_LEN = 4096
 
 
 def serial16le(data):
@@ -68,12 +36,6 @@ def serial32le(data):
     return out
 
 
-def crc16(iv, data):
-    for byte in data:
-        iv = ((iv >> 8) & 0xFFFF) ^ crcTbl[(iv ^ byte) & 0xFF]
-    return ~iv & 0xFFFF
-
-
 def serial32(data):
     out = bytearray()
     out += serial16((data >> 16) & 0xFFFF)
@@ -82,43 +44,75 @@ def serial32(data):
 
 
 def escape(indata):
-    outdata = bytearray()
-    for i in range(0, len(indata)):
-        buf = indata[i]
-        if buf == 0x7e:
-            outdata.append(0x7d)
-            outdata.append(0x5e)
-        elif buf == 0x7d:
-            outdata.append(0x7d)
-            outdata.append(0x5d)
-        else:
-            outdata.append(buf)
-    return outdata
+    # 0x7D has to be escaped first, otherwise the escapes of 0x7E would be escaped again
+    return bytearray(bytes(indata).replace(b"\x7d", b"\x7d\x5d").replace(b"\x7e", b"\x7d\x5e"))
 
 
 def unescape(indata):
-    mescape = False
-    out = bytearray()
-    for buf in indata:
-        if mescape:
-            if buf == 0x5e:
-                out.append(0x7e)
-            elif buf == 0x5d:
-                out.append(0x7d)
-            else:
-                logging.error("Fatal error unescaping buffer!")
-                return None
-            mescape = False
+    indata = bytes(indata)
+    if b"\x7d" not in indata:
+        if len(indata) == 0:
+            return None
+        return bytearray(indata)
+    parts = indata.split(b"\x7d")
+    out = bytearray(parts[0])
+    last = len(parts) - 1
+    for idx, part in enumerate(parts[1:], 1):
+        if not part:
+            if idx == last:
+                # Trailing escape byte without a following byte, ignored
+                continue
+            # Escape byte followed by another escape byte
+            logging.error("Fatal error unescaping buffer!")
+            return None
+        if part[0] == 0x5e:
+            out.append(0x7e)
+        elif part[0] == 0x5d:
+            out.append(0x7d)
         else:
-            if buf == 0x7d:
-                mescape = True
-            else:
-                out.append(buf)
+            logging.error("Fatal error unescaping buffer!")
+            return None
+        out.extend(part[1:])
     if len(out) == 0:
         return None
     return out
 
 
+class hdlc_deframer:
+    """
+    Splits a byte stream into 0x7E delimited frames. Partial frames are kept
+    across feed() calls, several frames in one usb read are returned at once.
+    Frames are returned unescaped, including the trailing crc.
+    """
+
+    def __init__(self):
+        self.pending = bytearray()
+
+    def reset(self):
+        self.pending = bytearray()
+
+    def feed(self, data):
+        self.pending.extend(data)
+        if 0x7e not in data:
+            return []
+        chunks = bytes(self.pending).split(b"\x7e")
+        self.pending = bytearray(chunks[-1])
+        frames = []
+        for chunk in chunks[:-1]:
+            if not chunk:
+                continue
+            frame = unescape(chunk)
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    def flush(self):
+        """ Returns the incomplete frame received so far (if any) """
+        frame = unescape(self.pending) if self.pending else None
+        self.pending = bytearray()
+        return frame
+
+
 def convert_cmdbuf(indata):
     crc16val = crc16(0xFFFF, indata)
     indata.extend(bytearray(serial16le(crc16val)))
@@ -132,76 +126,41 @@ class hdlc:
         self.cdc = cdc
         self.programmer = None
         self.timeout = 1500
+        self.deframer = hdlc_deframer()
+        self.frames = deque()
 
-    def receive_reply(self, timeout=None):
-        replybuf = bytearray()
+    def receive_frame(self, timeout=None, retries=5):
+        """ Returns the next complete frame (payload + crc), or the partial data if the frame doesn't end """
+        if self.frames:
+            return self.frames.popleft()
         if timeout is None:
             timeout = self.timeout
-        tmp = self.cdc.read(time_out=timeout)
-        if tmp == bytearray():
-            return b""
-        if tmp == b"":
-            return b""
-        retry = 0
-        while tmp[-1] != 0x7E:
-            time.sleep(0.01)
-            tmp += self.cdc.read(time_out=timeout)
-            retry += 1
-            if retry > 5:
+        for _ in range(retries + 1):
+            tmp = self.cdc.read(time_out=timeout)
+            if not tmp:
                 break
-        replybuf.extend(tmp)
-        data = unescape(replybuf)
-        # print(hexlify(data))
-        if len(data) > 3:
-            if data[0] == 0x7E:
-                data = data[1:]
-            crc16val = crc16(0xFFFF, data[:-3])
-            reccrc = int(data[-3]) + (int(data[-2]) << 8)
+            self.frames.extend(self.deframer.feed(tmp))
+            if self.frames:
+                return self.frames.popleft()
+        return self.deframer.flush()
+
+    def receive_reply(self, timeout=None):
+        data = self.receive_frame(timeout)
+        if data is None:
+            return b""
+        if len(data) > 2:
+            crc16val = crc16(0xFFFF, data[:-2])
+            reccrc = int(data[-2]) + (int(data[-1]) << 8)
             if crc16val != reccrc:
                 return -1
-        else:
-            time.sleep(0.01)
-            data = self.cdc.read(time_out=timeout)
-            if len(data) > 3:
-                crc16val = crc16(0xFFFF, data[:-3])
-                reccrc = int(data[-3]) + (int(data[-2]) << 8)
-                if crc16val != reccrc:
-                    return -1
-                return data
-        return data[:-3]
+        return data[:-2]
 
     def receive_reply_nocrc(self, timeout=None):
-        replybuf = bytearray()
-        if timeout is None:
-            timeout = self.timeout
-        tmp = self.cdc.read(time_out=timeout)
-        if tmp == bytearray():
+        data = self.receive_frame(timeout)
+        if data is None:
             return b""
-        if tmp == b"":
-            return b""
-        retry = 0
-        while tmp[-1] != 0x7E:
-            # time.sleep(0.05)
-            tmp += self.cdc.read(time_out=timeout)
-            retry += 1
-            if retry > 5:
-                break
-        replybuf.extend(tmp)
-        data = unescape(replybuf)
-        # print(hexlify(data))
-        if len(data) > 3:
-            # crc16val = self.crc16(0xFFFF, data[:-3])
-            # reccrc = int(data[-3]) + (int(data[-2]) << 8)
-            return data[:-3]
-        else:
-            time.sleep(0.5)
-            data = self.cdc.read(time_out=timeout)
-            if len(data) > 3:
-                # crc16val = self.crc16(0xFFFF, data[:-3])
-                # reccrc = int(data[-3]) + (int(data[-2]) << 8)
-                return data[:-3]
-            else:
-                return data
+        # Callers index these replies including the leading 0x7E flag (command byte at offset 1)
+        return b"\x7e" + data[:-2]
 
     def send_unframed_buf(self, outdata, prefixflag):
         # ttyflush()
@@ -213,11 +172,29 @@ class hdlc:
         return self.cdc.write(outdata[:MAX_PACKET_LEN])
         # FlushFileBuffers(ser)
 
+    def send_packet(self, outdata, prefixflag=0):
+        """ Frames and writes a command without flushing or waiting, replies are fetched via receive_frame """
+        if isinstance(outdata, str):
+            outdata = bytes(outdata, 'utf-8')
+        return self.send_unframed_buf(convert_cmdbuf(bytearray(outdata)), prefixflag)
+
+    def reset_receiver(self):
+        self.cdc.flush()
+        self.deframer.reset()
+        self.frames.clear()
+
+    def drain_receiver(self, timeout=100):
+        """ Discards replies still on their way until the link stays quiet for timeout ms """
+        self.reset_receiver()
+        while self.cdc.read(time_out=timeout):
+            pass
+        self.reset_receiver()
+
     def send_cmd_base(self, outdata, prefixflag, nocrc=False):
         if isinstance(outdata, str):
             outdata = bytes(outdata, 'utf-8')
         packet = convert_cmdbuf(bytearray(outdata))
-        self.cdc.flush()
+        self.reset_receiver()
         if self.send_unframed_buf(packet, prefixflag):
             if nocrc:
                 return self.receive_reply_nocrc()
@@ -5,10 +5,13 @@
 #
 # !!!!! If you use this code in commercial products, your product is automatically
 # GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+import hashlib
 import inspect
+import json
 import logging
 import os
 import sys
+from struct import unpack
 
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
@@ -21,6 +24,173 @@ except:
     from Config.qualcomm_config import sochw, msmids, root_cert_hash
 
 
+LOADER_EXTENSIONS = (".bin", ".mbn", ".elf")
+LOADER_INDEX_FILENAME = "loader_index.json"
+LOADER_INDEX_VERSION = 1
+MBN_MAGIC = 0x844BDCD1
+LOADER_STATS_FILENAME = "edl_loader_stats.json"
+
+msmid_index = None
+
+
+def qualcomm_indexes():
+    """ Reverse indexes over the qualcomm_config tables, built once per process """
+    global msmid_index
+    if msmid_index is None:
+        names = {}
+        for msmid, name in msmids.items():
+            names.setdefault(name, []).append("{:08x}".format(msmid))
+        msmid_index = dict(names=names,
+                           root_hashes=set(value[:16].lower() for value in root_cert_hash.values()))
+    return msmid_index
+
+
+def is_root_pkhash(pkhash):
+    """ True if pkhash is one of the qualcomm test root certificates (unfused device) """
+    return pkhash is not None and pkhash[:16].lower() in qualcomm_indexes()["root_hashes"]
+
+
+def der_length(data, offset):
+    """ Returns the full length of the DER element at offset, 0 if there is none """
+    if offset + 2 > len(data) or data[offset] != 0x30:
+        return 0
+    length = data[offset + 1]
+    if length & 0x80:
+        count = length & 0x7F
+        length = int.from_bytes(data[offset + 2:offset + 2 + count], "big")
+        return length + 2 + count
+    return length + 2
+
+
+def parse_cert_chain(data, offset, version):
+    """
+    Parses the attestation, attestation ca and root certificate at offset. Returns the hash of
+    the root certificate (the pk hash fused into the device) and the OU fields of the chain.
+    """
+    certs = []
+    while len(certs) < 3:
+        length = der_length(data, offset)
+        if length == 0 or offset + length > len(data):
+            break
+        certs.append(bytes(data[offset:offset + length]))
+        offset += length
+    if not certs:
+        return None
+    ou = {}
+    for cert in certs[:-1]:
+        idx = cert.find(b"\x55\x04\x0B")
+        while idx != -1:
+            length = cert[idx + 4]
+            try:
+                text = cert[idx + 5:idx + 5 + length].decode().split(" ")
+                if len(text) >= 3:
+                    ou[text[2]] = text[1]
+            except UnicodeDecodeError:
+                pass
+            idx = cert.find(b"\x55\x04\x0B", idx + 1)
+    root = certs[-1]
+    if "SHA256" in ou or ("SHA384" not in ou and version < 6):
+        pkhash = hashlib.sha256(root).hexdigest()
+    else:
+        pkhash = hashlib.sha384(root).hexdigest()
+    return dict(pkhash=pkhash, ou=ou, certs=len(certs))
+
+
+def parse_hash_segment(segment):
+    """ Reads the signing metadata (hw/oem/model id) and certificate chain of a mbn hash segment """
+    version, hdr1, hdr2, hdr3, code_size, hdr4, signature_size = unpack("<IIIIIII", segment[4:0x20])
+    info = dict(hash_version=version, hwid=None, oem_id=None, model_id=None, sw_id=None)
+    if version < 6:
+        sigoffset = 0x28 + code_size + signature_size
+    else:
+        md_size = unpack("<I", segment[0x2C:0x30])[0]
+        sw_id, hw_id, oem_id, model_id = unpack("<IIII", segment[0x38:0x48])
+        info.update(hwid="{:08x}{:04x}{:04x}".format(hw_id, oem_id, model_id), oem_id="{:04x}".format(oem_id),
+                    model_id="{:04x}".format(model_id), sw_id="{:08x}".format(sw_id))
+        if version == 6:
+            sigoffset = 0x30 + md_size + code_size + signature_size
+        else:
+            sigoffset = 0x28 + hdr1 + hdr2 + hdr3 + md_size + code_size + hdr4
+    chain = parse_cert_chain(segment, sigoffset, version)
+    if chain is None:
+        return None
+    ou = chain.pop("ou")
+    info.update(chain)
+    if "HW_ID" in ou:
+        info["hwid"] = ou["HW_ID"].lower()
+    if "OEM_ID" in ou:
+        info["oem_id"] = ou["OEM_ID"][-4:].lower()
+    if "MODEL_ID" in ou:
+        info["model_id"] = ou["MODEL_ID"][-4:].lower()
+    if "SW_ID" in ou:
+        info["sw_id"] = ou["SW_ID"].lower()
+    return info
+
+
+def parse_loader(filename):
+    """
+    Extracts hwid, pk hash, oem/model id and the hash segment location from the elf/mbn headers
+    and the certificate chain of a loader. Only the headers and the hash segment are read.
+    Returns None for unsigned or unknown files.
+    """
+    with open(filename, "rb") as rf:
+        header = rf.read(0x40)
+        if len(header) < 0x34:
+            return None
+        if header[:4] == b"\x7fELF":
+            if header[4] == 2:
+                phoff = unpack("<Q", header[0x20:0x28])[0]
+                phentsize, phnum = unpack("<HH", header[0x36:0x3A])
+            else:
+                phoff = unpack("<I", header[0x1C:0x20])[0]
+                phentsize, phnum = unpack("<HH", header[0x2A:0x2E])
+            rf.seek(phoff)
+            phdrs = rf.read(phentsize * phnum)
+            for idx in range(phnum):
+                entry = phdrs[idx * phentsize:(idx + 1) * phentsize]
+                if header[4] == 2:
+                    p_type, p_flags, offset, _, _, filesz = unpack("<IIQQQQ", entry[:0x28])
+                else:
+                    p_type, offset, _, _, filesz, _, p_flags = unpack("<IIIIIII", entry[:0x1C])
+                if p_type == 0 and p_flags & 0x7000000 == 0x2000000:
+                    rf.seek(offset)
+                    info = parse_hash_segment(rf.read(filesz))
+                    if info is not None:
+                        info["hash_segment"] = [offset, filesz]
+                    return info
+            return None
+        if unpack("<I", header[:4])[0] == MBN_MAGIC:
+            imagesrc, _, _, codesz, _, sigsz = unpack("<IIIIII", header[0x14:0x2C])
+            if sigsz == 0:
+                return None
+            rf.seek(0)
+            chain = parse_cert_chain(rf.read(), imagesrc + codesz + sigsz, 5)
+            if chain is None:
+                return None
+            ou = chain.pop("ou")
+            chain.update(hash_version=5, hwid=ou.get("HW_ID", "").lower() or None,
+                         oem_id=ou.get("OEM_ID", "")[-4:].lower() or None,
+                         model_id=ou.get("MODEL_ID", "")[-4:].lower() or None, sw_id=ou.get("SW_ID", "").lower() or None,
+                         hash_segment=[0, imagesrc + codesz + sigsz])
+            return chain
+    return None
+
+
+def filename_ids(filename):
+    """ hwid and pk hash from the Loaders naming scheme [hwid]_[pkhash]_[FHPRG/ENPRG].bin """
+    parts = filename.split("_")
+    if len(parts) < 2:
+        return None
+    hwid = parts[0].lower()
+    try:
+        int(hwid[:8], 16)
+    except ValueError:
+        return None
+    if hwid[8:] == "":
+        return None
+    return hwid, parts[1].lower()
+
+
 class loader_utils(metaclass=LogBase):
     def __init__(self, loglevel=logging.INFO):
         self.__logger = self._logger
@@ -35,41 +205,104 @@ class loader_utils(metaclass=LogBase):
             fh = logging.FileHandler(logfilename)
             self.__logger.addHandler(fh)
         self.loaderdb = {}
+        self.loaders = {}
+        self.loader_ids = []
+        self.loaderdir = os.path.join(parent_dir, "..", "Loaders")
+
+    def index_entry(self, fn, filename, st):
+        entry = dict(mtime=st.st_mtime_ns, size=st.st_size, hwid=None, pkhash=None, oem_id=None, model_id=None,
+                     sw_id=None, hash_version=None, hash_segment=None, certs=0, ids=[])
+        try:
+            info = parse_loader(fn)
+        except Exception as e:  # pylint: disable=broad-except
+            self.debug(f"Filename:{filename} => {str(e)}")
+            info = None
+        if info is not None:
+            entry.update(info)
+        ids = []
+        if entry["hwid"] and entry["pkhash"]:
+            ids.append([entry["hwid"], entry["pkhash"][:16]])
+        named = filename_ids(filename)
+        if named is not None and list(named) not in ids:
+            ids.append(list(named))
+        entry["ids"] = ids
+        return entry
+
+    def scan_dir(self, path, old):
+        """ Rescans a directory, files with unchanged mtime and size keep their old entry """
+        dirs = []
+        files = {}
+        for item in os.scandir(path):
+            if item.is_dir():
+                dirs.append(item.name)
+            elif item.name.lower().endswith(LOADER_EXTENSIONS):
+                st = item.stat()
+                entry = old["files"].get(item.name) if old is not None else None
+                if entry is None or entry["mtime"] != st.st_mtime_ns or entry["size"] != st.st_size:
+                    entry = self.index_entry(item.path, item.name, st)
+                files[item.name] = entry
+        return dict(dirs=sorted(dirs), files=files)
+
+    def update_index(self, old, index, path, rel=""):
+        """
+        Walks the loader tree. Every directory is listed with scandir and its files are stat'ed,
+        a file replaced in place doesn't change the directory mtime. Only new or changed files
+        are parsed again. Returns True if anything changed.
+        """
+        entry = self.scan_dir(path, old.get(rel))
+        changed = entry != old.get(rel)
+        index[rel] = entry
+        for name in entry["dirs"]:
+            if self.update_index(old, index, os.path.join(path, name), name if rel == "" else rel + "/" + name):
+                changed = True
+        return changed
+
+    def load_index(self, filename):
+        try:
+            with open(filename, "r") as rf:
+                data = json.load(rf)
+            if data.get("version") == LOADER_INDEX_VERSION:
+                return data["dirs"]
+        except (OSError, ValueError, KeyError) as e:
+            self.debug(f"Loader index {filename} => {str(e)}")
+        return {}
+
+    def save_index(self, filename, index):
+        try:
+            with open(filename, "w") as wf:
+                json.dump(dict(version=LOADER_INDEX_VERSION, dirs=index), wf)
+        except OSError as e:
+            self.debug(f"Couldn't store loader index {filename} => {str(e)}")
 
     def init_loader_db(self):
-        for (dirpath, dirnames, filenames) in os.walk(os.path.join(parent_dir, "..", "Loaders")):
-            for filename in filenames:
+        """
+        Maps hwid -> pk hash (first 16 chars) -> loader filename. The metadata of every loader is kept
+        in Loaders/loader_index.json and only parsed again for files whose mtime or size changed.
+        """
+        self.loaderdb = {}
+        self.loaders = {}
+        self.loader_ids = []
+        if not os.path.isdir(self.loaderdir):
+            return self.loaderdb
+        indexfile = os.path.join(self.loaderdir, LOADER_INDEX_FILENAME)
+        old = self.load_index(indexfile)
+        index = {}
+        if self.update_index(old, index, self.loaderdir) or index.keys() != old.keys():
+            self.save_index(indexfile, index)
+        for rel in sorted(index):
+            dirpath = self.loaderdir if rel == "" else os.path.join(self.loaderdir, *rel.split("/"))
+            for filename in sorted(index[rel]["files"]):
+                entry = index[rel]["files"][filename]
                 fn = os.path.join(dirpath, filename)
-                found = False
-                for ext in [".bin", ".mbn", ".elf"]:
-                    if ext in filename[-4:]:
-                        found = True
-                        break
-                if not found:
-                    continue
-                try:
-                    hwid = filename.split("_")[0].lower()
-                    msmid = hwid[:8]
-                    try:
-                        int(msmid, 16)
-                    except:
-                        continue
-                    devid = hwid[8:]
-                    if devid == '':
-                        continue
-                    if len(filename.split("_")) < 2:
-                        continue
-                    pkhash = filename.split("_")[1].lower()
-                    for msmid in self.convertmsmid(msmid):
-                        mhwid = msmid + devid
-                        mhwid = mhwid.lower()
+                self.loaders[fn] = entry
+                for hwid, pkhash in entry["ids"]:
+                    for msmid in self.convertmsmid(hwid[:8]):
+                        mhwid = (msmid + hwid[8:]).lower()
+                        self.loader_ids.append((mhwid, pkhash, fn))
                         if mhwid not in self.loaderdb:
                             self.loaderdb[mhwid] = {}
                         if pkhash not in self.loaderdb[mhwid]:
                             self.loaderdb[mhwid][pkhash] = fn
-                except Exception as e:  # pylint: disable=broad-except
-                    self.debug(f"Filename:{filename} => {str(e)}")
-                    continue
         return self.loaderdb
 
     def convertmsmid(self, msmid):
@@ -78,12 +311,98 @@ class loader_utils(metaclass=LogBase):
             return [msmid]
         socid = int(msmid, 16) >> 16
         if socid in sochw:
-            names = sochw[socid].split(",")
-            for name in names:
-                for ids in msmids:
-                    if msmids[ids] == name:
-                        rmsmid = hex(ids)[2:].lower()
-                        while len(rmsmid) < 8:
-                            rmsmid = '0' + rmsmid
-                        msmiddb.append(rmsmid)
+            names = qualcomm_indexes()["names"]
+            for name in sochw[socid].split(","):
+                msmiddb.extend(names.get(name, []))
         return msmiddb
+
+    def loader_name(self, fn):
+        """ Loaders below Loaders/ are recorded relative to it, so the stats survive moving the tree """
+        path = os.path.abspath(fn)
+        root = os.path.abspath(self.loaderdir)
+        if path.startswith(root + os.sep):
+            return os.path.relpath(path, root).replace(os.sep, "/")
+        return path
+
+    def stats_file(self):
+        """ The outcome stats are kept in the Loaders directory, next to the loader index """
+        return os.path.join(self.loaderdir, LOADER_STATS_FILENAME)
+
+    def load_stats(self, filename=None):
+        if filename is None:
+            filename = self.stats_file()
+        if not os.path.exists(filename):
+            return {}
+        try:
+            with open(filename, "r") as rf:
+                return json.load(rf)
+        except (OSError, ValueError):
+            return {}
+
+    def record_outcome(self, hwid, pkhash, loader, success, elapsed=None, filename=None):
+        """
+        Records if loader got the device (hwid includes oem and model id) with pkhash into firehose
+        and how long it took, rank_loaders() prefers loaders that worked before.
+        """
+        if hwid is None or loader == "":
+            return False
+        if filename is None:
+            filename = self.stats_file()
+        stats = self.load_stats(filename)
+        key = f"{hwid}_{(pkhash or '')[:16]}"
+        entry = stats.setdefault(key, {}).setdefault(self.loader_name(loader), dict(success=0, failure=0, time=None))
+        if success:
+            entry["success"] += 1
+            if elapsed is not None:
+                entry["time"] = elapsed if entry["time"] is None else (entry["time"] + elapsed) / 2
+        else:
+            entry["failure"] += 1
+        try:
+            with open(filename, "w") as wf:
+                json.dump(stats, wf)
+        except OSError as e:
+            self.debug(f"Couldn't store loader stats {filename} => {str(e)}")
+            return False
+        return True
+
+    def rank_loaders(self, hwid, pkhash, filename=None):
+        """
+        Returns the loaders for a device, best candidate first. Loaders are grouped by how well they
+        match: same hwid and full root certificate hash, same hwid and pk hash, same msm id and pk hash,
+        any hwid with the pk hash, the same hwid with another pk hash and finally any loader of the same
+        msm id. The last two groups are only offered to unfused devices or if the pk hash is unknown
+        (sahara v3), a fused device rejects those loaders anyway. Within a group, loaders with a better
+        success record and a shorter time to firehose come first.
+        """
+        if hwid is None:
+            return []
+        pkhash = (pkhash or "").lower()
+        pkhash16 = pkhash[:16]
+        unfused = is_root_pkhash(pkhash16)
+        stats = self.load_stats(filename).get(f"{hwid}_{pkhash16}", {})
+        tiers = {}
+        for mhwid, lpkhash, fn in self.loader_ids:
+            if mhwid == hwid:
+                if pkhash16 and lpkhash == pkhash16:
+                    tier = 0 if self.loaders[fn]["pkhash"] == pkhash else 1
+                elif unfused or not pkhash16:
+                    tier = 4
+                else:
+                    continue
+            elif pkhash16 and lpkhash == pkhash16:
+                tier = 2 if mhwid[:8] == hwid[:8] else 3
+            elif (unfused or not pkhash16) and mhwid[:8] == hwid[:8]:
+                tier = 5
+            else:
+                continue
+            tiers[fn] = min(tier, tiers.get(fn, tier))
+
+        def score(fn):
+            entry = stats.get(self.loader_name(fn), {})
+            success = entry.get("success", 0)
+            failure = entry.get("failure", 0)
+            elapsed = entry.get("time")
+            return (tiers[fn], -(success + 1) / (success + failure + 2), float("inf") if elapsed is None else elapsed,
+                    fn)
+
+        return sorted(tiers, key=score)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import hashlib
+from struct import pack, unpack_from
+
+LP_SECTOR_SIZE = 512
+LP_PARTITION_RESERVED_BYTES = 4096
+LP_METADATA_GEOMETRY_SIZE = 4096
+LP_METADATA_GEOMETRY_MAGIC = 0x616c4467
+LP_METADATA_HEADER_MAGIC = 0x414C5030
+LP_METADATA_HEADER_V1_0_SIZE = 128
+
+LP_TARGET_TYPE_LINEAR = 0
+LP_TARGET_TYPE_ZERO = 1
+
+LP_PARTITION_ENTRY_SIZE = 52
+LP_EXTENT_ENTRY_SIZE = 24
+LP_GROUP_ENTRY_SIZE = 48
+LP_BLOCK_DEVICE_ENTRY_SIZE = 64
+
+
+def lp_name(data):
+    return data.split(b"\x00", 1)[0].decode("utf-8", errors="replace")
+
+
+class lp_partition:
+    __slots__ = ("name", "attributes", "group_index", "extents")
+
+    def __init__(self, name, attributes, group_index, extents):
+        self.name = name
+        self.attributes = attributes
+        self.group_index = group_index
+        self.extents = extents
+
+    @property
+    def sectors(self):
+        return sum(extent[0] for extent in self.extents)
+
+
+class lp_metadata:
+    """
+    Parser/writer for Android logical partition (dynamic partitions) metadata
+    stored at the start of the super partition. All offsets and extents are
+    in 512 byte LP sectors relative to the start of super.
+    """
+
+    def __init__(self, geometry, data, slot=0):
+        self.slot = slot
+        self.parse_geometry(geometry)
+        self.parse(data)
+
+    @classmethod
+    def read(cls, rf, slot=0):
+        """ Reads geometry and metadata of a slot from a seekable super partition stream """
+        rf.seek(LP_PARTITION_RESERVED_BYTES)
+        geometry = rf.read(LP_METADATA_GEOMETRY_SIZE)
+        metadata_max_size, metadata_slot_count = unpack_from("<II", geometry, 40)
+        if slot >= max(1, metadata_slot_count):
+            slot = 0
+        rf.seek(LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE + slot * metadata_max_size)
+        return cls(geometry, rf.read(metadata_max_size), slot)
+
+    def write(self, wf):
+        """ Writes the metadata of the current slot to primary and backup location """
+        data = self.serialize()
+        for backup in [False, True]:
+            wf.seek(self.metadata_offset(self.slot, backup))
+            wf.write(data)
+
+    def metadata_offset(self, slot, backup=False):
+        offset = LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE
+        if backup:
+            offset += self.metadata_max_size * self.metadata_slot_count
+        return offset + slot * self.metadata_max_size
+
+    def parse_geometry(self, data):
+        magic, struct_size = unpack_from("<II", data, 0)
+        if magic != LP_METADATA_GEOMETRY_MAGIC:
+            raise ValueError("Invalid LP geometry magic")
+        checksum = data[8:40]
+        raw = bytearray(data[:struct_size])
+        raw[8:40] = b"\x00" * 32
+        if hashlib.sha256(raw).digest() != checksum:
+            raise ValueError("Invalid LP geometry checksum")
+        self.metadata_max_size, self.metadata_slot_count, self.logical_block_size = unpack_from("<III", data, 40)
+
+    def parse(self, data):
+        magic, self.major, self.minor, self.header_size = unpack_from("<IHHI", data, 0)
+        if magic != LP_METADATA_HEADER_MAGIC:
+            raise ValueError("Invalid LP metadata magic")
+        header = bytearray(data[:self.header_size])
+        header_checksum = bytes(header[12:44])
+        header[12:44] = b"\x00" * 32
+        if hashlib.sha256(header).digest() != header_checksum:
+            raise ValueError("Invalid LP metadata header checksum")
+        self.tables_size = unpack_from("<I", data, 44)[0]
+        tables = data[self.header_size:self.header_size + self.tables_size]
+        if hashlib.sha256(tables).digest() != bytes(data[48:80]):
+            raise ValueError("Invalid LP metadata tables checksum")
+        self.header_tail = bytes(data[128:self.header_size])
+        descs = [unpack_from("<III", data, 80 + i * 12) for i in range(4)]
+
+        def table(idx):
+            offset, num, size = descs[idx]
+            return [tables[offset + i * size:offset + (i + 1) * size] for i in range(num)]
+
+        extents = []
+        for entry in table(1):
+            num_sectors, target_type, target_data, target_source = unpack_from("<QIQI", entry, 0)
+            extents.append((num_sectors, target_type, target_data, target_source))
+        self.partitions = []
+        for entry in table(0):
+            attributes, first, num, group_index = unpack_from("<IIII", entry, 36)
+            self.partitions.append(lp_partition(lp_name(entry[:36]), attributes, group_index,
+                                                extents[first:first + num]))
+        self.groups = []
+        for entry in table(2):
+            flags, maximum_size = unpack_from("<IQ", entry, 36)
+            self.groups.append([lp_name(entry[:36]), flags, maximum_size])
+        self.block_devices = []
+        for entry in table(3):
+            first_logical_sector, alignment, alignment_offset, size = unpack_from("<QIIQ", entry, 0)
+            flags = unpack_from("<I", entry, 60)[0]
+            self.block_devices.append([first_logical_sector, alignment, alignment_offset, size,
+                                       lp_name(entry[24:60]), flags])
+
+    def get_partition(self, name):
+        for partition in self.partitions:
+            if partition.name == name:
+                return partition
+        return None
+
+    def extent_map(self, partition):
+        """ Returns (logical sector, physical sector or None for zero extents, sectors) per extent """
+        result = []
+        pos = 0
+        for num_sectors, target_type, target_data, target_source in partition.extents:
+            if target_source != 0:
+                raise ValueError(f"{partition.name} has extents outside of super, not supported")
+            if target_type == LP_TARGET_TYPE_LINEAR:
+                result.append((pos, target_data, num_sectors))
+            else:
+                result.append((pos, None, num_sectors))
+            pos += num_sectors
+        return result
+
+    def free_regions(self):
+        first, alignment, alignment_offset, size = self.block_devices[0][:4]
+        used = sorted((extent[2], extent[2] + extent[0]) for partition in self.partitions
+                      for extent in partition.extents
+                      if extent[1] == LP_TARGET_TYPE_LINEAR and extent[3] == 0)
+        align = max(1, alignment // LP_SECTOR_SIZE)
+        regions = []
+        pos = first
+        end = size // LP_SECTOR_SIZE
+        for start, stop in used + [(end, end)]:
+            pos = (pos + align - 1) // align * align
+            if start > pos:
+                regions.append((pos, start - pos))
+            pos = max(pos, stop)
+        return regions
+
+    def resize_partition(self, name, sectors):
+        """ Grows a partition by allocating new linear extents from free space """
+        partition = self.get_partition(name)
+        if partition is None:
+            raise ValueError(f"Unknown logical partition {name}")
+        lbs = max(1, self.logical_block_size // LP_SECTOR_SIZE)
+        sectors = (sectors + lbs - 1) // lbs * lbs
+        need = sectors - partition.sectors
+        if need <= 0:
+            return False
+        group = self.groups[partition.group_index]
+        if group[2]:
+            groupsize = sum(p.sectors for p in self.partitions if p.group_index == partition.group_index)
+            if (groupsize + need) * LP_SECTOR_SIZE > group[2]:
+                raise ValueError(f"Group {group[0]} has not enough space for {name}")
+        extents = list(partition.extents)
+        for start, count in self.free_regions():
+            if need <= 0:
+                break
+            take = min(count, need)
+            if extents and extents[-1][1] == LP_TARGET_TYPE_LINEAR and extents[-1][3] == 0 and \
+                    extents[-1][2] + extents[-1][0] == start:
+                extents[-1] = (extents[-1][0] + take, LP_TARGET_TYPE_LINEAR, extents[-1][2], 0)
+            else:
+                extents.append((take, LP_TARGET_TYPE_LINEAR, start, 0))
+            need -= take
+        if need > 0:
+            raise ValueError(f"Not enough free space in super for {name}")
+        partition.extents = extents
+        return True
+
+    def serialize(self):
+        partitions = b""
+        extents = b""
+        index = 0
+        for partition in self.partitions:
+            partitions += pack("<36sIIII", partition.name.encode("utf-8"), partition.attributes, index,
+                               len(partition.extents), partition.group_index)
+            for extent in partition.extents:
+                extents += pack("<QIQI", *extent)
+            index += len(partition.extents)
+        groups = b"".join(pack("<36sIQ", name.encode("utf-8"), flags, maximum_size)
+                          for name, flags, maximum_size in self.groups)
+        devices = b"".join(pack("<QIIQ36sI", first, alignment, alignment_offset, size, name.encode("utf-8"),
+                                flags)
+                           for first, alignment, alignment_offset, size, name, flags in self.block_devices)
+        tables = partitions + extents + groups + devices
+        descs = pack("<12I",
+                     0, len(self.partitions), LP_PARTITION_ENTRY_SIZE,
+                     len(partitions), len(extents) // LP_EXTENT_ENTRY_SIZE, LP_EXTENT_ENTRY_SIZE,
+                     len(partitions) + len(extents), len(self.groups), LP_GROUP_ENTRY_SIZE,
+                     len(partitions) + len(extents) + len(groups), len(self.block_devices),
+                     LP_BLOCK_DEVICE_ENTRY_SIZE)
+        header = bytearray(pack("<IHHI32sI32s", LP_METADATA_HEADER_MAGIC, self.major, self.minor,
+                                self.header_size, b"\x00" * 32, len(tables), hashlib.sha256(tables).digest()))
+        header += descs + self.header_tail
+        header[12:44] = hashlib.sha256(header).digest()
+        data = bytes(header) + tables
+        if len(data) > self.metadata_max_size:
+            raise ValueError("LP metadata exceeds metadata_max_size")
+        return data
+
+    def print(self, printer=print):
+        printer(f"LP metadata v{self.major}.{self.minor}, slots: {self.metadata_slot_count}")
+        for partition in self.partitions:
+            group = self.groups[partition.group_index][0]
+            printer(f"{partition.name:<24} group: {group:<16} size: {hex(partition.sectors * LP_SECTOR_SIZE)} " +
+                    f"extents: {len(partition.extents)}")
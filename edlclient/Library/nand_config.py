@@ -6,7 +6,9 @@
 # !!!!! If you use this code in commercial products, your product is automatically
 # GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
 import ctypes
+from contextlib import contextmanager
 from enum import Enum
+from struct import pack, unpack
 from edlclient.Config.qualcomm_config import secgen, secureboottbl
 
 c_uint8 = ctypes.c_uint8
@@ -742,41 +744,140 @@ class NandDevice:
         return cfg0, cfg1, ecc_buf_cfg, ecc_bch_cfg
 
 
+# Registers changed by the controller itself: never cached, never suppressed, reading or writing them
+# commits pending batched writes first
+VOLATILE_REGISTERS = ("NAND_EXEC_CMD", "NAND_FLASH_STATUS", "NAND_BUFFER_STATUS", "NAND_READ_ID", "NAND_READ_STATUS",
+                      "NAND_FLASH_BUFFER")
+NANDREGS_INTERNAL = ("register_mapping", "reverse_mapping", "parent", "shadow", "volatile", "pending", "batching")
+# A single memwrite carries up to 1000 bytes
+MAX_BATCH_WORDS = 250
+# Gaps of up to this many words with known values are filled to merge two batched writes
+MAX_FILL_WORDS = 3
+
+
 class nandregs:
+    """
+    Shadowed access to the NAND controller registers. Values of configuration registers are
+    cached after the first read or write and rewriting an unchanged value is suppressed.
+    Inside batch() writes are queued and committed as few multi-word memwrites as possible.
+    """
+
     def __init__(self, parent):
         self.register_mapping = {
         }
         self.reverse_mapping = {}
-        self.create_reverse_mapping()
         self.parent = parent
+        self.shadow = {}
+        self.volatile = set()
+        self.pending = []
+        self.batching = 0
+        self.create_reverse_mapping()
 
     def __getattribute__(self, name):
-        if name in ("register_mapping", "parent"):
+        if name in NANDREGS_INTERNAL:
             return super(nandregs, self).__getattribute__(name)
 
         if name in self.register_mapping:
-            return self.parent.mempeek(self.register_mapping[name])
+            return self.read(self.register_mapping[name])
 
         return super(nandregs, self).__getattribute__(name)
 
     def __setattr__(self, name, value):
-        if name in ("register_mapping", "parent"):
+        if name in NANDREGS_INTERNAL:
             super(nandregs, self).__setattr__(name, value)
+            if name == "register_mapping" and "parent" in self.__dict__:
+                self.create_reverse_mapping()
+                self.invalidate()
+            return
 
         if name in self.register_mapping:
-            self.parent.mempoke(self.register_mapping[name], value)
+            self.write(self.register_mapping[name], value)
         else:
             super(nandregs, self).__setattr__(name, value)
 
-    def read(self, register):
+    def address(self, register):
         if isinstance(register, str):
-            register = self.register_mapping.get(register.lower(), None)
-        return self.parent.mempeek(register)
+            return self.register_mapping.get(register, self.register_mapping.get(register.upper(), None))
+        return register
+
+    def read(self, register):
+        register = self.address(register)
+        if register in self.shadow:
+            return self.shadow[register]
+        self.flush()
+        value = self.parent.mempeek(register)
+        if value != -1 and register in self.reverse_mapping and register not in self.volatile:
+            self.shadow[register] = value
+        return value
+
+    def read_words(self, register, count):
+        """ Reads count consecutive registers with one memread, bypassing the cache """
+        register = self.address(register)
+        self.flush()
+        data = self.parent.memread(register, count * 4)
+        if len(data) < count * 4:
+            return None
+        return unpack("<%dI" % count, data[:count * 4])
 
     def write(self, register, value):
-        if isinstance(register, str):
-            register = self.register_mapping.get(register.lower(), None)
-        return self.parent.mempoke(register, value)
+        register = self.address(register)
+        value &= 0xFFFFFFFF
+        volatile = register in self.volatile or register not in self.reverse_mapping
+        if not volatile and self.shadow.get(register) == value:
+            return True
+        if not volatile:
+            self.shadow[register] = value
+        else:
+            self.shadow.pop(register, None)
+        self.pending.append((register, value))
+        if not self.batching or volatile:
+            return self.flush()
+        return True
+
+    def sequence(self, writes):
+        """ Sends a list of (register, value) writes, e.g. a whole page read recipe, as one batch """
+        with self.batch():
+            for register, value in writes:
+                self.write(register, value)
+
+    @contextmanager
+    def batch(self):
+        self.batching += 1
+        try:
+            yield self
+        finally:
+            self.batching -= 1
+            if not self.batching:
+                self.flush()
+
+    def flush(self):
+        """ Commits queued writes in order, merging writes to ascending adjacent registers """
+        if not self.pending:
+            return True
+        pending = self.pending
+        self.pending = []
+        runs = []
+        for register, value in pending:
+            if runs:
+                start, words = runs[-1]
+                end = start + len(words) * 4
+                gap = (register - end) // 4
+                if register >= end and (register - end) % 4 == 0 and gap <= MAX_FILL_WORDS and \
+                        len(words) + gap < MAX_BATCH_WORDS and \
+                        all(end + pos * 4 in self.shadow for pos in range(gap)):
+                    words.extend(self.shadow[end + pos * 4] for pos in range(gap))
+                    words.append(value)
+                    continue
+            runs.append((register, [value]))
+        result = True
+        for start, words in runs:
+            if not self.parent.memwrite(start, pack("<%dI" % len(words), *words)):
+                result = False
+        return result
+
+    def invalidate(self):
+        self.flush()
+        self.shadow = {}
 
     def save(self):
         reg_dict = {}
@@ -794,3 +895,4 @@ class nandregs:
 
     def create_reverse_mapping(self):
         self.reverse_mapping = {v: k for k, v in self.register_mapping.items()}
+        self.volatile = {self.register_mapping[name] for name in VOLATILE_REGISTERS if name in self.register_mapping}
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+LAYOUT_RAW = 0  # Page data as read, optionally followed by the spare bytes
+LAYOUT_LINUX = 1  # Page data only, ECC corrected as the Linux MTD driver sees it
+LAYOUT_YAFFS2 = 2  # ECC corrected page data followed by a full oob area (spare bytes, padded with 0xFF)
+
+LAYOUT_NAMES = {"raw": LAYOUT_RAW, "linux": LAYOUT_LINUX, "yaffs2": LAYOUT_YAFFS2, "yaffs": LAYOUT_YAFFS2}
+
+
+def layout_mode(name):
+    """ Maps a --nandlayout value (name or number) to a layout, None means raw """
+    if name is None:
+        return LAYOUT_RAW
+    name = str(name).lower()
+    if name.isdigit() and int(name) in LAYOUT_NAMES.values():
+        return int(name)
+    if name not in LAYOUT_NAMES:
+        raise ValueError(f"Unknown nand layout {name}, use one of {', '.join(LAYOUT_NAMES)}")
+    return LAYOUT_NAMES[name]
+
+
+class nand_geometry:
+    """
+    Qualcomm controllers store a page as sectors_per_page codewords of cwsize bytes. The first
+    udsize bytes of a codeword are user bytes, the rest is ecc. Concatenated, the user bytes of
+    a page hold pagesize bytes of data followed by the spare (free oob) bytes.
+    """
+    __slots__ = ("pagesize", "sectors_per_page", "cwsize", "udsize", "oobsize", "pages_per_block")
+
+    def __init__(self, pagesize, sectors_per_page, cwsize, udsize=None, oobsize=0, pages_per_block=64):
+        self.pagesize = pagesize
+        self.sectors_per_page = sectors_per_page
+        self.cwsize = cwsize
+        self.udsize = cwsize if udsize is None else min(udsize, cwsize)
+        self.oobsize = oobsize
+        self.pages_per_block = pages_per_block
+
+    @classmethod
+    def from_settings(cls, settings, cwsize):
+        return cls(settings.PAGESIZE, settings.sectors_per_page, cwsize, settings.UD_SIZE_BYTES, settings.OOBSIZE,
+                   settings.num_pages_per_blk)
+
+    @property
+    def userpage(self):
+        return self.sectors_per_page * self.udsize
+
+    @property
+    def sparesize(self):
+        return max(self.userpage - self.pagesize, 0)
+
+
+def split_codewords(raw, cwsize, udsize):
+    """ De-interleaves a run of codewords into (user bytes, ecc bytes) """
+    view = memoryview(raw)
+    length = len(raw) - len(raw) % cwsize
+    if udsize >= cwsize:
+        return bytes(view[:length]), b""
+    user = b"".join([view[pos:pos + udsize] for pos in range(0, length, cwsize)])
+    ecc = b"".join([view[pos + udsize:pos + cwsize] for pos in range(0, length, cwsize)])
+    return user, ecc
+
+
+def split_pages(user, pagesize, userpage):
+    """ Splits concatenated per page user bytes into (data, spare) """
+    view = memoryview(user)
+    length = len(user) - len(user) % userpage
+    if userpage <= pagesize:
+        return bytes(view[:length]), b""
+    data = b"".join([view[pos:pos + pagesize] for pos in range(0, length, userpage)])
+    spare = b"".join([view[pos + pagesize:pos + userpage] for pos in range(0, length, userpage)])
+    return data, spare
+
+
+def split_block(raw, geometry):
+    """ Returns (data, spare, ecc) of the raw codewords of one or more pages """
+    user, ecc = split_codewords(raw, geometry.cwsize, geometry.udsize)
+    data, spare = split_pages(user, geometry.pagesize, geometry.userpage)
+    return data, spare, ecc
+
+
+class layout_writer:
+    """ Writes raw codeword blocks to fw in the requested output layout """
+
+    def __init__(self, fw, geometry, layout=LAYOUT_RAW, savespare=False):
+        self.fw = fw
+        self.geometry = geometry
+        self.layout = layout
+        self.savespare = savespare
+        self.written = 0
+
+    def oob(self, spare):
+        oobsize = self.geometry.oobsize or len(spare)
+        return bytes(spare[:oobsize]) + b"\xFF" * (oobsize - len(spare))
+
+    def write_pages(self, data, spare):
+        """ Writes pages already split into data and spare """
+        pagesize = self.geometry.pagesize
+        pages = len(data) // pagesize
+        sparesize = len(spare) // pages if pages else 0
+        if self.layout == LAYOUT_LINUX or (self.layout == LAYOUT_RAW and not self.savespare) or not pages:
+            self.fw.write(data)
+            self.written += len(data)
+            return
+        dview = memoryview(data)
+        sview = memoryview(spare)
+        parts = []
+        for page in range(pages):
+            parts.append(dview[page * pagesize:(page + 1) * pagesize])
+            pagespare = sview[page * sparesize:(page + 1) * sparesize]
+            parts.append(self.oob(pagespare) if self.layout == LAYOUT_YAFFS2 else pagespare)
+        buffer = b"".join(parts)
+        self.fw.write(buffer)
+        self.written += len(buffer)
+
+    def write_block(self, raw):
+        """ Writes the raw codewords of a block (or any number of whole pages) """
+        data, spare, ecc = split_block(raw, self.geometry)
+        self.write_pages(data, spare)
+
+    def write_fill(self, pages, value=0xbb):
+        """ Stands in for the pages of an unreadable block """
+        data = bytes([value]) * (pages * self.geometry.pagesize)
+        spare = b"\xFF" * (pages * self.geometry.sparesize)
+        self.write_pages(data, spare)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import errno
+import logging
+import os
+import socket
+from struct import pack, unpack, calcsize
+
+from edlclient.Library.blockdev import BlockDevice
+from edlclient.Library.utils import LogBase
+
+# Handshake (fixed newstyle)
+NBDMAGIC = 0x4e42444d41474943
+IHAVEOPT = 0x49484156454F5054
+OPT_REPLY_MAGIC = 0x3e889045565a9
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_LIST = 3
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+
+NBD_REP_ACK = 1
+NBD_REP_SERVER = 2
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_INFO_EXPORT = 0
+
+# Transmission
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_FLAG_SEND_FLUSH = 1 << 2
+NBD_FLAG_SEND_TRIM = 1 << 5
+
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_REQUEST = ">IHHQQI"
+NBD_REQUEST_SIZE = calcsize(NBD_REQUEST)
+
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_CMD_TRIM = 4
+
+
+class nbd_server(metaclass=LogBase):
+    """
+    Network block device server (fixed newstyle handshake) on a unix socket,
+    exporting one lun through a cached BlockDevice. Requests are served one
+    at a time since the device can only handle one command anyway.
+
+    Connect with: nbd-client -unix /path/to/socket /dev/nbd0
+    """
+
+    def __init__(self, fh, lun, socketpath, loglevel=logging.INFO, readonly=False, **cacheopts):
+        self.__logger = self._logger
+        self.info = self.__logger.info
+        self.debug = self.__logger.debug
+        self.error = self.__logger.error
+        self.__logger.setLevel(loglevel)
+        if loglevel == logging.DEBUG:
+            logfilename = "log.txt"
+            fh_log = logging.FileHandler(logfilename)
+            self.__logger.addHandler(fh_log)
+        self.fh = fh
+        self.lun = lun
+        self.socketpath = socketpath
+        self.readonly = readonly
+        self.trim = "erase" in fh.supported_functions
+        sectors = fh.getlunsize(lun)
+        if sectors is None or sectors <= 0:
+            raise IOError(f"Couldn't detect size of lun {lun}")
+        self.bdev = BlockDevice(fh, lun, 0, sectors, **cacheopts)
+        self.size = self.bdev.size
+        self.exportname = f"lun{lun}"
+
+    def transmission_flags(self):
+        flags = NBD_FLAG_HAS_FLAGS | NBD_FLAG_SEND_FLUSH
+        if self.readonly:
+            flags |= NBD_FLAG_READ_ONLY
+        elif self.trim:
+            flags |= NBD_FLAG_SEND_TRIM
+        return flags
+
+    @staticmethod
+    def recvexactly(conn, length):
+        data = bytearray()
+        while len(data) < length:
+            tmp = conn.recv(length - len(data))
+            if not tmp:
+                raise ConnectionError("Connection closed by client")
+            data.extend(tmp)
+        return bytes(data)
+
+    @staticmethod
+    def send_option_reply(conn, option, reply, data=b""):
+        conn.sendall(pack(">QIII", OPT_REPLY_MAGIC, option, reply, len(data)) + data)
+
+    def handshake(self, conn):
+        conn.sendall(pack(">QQH", NBDMAGIC, IHAVEOPT, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        clientflags = unpack(">I", self.recvexactly(conn, 4))[0]
+        nozeroes = bool(clientflags & NBD_FLAG_C_NO_ZEROES)
+        while True:
+            magic, option, length = unpack(">QII", self.recvexactly(conn, 16))
+            if magic != IHAVEOPT:
+                raise ConnectionError("Bad option magic")
+            data = self.recvexactly(conn, length) if length else b""
+            if option == NBD_OPT_EXPORT_NAME:
+                reply = pack(">QH", self.size, self.transmission_flags())
+                if not nozeroes:
+                    reply += b"\x00" * 124
+                conn.sendall(reply)
+                return True
+            elif option == NBD_OPT_ABORT:
+                self.send_option_reply(conn, option, NBD_REP_ACK)
+                return False
+            elif option == NBD_OPT_LIST:
+                name = self.exportname.encode("utf-8")
+                self.send_option_reply(conn, option, NBD_REP_SERVER, pack(">I", len(name)) + name)
+                self.send_option_reply(conn, option, NBD_REP_ACK)
+            elif option in [NBD_OPT_INFO, NBD_OPT_GO]:
+                info = pack(">HQH", NBD_INFO_EXPORT, self.size, self.transmission_flags())
+                self.send_option_reply(conn, option, NBD_REP_INFO, info)
+                self.send_option_reply(conn, option, NBD_REP_ACK)
+                if option == NBD_OPT_GO:
+                    return True
+            else:
+                self.send_option_reply(conn, option, NBD_REP_ERR_UNSUP)
+
+    def transmission(self, conn):
+        while True:
+            magic, flags, cmd, handle, offset, length = unpack(NBD_REQUEST,
+                                                               self.recvexactly(conn, NBD_REQUEST_SIZE))
+            if magic != NBD_REQUEST_MAGIC:
+                raise ConnectionError("Bad request magic")
+            data = b""
+            if cmd == NBD_CMD_WRITE:
+                data = self.recvexactly(conn, length)
+            elif cmd == NBD_CMD_DISC:
+                return
+            err = 0
+            rdata = b""
+            try:
+                if offset + length > self.size:
+                    err = errno.EINVAL
+                elif cmd == NBD_CMD_READ:
+                    rdata = self.bdev.pread(offset, length)
+                elif cmd == NBD_CMD_WRITE:
+                    if self.readonly:
+                        err = errno.EPERM
+                    else:
+                        self.bdev.pwrite(offset, data)
+                elif cmd == NBD_CMD_TRIM:
+                    if self.readonly:
+                        err = errno.EPERM
+                    elif self.trim:
+                        self.bdev.discard(offset, length)
+                elif cmd != NBD_CMD_FLUSH:
+                    err = errno.EINVAL
+            except (IOError, OSError) as e:
+                self.error(str(e))
+                err = errno.EIO
+            reply = pack(">IIQ", NBD_REPLY_MAGIC, err, handle)
+            if cmd == NBD_CMD_READ:
+                if err:
+                    rdata = b""
+                elif len(rdata) < length:
+                    rdata += b"\x00" * (length - len(rdata))
+            conn.sendall(reply + rdata)
+
+    def run(self):
+        if os.path.exists(self.socketpath):
+            os.unlink(self.socketpath)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socketpath)
+        sock.listen(1)
+        self.info(f"Exporting lun {self.lun} ({self.size} bytes) on {self.socketpath}")
+        try:
+            while True:
+                conn, _ = sock.accept()
+                self.info("nbd client connected")
+                try:
+                    if self.handshake(conn):
+                        self.transmission(conn)
+                except ConnectionError as err:
+                    self.debug(str(err))
+                finally:
+                    conn.close()
+                    self.info(f"nbd client disconnected, cache stats: {self.bdev.stats()}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            if os.path.exists(self.socketpath):
+                os.unlink(self.socketpath)
+        return True
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+from bisect import bisect_left, bisect_right
+
+
+class part_record:
+    __slots__ = ("lun", "name", "sector", "sectors", "type", "flags")
+
+    def __init__(self, lun, name, sector, sectors, type="", flags=0):
+        self.lun = lun
+        self.name = name
+        self.sector = sector
+        self.sectors = sectors
+        self.type = type
+        self.flags = flags
+
+    @property
+    def end(self):
+        return self.sector + self.sectors
+
+    def __repr__(self):
+        return f"part_record(lun={self.lun}, name={self.name}, sector={self.sector}, sectors={self.sectors})"
+
+
+class partition_index:
+    """
+    Sector interval index over the partitions of all luns. Records of a lun are
+    kept sorted by start sector with parallel start/end columns, so sector lookups
+    and overlap queries are a bisect instead of a scan over all partitions.
+    """
+
+    def __init__(self):
+        self.luns = {}
+        self.names = {}
+
+    def add(self, lun, name, sector, sectors, type="", flags=0):
+        record = part_record(lun, name, sector, sectors, type, flags)
+        records = self.luns.setdefault(lun, [[], [], []])
+        pos = bisect_right(records[0], sector)
+        records[0].insert(pos, sector)
+        records[1].insert(pos, sector + sectors)
+        records[2].insert(pos, record)
+        self.names.setdefault(name, []).append(record)
+        return record
+
+    def add_table(self, lun, partentries):
+        """ Adds all entries of gpt.partentries / nand_partition.partentries """
+        for name, partition in partentries.items():
+            self.add(lun, name, partition.sector, partition.sectors, getattr(partition, "type", ""),
+                     getattr(partition, "flags", 0))
+
+    def get(self, name, lun=None):
+        for record in self.names.get(name, []):
+            if lun is None or record.lun == lun:
+                return record
+        return None
+
+    def find(self, lun, sector):
+        """ Returns the partition containing sector or None """
+        records = self.luns.get(lun)
+        if records is None:
+            return None
+        pos = bisect_right(records[0], sector) - 1
+        if pos >= 0 and sector < records[1][pos]:
+            return records[2][pos]
+        return None
+
+    def overlaps(self, lun, start_sector, sectors):
+        """ Returns all partitions of a lun touching [start_sector, start_sector + sectors) """
+        records = self.luns.get(lun)
+        if records is None or sectors <= 0:
+            return []
+        end = start_sector + sectors
+        first = max(0, bisect_right(records[0], start_sector) - 1)
+        last = bisect_left(records[0], end)
+        return [record for record in records[2][first:last]
+                if record.sector < end and record.end > start_sector]
+
+    def __iter__(self):
+        for lun in sorted(self.luns):
+            yield from self.luns[lun][2]
+
+    def __len__(self):
+        return sum(len(records[2]) for records in self.luns.values())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import io
+import os
+
+
+class sector_stream(io.RawIOBase):
+    """
+    File-like view on a sector range of a lun.
+
+    Reads and writes are split into <read>/<program> commands of at most
+    chunksize bytes. Writes are buffered until a full chunk is available,
+    partial sectors at the edges are merged with the data on the device.
+    If sectors is None the stream has no known end (seek from end is refused).
+    """
+
+    def __init__(self, fh, lun, start_sector, sectors=None, mode="rb", name=None, chunksize=None):
+        super().__init__()
+        if mode.replace("b", "") not in ["r", "w", "r+", "w+"]:
+            raise ValueError(f"Invalid mode: {mode}")
+        self.fh = fh
+        self.lun = lun
+        self.start_sector = start_sector
+        self.sectors = sectors
+        self.mode = mode
+        self.name = name if name is not None else f"lun{lun}:{start_sector}"
+        self.sectorsize = fh.cfg.SECTOR_SIZE_IN_BYTES
+        if chunksize is None:
+            chunksize = fh.cfg.MaxPayloadSizeToTargetInBytes
+        self.chunksize = max(self.sectorsize, chunksize - chunksize % self.sectorsize)
+        self.size = None if sectors is None else sectors * self.sectorsize
+        self.pos = 0
+        self.wpos = 0
+        self.wbuf = bytearray()
+        self._readable = "r" in mode or "+" in mode
+        self._writable = "w" in mode or "+" in mode
+
+    def readable(self):
+        return self._readable
+
+    def writable(self):
+        return self._writable
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            if self.size is None:
+                raise io.UnsupportedOperation("Stream size is unknown")
+            pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError("Negative seek position")
+        self.pos = pos
+        return self.pos
+
+    def remaining(self):
+        if self.size is None:
+            return None
+        return max(0, self.size - self.pos)
+
+    def read_sectors(self, sector, count):
+        rsp = self.fh.cmd_read_buffer(self.lun, self.start_sector + sector, count, False)
+        if not rsp.resp:
+            raise IOError(f"Error reading lun {self.lun} sector {self.start_sector + sector}: {rsp.error}")
+        return rsp.data
+
+    def write_sectors(self, sector, data):
+        if not self.fh.cmd_program_buffer(self.lun, self.start_sector + sector, data, False):
+            raise IOError(f"Error writing lun {self.lun} sector {self.start_sector + sector}")
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        data = bytearray(size)
+        mv = memoryview(data)
+        pos = 0
+        while pos < size:
+            rlen = self.readinto(mv[pos:])
+            if not rlen:
+                break
+            pos += rlen
+        del mv
+        del data[pos:]
+        return bytes(data)
+
+    def readall(self):
+        data = bytearray()
+        while True:
+            tmp = self.read(self.chunksize)
+            if not tmp:
+                break
+            data.extend(tmp)
+        return bytes(data)
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if not self._readable:
+            raise io.UnsupportedOperation("not readable")
+        self.flush()
+        mv = memoryview(b).cast("B")
+        length = min(len(mv), self.chunksize)
+        left = self.remaining()
+        if left is not None:
+            length = min(length, left)
+        if length <= 0:
+            return 0
+        sector = self.pos // self.sectorsize
+        skip = self.pos % self.sectorsize
+        count = (skip + length + self.sectorsize - 1) // self.sectorsize
+        data = self.read_sectors(sector, count)
+        length = min(length, len(data) - skip)
+        mv[:length] = data[skip:skip + length]
+        self.pos += length
+        return length
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if not self._writable:
+            raise io.UnsupportedOperation("not writable")
+        data = memoryview(b).cast("B")
+        left = self.remaining()
+        if left is not None and len(data) > left:
+            raise IOError(f"Write of {len(data)} bytes exceeds end of {self.name}")
+        if self.wbuf and self.pos != self.wpos + len(self.wbuf):
+            self.flush()
+        if not self.wbuf:
+            self.wpos = self.pos
+        self.wbuf.extend(data)
+        self.pos += len(data)
+        if len(self.wbuf) >= self.chunksize:
+            self.flush_buffer(final=False)
+        return len(data)
+
+    def flush_buffer(self, final):
+        ss = self.sectorsize
+        head = self.wpos % ss
+        if head:
+            # merge leading partial sector with device content
+            sector = self.read_sectors(self.wpos // ss, 1)
+            self.wbuf[0:0] = sector[:head]
+            self.wpos -= head
+        end = len(self.wbuf)
+        if final:
+            tail = end % ss
+            if tail:
+                sector = self.read_sectors((self.wpos + end) // ss, 1)
+                self.wbuf.extend(sector[tail:ss])
+                end = len(self.wbuf)
+        else:
+            end -= end % ss
+        pos = 0
+        while pos < end:
+            wlen = min(self.chunksize, end - pos)
+            self.write_sectors((self.wpos + pos) // ss, self.wbuf[pos:pos + wlen])
+            pos += wlen
+        del self.wbuf[:end]
+        self.wpos += end
+
+    def flush(self):
+        if self.wbuf:
+            self.flush_buffer(final=True)
+        super().flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                super().close()
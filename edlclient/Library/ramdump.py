@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+import os
+from struct import pack
+
+
+def parse_ranges(text):
+    """ Parses "start-end,start+length,..." (hex or decimal) into a list of [start, end) tuples """
+    ranges = []
+    if not text:
+        return ranges
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "+" in item:
+            start, length = item.split("+", 1)
+            start = int(start, 0)
+            end = start + int(length, 0)
+        elif "-" in item:
+            start, end = item.split("-", 1)
+            start = int(start, 0)
+            end = int(end, 0)
+        else:
+            raise ValueError(f"Invalid memory range {item}, use start-end or start+length")
+        if end <= start:
+            raise ValueError(f"Invalid memory range {item}, end before start")
+        ranges.append((start, end))
+    return ranges
+
+
+def select_regions(regions, names=None, ranges=None):
+    """
+    Filters the memory table regions (dicts with filename, mem_base and length) by filename and
+    address ranges. Regions partially covered by a range are clipped to it, the clipped part gets
+    its address appended to the filename.
+    """
+    selected = []
+    for region in regions:
+        if names and region["filename"] not in names:
+            continue
+        if not ranges:
+            selected.append(region)
+            continue
+        base = region["mem_base"]
+        end = base + region["length"]
+        for start, stop in ranges:
+            start = max(start, base)
+            stop = min(stop, end)
+            if start >= stop:
+                continue
+            part = dict(region)
+            part["mem_base"] = start
+            part["length"] = stop - start
+            if start != base or stop != end:
+                name, ext = os.path.splitext(region["filename"])
+                part["filename"] = f"{name}_{start:x}-{stop:x}{ext}"
+            selected.append(part)
+    return selected
+
+
+EM_ARM = 40
+EM_AARCH64 = 183
+ELF_PAGE_SIZE = 0x1000
+ELF32_EHDR_SIZE = 0x34
+ELF32_PHDR_SIZE = 0x20
+ELF64_EHDR_SIZE = 0x40
+ELF64_PHDR_SIZE = 0x38
+
+
+class elf_core_writer:
+    """
+    ELF core file with one PT_LOAD per memory region, ELF32 for EM_ARM (gdb and crash reject
+    ELFCLASS64 with a 32-bit machine) and ELF64 otherwise. The headers are written up front, the
+    region data goes to file offsets congruent to the region address modulo the page size
+    (regions clipped by --memrange may start unaligned), so the dump can be mmapped directly.
+    Skipped zero chunks stay holes of a sparse file, regions marked as failed get p_filesz 0.
+    """
+
+    def __init__(self, filename, regions, machine=EM_AARCH64):
+        self.regions = regions
+        self.machine = machine
+        self.offsets = []
+        self.failed = set()
+        self.class32 = machine == EM_ARM
+        if self.class32:
+            self.ehdr_size, self.phdr_size = ELF32_EHDR_SIZE, ELF32_PHDR_SIZE
+        else:
+            self.ehdr_size, self.phdr_size = ELF64_EHDR_SIZE, ELF64_PHDR_SIZE
+        offset = self.ehdr_size + self.phdr_size * len(regions)
+        self.size = offset
+        for region in regions:
+            offset += (region["mem_base"] - offset) % ELF_PAGE_SIZE
+            self.offsets.append(offset)
+            offset += region["length"]
+            self.size = offset
+        if self.class32 and (self.size > 0xFFFFFFFF or
+                             any(region["mem_base"] + region["length"] > 0x100000000 for region in regions)):
+            raise IOError("Memory regions don't fit into an ELF32 core file")
+        self.fh = open(filename, "wb")
+        self.fh.write(self.header())
+
+    def header(self):
+        # ELFCLASS32/ELFCLASS64, little endian, EV_CURRENT
+        ident = b"\x7fELF" + bytes([1 if self.class32 else 2, 1, 1, 0]) + b"\x00" * 8
+        data = bytearray(ident)
+        ehdr = "<HHIIIIIHHHHHH" if self.class32 else "<HHIQQQIHHHHHH"
+        data += pack(ehdr, 4, self.machine, 1, 0, self.ehdr_size, 0, 0, self.ehdr_size, self.phdr_size,
+                     len(self.regions), 0, 0, 0)  # ET_CORE, no section headers
+        for idx, (region, offset) in enumerate(zip(self.regions, self.offsets)):
+            filesz = 0 if idx in self.failed else region["length"]
+            if self.class32:  # p_flags moves behind p_memsz in Elf32_Phdr
+                data += pack("<IIIIIIII", 1, offset, region["mem_base"], region["mem_base"], filesz,
+                             region["length"], 6, ELF_PAGE_SIZE)  # PT_LOAD, PF_R|PF_W
+            else:
+                data += pack("<IIQQQQQQ", 1, 6, offset, region["mem_base"], region["mem_base"], filesz,
+                             region["length"], ELF_PAGE_SIZE)  # PT_LOAD, PF_R|PF_W
+        return data
+
+    def region(self, idx):
+        """ Returns the file positioned at the data of region idx """
+        self.fh.seek(self.offsets[idx])
+        return self.fh
+
+    def mark_failed(self, idx):
+        """ The data of region idx is incomplete, it is left out of the file image (p_filesz 0) """
+        self.failed.add(idx)
+
+    def close(self):
+        try:
+            if self.failed:
+                self.fh.seek(0)
+                self.fh.write(self.header())
+            self.fh.truncate(self.size)
+        finally:
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
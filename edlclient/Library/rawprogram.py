@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import ast
+import operator
+import os
+from xml.sax.saxutils import quoteattr
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+PROGRAM_ATTRS = ["SECTOR_SIZE_IN_BYTES", "file_sector_offset", "filename", "label", "num_partition_sectors",
+                 "partofsingleimage", "physical_partition_number", "readbackverify", "size_in_KB", "sparse",
+                 "start_byte_hex", "start_sector"]
+PATCH_ATTRS = ["SECTOR_SIZE_IN_BYTES", "byte_offset", "filename", "physical_partition_number", "size_in_bytes",
+               "start_sector", "value", "what"]
+
+SECTOR_OPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.floordiv,
+              ast.FloorDiv: operator.floordiv}
+
+
+def resolve_sector(expr, num_disk_sectors=None):
+    """
+    Evaluates rawprogram/patch sector expressions like "NUM_DISK_SECTORS-5." without eval().
+    Returns None if NUM_DISK_SECTORS is needed but unknown.
+    """
+    expr = str(expr).strip()
+    if expr.isdigit():
+        return int(expr)
+    if "NUM_DISK_SECTORS" in expr:
+        if num_disk_sectors is None:
+            return None
+        expr = expr.replace("NUM_DISK_SECTORS", str(num_disk_sectors))
+    expr = expr.replace(".", "")
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, int):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in SECTOR_OPS:
+            return SECTOR_OPS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -evaluate(node.operand)
+        raise ValueError(f"Unsupported sector expression: {expr}")
+
+    return evaluate(ast.parse(expr, mode="eval"))
+
+
+class xml_record:
+    __slots__ = ("attrs", "extra")
+    tag = ""
+    order = []
+
+    def __init__(self, attrs=None, **kwargs):
+        self.attrs = {}
+        self.extra = {}
+        if attrs:
+            kwargs = dict(attrs, **kwargs)
+        for key, value in kwargs.items():
+            if key in self.order:
+                self.attrs[key] = str(value)
+            else:
+                self.extra[key] = str(value)
+
+    def get(self, key, default=None):
+        value = self.attrs.get(key)
+        if value is None:
+            value = self.extra.get(key, default)
+        return value
+
+    @property
+    def lun(self):
+        return int(self.get("physical_partition_number", "0"))
+
+    def sector(self, num_disk_sectors=None):
+        return resolve_sector(self.get("start_sector", "0"), num_disk_sectors)
+
+    def toxml(self):
+        items = [(key, self.attrs[key]) for key in self.order if key in self.attrs]
+        items += list(self.extra.items())
+        return f"<{self.tag} " + " ".join(f"{key}={quoteattr(value)}" for key, value in items) + "/>"
+
+
+class program_record(xml_record):
+    __slots__ = ()
+    tag = "program"
+    order = PROGRAM_ATTRS
+
+    @property
+    def filename(self):
+        return self.get("filename", "")
+
+    @property
+    def label(self):
+        return self.get("label", "")
+
+    @property
+    def num_partition_sectors(self):
+        try:
+            return int(self.get("num_partition_sectors", "0"))
+        except ValueError:
+            return 0
+
+
+class patch_record(xml_record):
+    __slots__ = ()
+    tag = "patch"
+    order = PATCH_ATTRS
+
+    @property
+    def filename(self):
+        return self.get("filename", "")
+
+
+class rawprogram_file:
+    """ <program> and <patch> records of a rawprogram*.xml / patch*.xml file """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.programs = []
+        self.patches = []
+        if filename is not None:
+            self.parse(filename)
+
+    def parse(self, filename):
+        for evt, elem in ET.iterparse(filename, events=["end"]):
+            if elem.tag == "program":
+                self.programs.append(program_record(elem.attrib))
+            elif elem.tag == "patch":
+                self.patches.append(patch_record(elem.attrib))
+            elem.clear()
+
+    def bootable_lun(self):
+        """ Returns the lun holding the boot loader ("xbl", "xbl_a", "sbl1"), -1 if none and None if ambiguous """
+        luns = [program.get("physical_partition_number") for program in self.programs
+                if program.label in ["xbl", "xbl_a", "sbl1"]]
+        if not luns:
+            return -1
+        if len(luns) > 1:
+            return None
+        return luns[0]
+
+
+parse_cache = {}
+
+
+def load(filename):
+    """ Parses a rawprogram/patch file once, later calls return the cached records until the file changes """
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    cached = parse_cache.get(key)
+    if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    result = rawprogram_file(filename)
+    parse_cache[key] = ((st.st_mtime_ns, st.st_size), result)
+    return result
+
+
+def merge_plans(filenames, num_disk_sectors=None):
+    """
+    Merges the <program> records of several rawprogram files into one plan ordered by lun and
+    start sector. num_disk_sectors may be a dict lun -> sectors to resolve sectors relative to the end.
+    """
+    plan = []
+    for filename in filenames:
+        plan.extend(load(filename).programs)
+
+    def key(item):
+        idx, program = item
+        lun = program.lun
+        disk_sectors = num_disk_sectors.get(lun) if isinstance(num_disk_sectors, dict) else num_disk_sectors
+        sector = program.sector(disk_sectors)
+        return lun, float("inf") if sector is None else sector, idx
+
+    return [program for idx, program in sorted(enumerate(plan), key=key)]
+
+
+def write_rawprogram(filename, programs=(), patches=()):
+    """ Streams the records to filename instead of building the whole xml in memory """
+    with open(filename, "w", encoding="utf-8", newline="") as wf:
+        wf.write("<?xml version=\"1.0\" ?>\n<data>\n")
+        for record in programs:
+            wf.write("\t" + record.toxml() + "\n")
+        for record in patches:
+            wf.write("\t" + record.toxml() + "\n")
+        wf.write("</data>")
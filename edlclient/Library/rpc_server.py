@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from struct import pack, unpack, calcsize
+
+from edlclient.Library.utils import LogBase, parse_args, getint
+
+# Frame header: type (u8), job id (u32), payload length (u32)
+FRAME_HDR = "<BII"
+FRAME_HDR_SIZE = calcsize(FRAME_HDR)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# client -> server
+FRAME_SUBMIT = 0x01
+FRAME_CANCEL = 0x02
+# server -> client
+FRAME_QUEUED = 0x10
+FRAME_DATA = 0x11
+FRAME_PROGRESS = 0x12
+FRAME_LOG = 0x13
+FRAME_RESULT = 0x14
+
+JOB_OK = "ok"
+JOB_ERROR = "error"
+JOB_CANCELLED = "cancelled"
+
+STREAM_CHUNK = 4 * 1024 * 1024
+
+
+def pack_frame(ftype, jobid, payload=b""):
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    elif isinstance(payload, dict):
+        payload = json.dumps(payload).encode("utf-8")
+    return pack(FRAME_HDR, ftype, jobid, len(payload)) + payload
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class rpc_job:
+    def __init__(self, conn, jobid, cmd, args, priority):
+        self.conn = conn
+        self.jobid = jobid
+        self.cmd = cmd
+        self.args = args
+        self.priority = priority
+        self.cancelled = False
+        self.started = False
+        self.done = False
+
+
+class rpc_connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.closed = False
+        self.jobs = {}
+
+    async def send(self, ftype, jobid, payload=b""):
+        if self.closed:
+            return False
+        async with self.lock:
+            try:
+                self.writer.write(pack_frame(ftype, jobid, payload))
+                await self.writer.drain()
+            except (ConnectionError, OSError):
+                self.closed = True
+                return False
+        return True
+
+
+class rpc_server(metaclass=LogBase):
+    """
+    Job server that keeps the device session open and serves many local clients.
+
+    Every frame starts with a FRAME_HDR header (type, job id, payload length).
+    A client submits a job as FRAME_SUBMIT with a json payload
+    {"cmd": "r", "args": "boot,-", "priority": 0} and may cancel it with FRAME_CANCEL.
+    Jobs are executed one at a time in priority order (lower value first) on a single
+    worker thread owning the device, the server answers with FRAME_QUEUED, FRAME_LOG,
+    FRAME_PROGRESS, FRAME_DATA and finally FRAME_RESULT.
+    For "r" and "rs" a filename of "-" streams the data back as FRAME_DATA frames.
+    """
+
+    def __init__(self, client, arguments, handler, loglevel=logging.INFO):
+        self.client = client
+        self.arguments = arguments
+        self.handler = handler
+        self.__logger = self._logger
+        self.info = self.__logger.info
+        self.debug = self.__logger.debug
+        self.error = self.__logger.error
+        self.__logger.setLevel(loglevel)
+        if loglevel == logging.DEBUG:
+            logfilename = "log.txt"
+            fh = logging.FileHandler(logfilename)
+            self.__logger.addHandler(fh)
+        self.loop = None
+        self.queue = []
+        self.seq = itertools.count()
+        self.wakeup = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.current = None
+
+    # ---------------------------------------------------------------- queue
+
+    def submit(self, job):
+        heapq.heappush(self.queue, (job.priority, next(self.seq), job))
+        job.conn.jobs[job.jobid] = job
+        self.wakeup.set()
+        return sum(1 for entry in self.queue if not entry[2].cancelled)
+
+    async def cancel(self, job):
+        job.cancelled = True
+        if not job.started:
+            job.done = True
+            job.conn.jobs.pop(job.jobid, None)
+            await job.conn.send(FRAME_RESULT, job.jobid, dict(status=JOB_CANCELLED))
+
+    async def worker(self):
+        while True:
+            while not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            _, _, job = heapq.heappop(self.queue)
+            if job.cancelled or job.conn.closed:
+                continue
+            job.started = True
+            self.current = job
+            try:
+                status, error = await self.loop.run_in_executor(self.executor, self.run_job, job)
+            finally:
+                self.current = None
+            job.done = True
+            job.conn.jobs.pop(job.jobid, None)
+            result = dict(status=status)
+            if error:
+                result["error"] = error
+            await job.conn.send(FRAME_RESULT, job.jobid, result)
+
+    # ---------------------------------------------------------------- worker thread
+
+    def send_threadsafe(self, job, ftype, payload=b""):
+        if job.cancelled:
+            raise JobCancelled()
+        fut = asyncio.run_coroutine_threadsafe(job.conn.send(ftype, job.jobid, payload), self.loop)
+        if not fut.result():
+            job.cancelled = True
+            raise JobCancelled()
+
+    def run_job(self, job):
+        def jobprint(arg):
+            if isinstance(arg, bytes) or isinstance(arg, bytearray):
+                arg = arg.decode("utf-8", errors="replace")
+            self.send_threadsafe(job, FRAME_LOG, str(arg))
+
+        oldprinter = getattr(self.client, "printer", None)
+        self.client.printer = jobprint
+        try:
+            try:
+                opts = parse_args(job.cmd, job.args, self.arguments)
+            except IndexError:
+                return JOB_ERROR, "Wrong arguments"
+            # A cancel that comes in once the work is done doesn't undo it
+            if job.cancelled:
+                return JOB_CANCELLED, ""
+            if job.cmd in ["r", "rs"] and opts.get("<filename>") == "-" and hasattr(self.client, "firehose"):
+                res = self.stream_read(job, opts)
+            else:
+                res = self.handler(job.cmd, opts)
+            return (JOB_OK, "") if res else (JOB_ERROR, "Command failed")
+        except JobCancelled:
+            return JOB_CANCELLED, ""
+        except Exception as err:  # pylint: disable=broad-except
+            self.error(str(err))
+            return JOB_ERROR, str(err)
+        finally:
+            self.client.printer = oldprinter
+
+    def stream_read(self, job, opts):
+        fh = self.client.firehose
+        if job.cmd == "r":
+            res = fh.detect_partition(opts, opts["<partitionname>"])
+            if not res[0]:
+                self.send_threadsafe(job, FRAME_LOG, f"Couldn't detect partition: {opts['<partitionname>']}")
+                return False
+            lun = res[1]
+            start = res[2].sector
+            sectors = res[2].sectors
+        else:
+            lun = getint(opts["--lun"]) if opts.get("--lun") is not None else 0
+            start = getint(opts["<start_sector>"])
+            sectors = getint(opts["<sectors>"])
+        sectorsize = fh.cfg.SECTOR_SIZE_IN_BYTES
+        chunk = max(1, STREAM_CHUNK // sectorsize)
+        total = sectors * sectorsize
+        pos = 0
+        self.send_threadsafe(job, FRAME_PROGRESS, dict(pos=0, total=total))
+        while pos < sectors:
+            if job.cancelled:
+                raise JobCancelled()
+            count = min(chunk, sectors - pos)
+            resp = fh.cmd_read_buffer(lun, start + pos, count, False)
+            if not resp.resp:
+                self.send_threadsafe(job, FRAME_LOG, str(resp.error))
+                return False
+            self.send_threadsafe(job, FRAME_DATA, bytes(resp.data))
+            pos += count
+            self.send_threadsafe(job, FRAME_PROGRESS, dict(pos=pos * sectorsize, total=total))
+        return True
+
+    # ---------------------------------------------------------------- network
+
+    async def handle_connection(self, reader, writer):
+        conn = rpc_connection(reader, writer)
+        self.info("Client connected")
+        try:
+            while True:
+                hdr = await reader.readexactly(FRAME_HDR_SIZE)
+                ftype, jobid, length = unpack(FRAME_HDR, hdr)
+                if length > MAX_FRAME_SIZE:
+                    self.error("Frame too large, dropping client")
+                    break
+                payload = await reader.readexactly(length) if length else b""
+                if ftype == FRAME_SUBMIT:
+                    await self.handle_submit(conn, jobid, payload)
+                elif ftype == FRAME_CANCEL:
+                    job = conn.jobs.get(jobid)
+                    if job is not None:
+                        await self.cancel(job)
+                else:
+                    await conn.send(FRAME_RESULT, jobid, dict(status=JOB_ERROR, error="Unknown frame type"))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            conn.closed = True
+            for job in list(conn.jobs.values()):
+                job.cancelled = True
+            writer.close()
+            self.info("Client disconnected")
+
+    async def handle_submit(self, conn, jobid, payload):
+        try:
+            request = json.loads(payload.decode("utf-8"))
+            cmd = request["cmd"]
+            args = request.get("args", "")
+            if isinstance(args, list):
+                args = ",".join(str(arg) for arg in args)
+            priority = int(request.get("priority", 0))
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError):
+            await conn.send(FRAME_RESULT, jobid, dict(status=JOB_ERROR, error="Malformed request"))
+            return
+        if cmd == "server" or jobid in conn.jobs:
+            await conn.send(FRAME_RESULT, jobid, dict(status=JOB_ERROR, error="Rejected request"))
+            return
+        position = self.submit(rpc_job(conn, jobid, cmd, args, priority))
+        await conn.send(FRAME_QUEUED, jobid, dict(position=position))
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        unixsocket = self.arguments.get("--unixsocket")
+        if unixsocket:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unixsocket)
+            self.info(f"starting up on unix socket {unixsocket}")
+        else:
+            port = int(self.arguments["--tcpport"])
+            server = await asyncio.start_server(self.handle_connection, host="localhost", port=port)
+            self.info(f"starting up on localhost port {port}")
+        worker = asyncio.ensure_future(self.worker())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=True)
+        return True
+
+
+class rpc_client:
+    """
+    Minimal blocking client for rpc_server, used by scripts and line controllers.
+    """
+
+    def __init__(self, port=1340, unixsocket=None, timeout=None):
+        if unixsocket is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unixsocket)
+        else:
+            self.sock = socket.create_connection(("localhost", port))
+        self.sock.settimeout(timeout)
+        self.jobid = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.sock.close()
+
+    def submit(self, cmd, args="", priority=0):
+        jobid = next(self.jobid)
+        request = dict(cmd=cmd, args=args, priority=priority)
+        with self.lock:
+            self.sock.sendall(pack_frame(FRAME_SUBMIT, jobid, request))
+        return jobid
+
+    def cancel(self, jobid):
+        with self.lock:
+            self.sock.sendall(pack_frame(FRAME_CANCEL, jobid))
+
+    def recvexactly(self, length):
+        data = bytearray()
+        while len(data) < length:
+            tmp = self.sock.recv(length - len(data))
+            if not tmp:
+                raise ConnectionError("Connection closed by server")
+            data.extend(tmp)
+        return bytes(data)
+
+    def read_frame(self):
+        ftype, jobid, length = unpack(FRAME_HDR, self.recvexactly(FRAME_HDR_SIZE))
+        payload = self.recvexactly(length) if length else b""
+        if ftype in [FRAME_QUEUED, FRAME_PROGRESS, FRAME_RESULT]:
+            payload = json.loads(payload.decode("utf-8"))
+        elif ftype == FRAME_LOG:
+            payload = payload.decode("utf-8")
+        return ftype, jobid, payload
+
+    def run(self, cmd, args="", priority=0, wf=None, progress=None, printer=None):
+        jobid = self.submit(cmd, args, priority)
+        while True:
+            ftype, fjobid, payload = self.read_frame()
+            if fjobid != jobid:
+                continue
+            if ftype == FRAME_DATA and wf is not None:
+                wf.write(payload)
+            elif ftype == FRAME_PROGRESS and progress is not None:
+                progress(payload["pos"], payload["total"])
+            elif ftype == FRAME_LOG and printer is not None:
+                printer(payload)
+            elif ftype == FRAME_RESULT:
+                return payload
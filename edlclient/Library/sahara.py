@@ -7,20 +7,69 @@
 # GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
 import inspect
 import logging
+import mmap
 import os
 import sys
 import time
+from queue import Queue
 from struct import pack
 
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 from edlclient.Library.utils import print_progress, rmrf, LogBase
-from edlclient.Config.qualcomm_config import msmids, root_cert_hash
-from edlclient.Library.loader_db import loader_utils
+from edlclient.Config.qualcomm_config import msmids
+from edlclient.Library.loader_db import is_root_pkhash, loader_utils
+from edlclient.Library.compressed import COMPRESSION_KINDS, background_writer, open_compressed_writer
+from edlclient.Library.ramdump import EM_AARCH64, EM_ARM, elf_core_writer, select_regions
 from edlclient.Library.sahara_defs import ErrorDesc, cmd_t, exec_cmd_t, sahara_mode_t, status_t, \
     CommandHandler
 
+MEMORY_READ_WINDOW = 0x80000
+MEMORY_WRITER_DEPTH = 8
+# Loaders served by this process, shared by all connections (e.g. a server handling a device farm)
+loader_cache = {}
+
+
+class loader_image:
+    """
+    Read only view of a loader file for SAHARA_READ_DATA requests. The file is mmapped where
+    possible, requests are answered with memoryview slices and reads beyond the end of the
+    file are padded with 0xFF without growing a copy of the loader.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as rf:
+            try:
+                self.buffer = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and file systems without mmap support
+                self.buffer = rf.read()
+        self.view = memoryview(self.buffer)
+        self.size = len(self.buffer)
+
+    def __len__(self):
+        return self.size
+
+    def chunk(self, offset, length):
+        if offset + length <= self.size:
+            return self.view[offset:offset + length]
+        data = bytes(self.view[offset:self.size]) if offset < self.size else b""
+        return data + b"\xFF" * (length - len(data))
+
+
+def load_loader(filename):
+    """ Returns the cached loader_image of filename, reloaded when the file changed """
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    cached = loader_cache.get(key)
+    if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    image = loader_image(filename)
+    loader_cache[key] = ((st.st_mtime_ns, st.st_size), image)
+    return image
+
 
 class sahara(metaclass=LogBase):
     def __init__(self, cdc, loglevel):
@@ -47,10 +96,13 @@ class sahara(metaclass=LogBase):
         self.oem_str = None
         self.msm_str = None
         self.bit64 = False
+        self.memory_window = MEMORY_READ_WINDOW
         self.pktsize = None
         self.ch = CommandHandler()
         self.loader_handler = loader_utils(loglevel=loglevel)
         self.loaderdb = self.loader_handler.init_loader_db()
+        self.loader_candidates = []
+        self.upload_start = None
 
         self.__logger.setLevel(loglevel)
         if loglevel == logging.DEBUG:
@@ -294,61 +346,15 @@ class sahara(metaclass=LogBase):
                               f"PK_HASH:           0x{self.pkhash}\n" +
                               f"Serial:            0x{self.serials}\n")
                 if self.programmer == "":
-                    if self.hwidstr in self.loaderdb:
-                        mt = self.loaderdb[self.hwidstr]
-                        unfused = False
-                        for rootcert in root_cert_hash:
-                            if self.pkhash[0:16] in root_cert_hash[rootcert]:
-                                unfused = True
-                                break
-                        if unfused:
-                            self.info("Possibly unfused device detected, so any loader should be fine...")
-                            if self.pkhash[0:16] in mt:
-                                self.programmer = mt[self.pkhash[0:16]]
-                                self.info(f"Trying loader: {self.programmer}")
-                            else:
-                                for loader in mt:
-                                    self.programmer = mt[loader]
-                                    self.info(f"Possible loader available: {self.programmer}")
-                                for loader in mt:
-                                    self.programmer = mt[loader]
-                                    self.info(f"Trying loader: {self.programmer}")
-                                    break
-                        elif self.pkhash[0:16] in mt:
-                            self.programmer = self.loaderdb[self.hwidstr][self.pkhash[0:16]]
-                            self.info(f"Detected loader: {self.programmer}")
-                        else:
-                            for loader in self.loaderdb[self.hwidstr]:
-                                self.programmer = self.loaderdb[self.hwidstr][loader]
-                                self.info(f"Trying loader: {self.programmer}")
-                                break
-                            # print("Couldn't find a loader for given hwid and pkhash :(")
-                            # exit(0)
-                    elif self.hwidstr is not None and self.pkhash is not None:
-                        msmid = self.hwidstr[:8]
-                        found = False
-                        for hwidstr in self.loaderdb:
-                            if msmid == hwidstr[:8]:
-                                if self.pkhash[0:16] in self.loaderdb[hwidstr]:
-                                    self.programmer = self.loaderdb[hwidstr][self.pkhash[0:16]]
-                                    self.info(f"Found loader: {self.programmer}")
-                                    self.cmd_modeswitch(sahara_mode_t.SAHARA_MODE_COMMAND)
-                                    return True
-                            else:
-                                if self.pkhash[0:16] in self.loaderdb[hwidstr]:
-                                    self.programmer = self.loaderdb[hwidstr][self.pkhash[0:16]]
-                                    self.info(f"Found possible loader: {self.programmer}")
-                                    found = True
-                        if found:
-                            self.cmd_modeswitch(sahara_mode_t.SAHARA_MODE_COMMAND)
-                            return True
-                        else:
+                    if is_root_pkhash(self.pkhash):
+                        self.info("Possibly unfused device detected, so any loader should be fine...")
+                    if not self.select_loader():
+                        if self.hwidstr is not None and self.pkhash is not None:
                             self.error(
                                 f"Couldn't find a loader for given hwid and pkhash ({self.hwidstr}_{self.pkhash[0:16]}" +
                                 "_[FHPRG/ENPRG].bin) :(")
-                        return False
-                    else:
-                        self.error(f"Couldn't find a suitable loader :(")
+                        else:
+                            self.error(f"Couldn't find a suitable loader :(")
                         return False
             else:
                 # V3: Try to read pkhash first (may still work on some devices)
@@ -392,38 +398,7 @@ class sahara(metaclass=LogBase):
                     
                     # Try to find loader using V3 info
                     if self.programmer == "":
-                        # First try exact match with pkhash if available
-                        if self.pkhash and self.hwidstr in self.loaderdb:
-                            mt = self.loaderdb[self.hwidstr]
-                            if self.pkhash[0:16] in mt:
-                                self.programmer = mt[self.pkhash[0:16]]
-                                self.info(f"Found loader by HWID+PKHash: {self.programmer}")
-                            else:
-                                for loader in mt:
-                                    self.programmer = mt[loader]
-                                    self.info(f"Found loader by HWID: {self.programmer}")
-                                    break
-                        elif self.hwidstr in self.loaderdb:
-                            mt = self.loaderdb[self.hwidstr]
-                            for loader in mt:
-                                self.programmer = mt[loader]
-                                self.info(f"Found loader by HWID: {self.programmer}")
-                                break
-                        else:
-                            # Try matching by MSM ID only
-                            msmid = self.hwidstr[:8]
-                            for hwidstr in self.loaderdb:
-                                if msmid == hwidstr[:8]:
-                                    if self.pkhash and self.pkhash[0:16] in self.loaderdb[hwidstr]:
-                                        self.programmer = self.loaderdb[hwidstr][self.pkhash[0:16]]
-                                        self.info(f"Found loader by MSM_ID+PKHash: {self.programmer}")
-                                        break
-                                    for loader in self.loaderdb[hwidstr]:
-                                        self.programmer = self.loaderdb[hwidstr][loader]
-                                        self.info(f"Found possible loader by MSM_ID: {self.programmer}")
-                                        break
-                                    if self.programmer:
-                                        break
+                        self.select_loader()
                 else:
                     # V3 extended info not available, show basic info
                     self.info(f"\nReading Chip Info : OK")
@@ -440,6 +415,44 @@ class sahara(metaclass=LogBase):
 
         return False
 
+    def select_loader(self):
+        """ Picks the best ranked loader for the device, the others are kept as fallback for upload_loader """
+        self.loader_candidates = self.loader_handler.rank_loaders(self.hwidstr, self.pkhash)
+        if not self.loader_candidates:
+            return False
+        for loader in self.loader_candidates[1:]:
+            self.debug(f"Possible loader available: {loader}")
+        self.programmer = self.loader_candidates.pop(0)
+        self.info(f"Trying loader: {self.programmer}")
+        return True
+
+    def record_loader_outcome(self, success):
+        """ Stores if the uploaded loader reached firehose/streaming, for ranking the loaders on the next run """
+        if self.upload_start is None:
+            return False
+        elapsed = time.time() - self.upload_start if success else None
+        self.upload_start = None
+        return self.loader_handler.record_outcome(self.hwidstr, self.pkhash, self.programmer, success, elapsed)
+
+    def upload_ranked_loader(self, version):
+        """
+        Uploads self.programmer. If the device rejects it, the sahara state machine is reset and the next
+        candidate of select_loader() is uploaded, without waiting for the device to reboot.
+        """
+        while True:
+            self.upload_start = time.time()
+            mode = self.upload_loader(version=version)
+            if mode not in ["", "error"] or self.programmer == "":
+                return mode
+            self.record_loader_outcome(False)
+            if not self.loader_candidates:
+                return mode
+            self.programmer = self.loader_candidates.pop(0)
+            self.info(f"Loader was rejected, trying next loader: {self.programmer}")
+            self.cmd_reset_state_machine()
+            if self.connect().get("mode") != "sahara":
+                return mode
+
     def streaminginfo(self):
         if self.enter_command_mode():
             self.serial = self.cmdexec_get_serial_num()
@@ -486,80 +499,150 @@ class sahara(metaclass=LogBase):
                     self.error(self.get_error_desc(pkt.image_tx_status))
         return False
 
-    def read_memory(self, addr, bytestoread, display=False, wf=None):
-        data = b""
+    def memory_read_request(self, addr, length):
+        if self.bit64:
+            return pack("<IIQQ", cmd_t.SAHARA_64BIT_MEMORY_READ, 0x8 + 8 + 8, addr, length)
+        return pack("<IIII", cmd_t.SAHARA_MEMORY_READ, 0x8 + 4 + 4, addr, length)
+
+    def read_memory_into(self, addr, bytestoread, sink, buffers, display=False):
+        """
+        Reads bytestoread bytes at addr in windows of self.memory_window bytes. Each window is
+        received into a buffer taken from the buffers queue and handed to sink(buffer, length),
+        which has to put the buffer back once done. The request for the next window goes out
+        as soon as the current one is complete.
+        """
         old = 0
         pos = 0
-        total = bytestoread
         if display:
             print_progress(0, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-        while bytestoread > 0:
-            if bytestoread > 0x080000:
-                length = 0x080000
-            else:
-                length = bytestoread
-            bytesread = 0
-            try:
-                self.cdc.read(1, 1)
-            except Exception as e:  # pylint: disable=broad-except
-                self.debug(str(e))
-                pass
-            if self.bit64:
-                if not self.cdc.write(pack("<IIQQ", cmd_t.SAHARA_64BIT_MEMORY_READ, 0x8 + 8 + 8, addr + pos,
-                                           length)):
-                    return None
-            else:
-                if not self.cdc.write(
-                        pack("<IIII", cmd_t.SAHARA_MEMORY_READ, 0x8 + 4 + 4, addr + pos, length)):
-                    return None
-            while length > 0:
+        try:
+            self.cdc.read(1, 1)
+        except Exception as e:  # pylint: disable=broad-except
+            self.debug(str(e))
+        if bytestoread > 0 and not self.cdc.write(self.memory_read_request(addr, min(self.memory_window, bytestoread))):
+            return False
+        while pos < bytestoread:
+            length = min(self.memory_window, bytestoread - pos)
+            buffer = buffers.get()
+            view = memoryview(buffer)
+            received = 0
+            while received < length:
                 try:
-                    tmp = self.cdc.read(length)
+                    tmp = self.cdc.read(length - received)
                 except Exception as e:  # pylint: disable=broad-except
                     self.debug(str(e))
-                    return None
-                length -= len(tmp)
-                pos += len(tmp)
-                bytesread += len(tmp)
-                if wf is not None:
-                    wf.write(tmp)
-                else:
-                    data += tmp
-                if display:
-                    prog = round(float(pos) / float(total) * float(100), 1)
-                    if prog > old:
-                        if display:
-                            print_progress(prog, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-                            old = prog
-            bytestoread -= bytesread
-        if display:
+                    tmp = b""
+                if not tmp:
+                    buffers.put(buffer)
+                    self.error(f"Error reading memory at {hex(addr + pos + received)}")
+                    return False
+                view[received:received + len(tmp)] = tmp
+                received += len(tmp)
+            nextpos = pos + length
+            if nextpos < bytestoread:
+                if not self.cdc.write(self.memory_read_request(addr + nextpos,
+                                                               min(self.memory_window, bytestoread - nextpos))):
+                    buffers.put(buffer)
+                    return False
+            sink(buffer, length)
+            pos = nextpos
+            if display:
+                prog = round(float(pos) / float(bytestoread) * float(100), 1)
+                if prog > old:
+                    print_progress(prog, 100, prefix='Progress:', suffix='Complete', bar_length=50)
+                    old = prog
+        if display and old < 100:
             print_progress(100, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-        '''
+        return True
+
+    def memory_buffers(self, count):
+        buffers = Queue()
+        for _ in range(count):
+            buffers.put(bytearray(self.memory_window))
+        return buffers
+
+    def read_memory(self, addr, bytestoread, display=False, wf=None):
+        if wf is not None:
+            buffers = self.memory_buffers(MEMORY_WRITER_DEPTH + 2)
+            writer = background_writer(wf, depth=MEMORY_WRITER_DEPTH, release=buffers.put)
+            try:
+                if not self.read_memory_into(addr, bytestoread, writer.write, buffers, display):
+                    return None
+            finally:
+                writer.close()
+            return b""
+        data = bytearray(bytestoread)
+        pos = 0
+
+        def sink(buffer, length):
+            nonlocal pos
+            data[pos:pos + length] = memoryview(buffer)[:length]
+            pos += length
+            buffers.put(buffer)
+
+        buffers = self.memory_buffers(1)
+        if not self.read_memory_into(addr, bytestoread, sink, buffers, display):
+            return None
+        return bytes(data)
+
+    def dump_region(self, part, stream, buffers, sparse):
+        """ Streams one memory region to stream, reading ahead while a bounded writer thread stores it """
+        length = part["length"]
+        print(f"Dumping {part['filename']}({part['desc']}) at {hex(part['mem_base'])}, length {hex(length)}")
+        writer = background_writer(stream, depth=MEMORY_WRITER_DEPTH, sparse=sparse, release=buffers.put)
+
+        def sink(buffer, size):
+            # After a write error the region is still read to the end, so the link stays in step
+            try:
+                writer.write(buffer, size)
+            except IOError:
+                buffers.put(buffer)
+
         try:
-            self.cdc.read(0)
-        except:
-            return data
-        '''
-        return data
-
-    def dump_partitions(self, partition):
-        for part in partition:
-            filename = part["filename"]
-            desc = part["desc"]
-            mem_base = part["mem_base"]
-            length = part["length"]
-            print(f"Dumping {filename}({desc}) at {hex(mem_base)}, length {hex(length)}")
-            fname = os.path.join("memory", filename)
-            with open(fname, "wb") as wf:
-                self.read_memory(mem_base, length, True, wf)
-                if wf.tell() == length:
-                    print("Done dumping memory")
-                else:
-                    self.error("Error dumping memory")
+            result = self.read_memory_into(part["mem_base"], length, sink, buffers, True)
+        finally:
+            try:
+                writer.close()
+            except IOError as err:
+                self.error(f"Error writing {part['filename']}: {str(err)}")
+                result = False
+        if result and writer.written == length:
+            print("Done dumping memory")
+            return True
+        self.error("Error dumping memory")
+        return False
+
+    def dump_partitions(self, partition, compress=None, elfcore=None):
+        """
+        Dumps the regions to memory/, zero windows become holes of a sparse file unless compress
+        is set. With elfcore, all regions go to a single ELF core file instead.
+        """
+        buffers = self.memory_buffers(MEMORY_WRITER_DEPTH + 2)
+        if elfcore is not None:
+            if compress is not None:
+                self.warning("Compression isn't supported for elf core dumps, writing uncompressed")
+            try:
+                with elf_core_writer(elfcore, partition, EM_AARCH64 if self.bit64 else EM_ARM) as core:
+                    for idx, part in enumerate(partition):
+                        if not self.dump_region(part, core.region(idx), buffers, True):
+                            self.error(f"{part['filename']} is left out of {elfcore} (p_filesz 0)")
+                            core.mark_failed(idx)
+            except IOError as err:
+                self.error(f"Error writing {elfcore}: {str(err)}")
+        else:
+            for part in partition:
+                fname = os.path.join("memory", part["filename"])
+                if compress is not None:
+                    fname += COMPRESSION_KINDS.get(compress, "")
+                try:
+                    with open_compressed_writer(fname, compress) as wf:
+                        self.dump_region(part, wf, buffers, compress is None)
+                except IOError as err:
+                    self.error(f"Error writing {fname}: {str(err)}")
         self.cmd_reset()
         return True
 
-    def debug_mode(self, dump_partitions=None, version=2):
+    def debug_mode(self, dump_partitions=None, version=2, ranges=None, compress=None, elfcore=None):
         if not self.cmd_hello(sahara_mode_t.SAHARA_MODE_MEMORY_DEBUG, version=version):
             return False
         if os.path.exists("memory"):
@@ -583,8 +666,6 @@ class sahara(metaclass=LogBase):
                             pd = self.ch.parttbl_64bit(ptbldata[id_entry * pktsize:(id_entry * pktsize) + pktsize])
                             desc = pd.desc.replace(b"\x00", b"").decode('utf-8')
                             filename = pd.filename.replace(b"\x00", b"").decode('utf-8')
-                            if dump_partitions and filename not in dump_partitions:
-                                continue
                             mem_base = pd.mem_base
                             save_pref = pd.save_pref
                             length = pd.length
@@ -594,7 +675,8 @@ class sahara(metaclass=LogBase):
                                 f"{filename}({desc}): Offset {hex(mem_base)}, Length {hex(length)}, " +
                                 f"SavePref {hex(save_pref)}")
 
-                        self.dump_partitions(partitions)
+                        self.dump_partitions(select_regions(partitions, dump_partitions, ranges), compress,
+                                             elfcore)
                         return True
 
                     return True
@@ -611,8 +693,6 @@ class sahara(metaclass=LogBase):
                             pd = self.ch.parttbl(ptbldata[id_entry * pktsize:(id_entry * pktsize) + pktsize])
                             desc = pd.desc.replace(b"\x00", b"").decode('utf-8')
                             filename = pd.filename.replace(b"\x00", b"").decode('utf-8')
-                            if dump_partitions and filename not in dump_partitions:
-                                continue
                             mem_base = pd.mem_base
                             save_pref = pd.save_pref
                             length = pd.length
@@ -621,7 +701,8 @@ class sahara(metaclass=LogBase):
                             print(f"{filename}({desc}): Offset {hex(mem_base)}, " +
                                   f"Length {hex(length)}, SavePref {hex(save_pref)}")
 
-                        self.dump_partitions(partitions)
+                        self.dump_partitions(select_regions(partitions, dump_partitions, ranges), compress,
+                                             elfcore)
                     return True
         elif res["data"].image_tx_status:
             self.error(self.get_error_desc(res["data"].image_tx_status))
@@ -633,8 +714,7 @@ class sahara(metaclass=LogBase):
             return ""
         try:
             self.info(f"Uploading loader {self.programmer} ...")
-            with open(self.programmer, "rb") as rf:
-                programmer = rf.read()
+            programmer = load_loader(self.programmer)
         except Exception as e:  # pylint: disable=broad-except
             self.error(str(e))
             sys.exit()
@@ -687,11 +767,7 @@ class sahara(metaclass=LogBase):
                     loop += 1
                     data_offset = pkt.data_offset
                     data_len = pkt.data_len
-                    if data_offset + data_len > len(programmer):
-                        while len(programmer) < data_offset + data_len:
-                            programmer += b"\xFF"
-                    data_to_send = programmer[data_offset:data_offset + data_len]
-                    self.cdc.write(data_to_send)
+                    self.cdc.write(programmer.chunk(data_offset, data_len))
                     datalen -= data_len
                 elif cmd == cmd_t.SAHARA_END_TRANSFER:
                     pkt = resp["data"]
@@ -10,7 +10,7 @@ import logging
 import os
 import sys
 from queue import Queue
-from struct import unpack
+from struct import unpack, pack
 
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
@@ -19,12 +19,18 @@ from edlclient.Library.utils import LogBase, print_progress
 
 MAX_STORE_SIZE = 1024 * 1024 * 1024 * 2  # 2 GBs
 
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
 
 class QCSparse(metaclass=LogBase):
     def __init__(self, filename, loglevel):
         self.rf = open(filename, 'rb')
         self.data = Queue()
-        self.__logger = self.__logger
+        self.__logger = self._logger
         self.offset = 0
         self.tmpdata = bytearray()
         self.__logger.setLevel(loglevel)
@@ -64,7 +70,7 @@ class QCSparse(metaclass=LogBase):
         self.total_blks = header[6]
         self.total_chunks = header[7]
         self.image_checksum = header[8]
-        if magic != 0xED26FF3A:
+        if magic != SPARSE_HEADER_MAGIC:
             return False
         if self.file_hdr_sz != 28:
             self.error("The file header size was expected to be 28, but is %u." % self.file_hdr_sz)
@@ -86,7 +92,7 @@ class QCSparse(metaclass=LogBase):
         total_sz = header[3]
         data_sz = total_sz - 12
 
-        if chunk_type == 0xCAC1:
+        if chunk_type == CHUNK_TYPE_RAW:
             if data_sz != (chunk_sz * self.blk_sz):
                 self.error(
                     "Raw chunk input size (%u) does not match output size (%u)" % (data_sz, chunk_sz * self.blk_sz))
@@ -94,16 +100,16 @@ class QCSparse(metaclass=LogBase):
             else:
                 self.rf.seek(self.rf.tell() + data_sz)
                 return chunk_sz * self.blk_sz
-        elif chunk_type == 0xCAC2:
+        elif chunk_type == CHUNK_TYPE_FILL:
             if data_sz != 4:
                 self.error("Fill chunk should have 4 bytes of fill, but this has %u" % data_sz)
                 return -1
             else:
                 self.rf.seek(self.rf.tell() + data_sz)
                 return chunk_sz * self.blk_sz
-        elif chunk_type == 0xCAC3:
+        elif chunk_type == CHUNK_TYPE_DONT_CARE:
             return chunk_sz * self.blk_sz
-        elif chunk_type == 0xCAC4:
+        elif chunk_type == CHUNK_TYPE_CRC32:
             if data_sz != 4:
                 self.error("CRC32 chunk should have 4 bytes of CRC, but this has %u" % data_sz)
                 return -1
@@ -124,7 +130,7 @@ class QCSparse(metaclass=LogBase):
         chunk_sz = header[2]
         total_sz = header[3]
         data_sz = total_sz - 12
-        if chunk_type == 0xCAC1:
+        if chunk_type == CHUNK_TYPE_RAW:
             if data_sz != (chunk_sz * self.blk_sz):
                 self.error(
                     "Raw chunk input size (%u) does not match output size (%u)" % (data_sz, chunk_sz * self.blk_sz))
@@ -134,7 +140,7 @@ class QCSparse(metaclass=LogBase):
                 data = self.rf.read(chunk_sz * self.blk_sz)
                 self.offset += chunk_sz
                 return data
-        elif chunk_type == 0xCAC2:
+        elif chunk_type == CHUNK_TYPE_FILL:
             if data_sz != 4:
                 self.error("Fill chunk should have 4 bytes of fill, but this has %u" % data_sz)
                 return -1
@@ -145,11 +151,11 @@ class QCSparse(metaclass=LogBase):
                 data = fill_bin * (chunk_sz * self.blk_sz // 4)
                 self.offset += chunk_sz
                 return data
-        elif chunk_type == 0xCAC3:
+        elif chunk_type == CHUNK_TYPE_DONT_CARE:
             data = b'\x00' * chunk_sz * self.blk_sz
             self.offset += chunk_sz
             return data
-        elif chunk_type == 0xCAC4:
+        elif chunk_type == CHUNK_TYPE_CRC32:
             if data_sz != 4:
                 self.error("CRC32 chunk should have 4 bytes of CRC, but this has %u" % data_sz)
                 return -1
@@ -193,6 +199,127 @@ class QCSparse(metaclass=LogBase):
                 return tdata
 
 
+class sparse_stream_reader:
+    """
+    Expands an Android sparse image from a non seekable stream (for example
+    a decompressor). The output size is taken from the header, total_blks * blk_sz.
+    """
+
+    def __init__(self, rf):
+        self.rf = rf
+        self.blk_sz = None
+        self.total_blks = None
+        self.total_chunks = None
+        self.chunk = 0
+        self.pending = bytearray()
+        self.fill = None
+        self.fill_left = 0
+
+    def readheader(self):
+        buf = self.rf.read(0x1C)
+        if len(buf) != 28:
+            return False
+        magic, _, _, file_hdr_sz, chunk_hdr_sz, self.blk_sz, self.total_blks, self.total_chunks, _ = \
+            unpack("<I4H4I", buf)
+        if magic != SPARSE_HEADER_MAGIC or file_hdr_sz != 28 or chunk_hdr_sz != 12:
+            return False
+        return True
+
+    def getsize(self):
+        return self.total_blks * self.blk_sz
+
+    def next_chunk(self):
+        header = self.rf.read(12)
+        if len(header) != 12:
+            raise IOError("Truncated sparse chunk header")
+        chunk_type, _, chunk_sz, total_sz = unpack("<2H2I", header)
+        data_sz = total_sz - 12
+        self.chunk += 1
+        if chunk_type == CHUNK_TYPE_RAW:
+            if data_sz != chunk_sz * self.blk_sz:
+                raise IOError("Raw chunk input size (%u) does not match output size (%u)" %
+                              (data_sz, chunk_sz * self.blk_sz))
+            self.fill = None
+            self.fill_left = data_sz
+        elif chunk_type in [CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE]:
+            self.fill = self.rf.read(4) if chunk_type == CHUNK_TYPE_FILL else b"\x00\x00\x00\x00"
+            self.fill_left = chunk_sz * self.blk_sz
+        elif chunk_type == CHUNK_TYPE_CRC32:
+            self.rf.read(data_sz)
+        else:
+            raise IOError("Unknown chunk type 0x%04X" % chunk_type)
+
+    def read(self, length):
+        while len(self.pending) < length:
+            if self.fill_left == 0:
+                if self.chunk >= self.total_chunks:
+                    break
+                self.next_chunk()
+                continue
+            rlen = min(self.fill_left, length - len(self.pending))
+            if self.fill is None:
+                data = self.rf.read(rlen)
+                if len(data) != rlen:
+                    raise IOError("Truncated sparse raw chunk")
+                self.pending.extend(data)
+            else:
+                phase = self.fill_left % 4
+                fill = self.fill[-phase:] + self.fill[:-phase] if phase else self.fill
+                self.pending.extend(fill * (rlen // 4) + fill[:rlen % 4])
+            self.fill_left -= rlen
+        data = bytes(self.pending[:length])
+        del self.pending[:length]
+        return data
+
+
+class sparse_writer:
+    """
+    Writes an Android sparse image. Raw data and don't care ranges are added
+    in block order, the file header is rewritten with the final counts on close.
+    """
+
+    def __init__(self, wf, blk_sz=4096):
+        self.wf = wf
+        self.blk_sz = blk_sz
+        self.total_blks = 0
+        self.total_chunks = 0
+        self.wf.write(self.header())
+
+    def header(self):
+        return pack("<I4H4I", SPARSE_HEADER_MAGIC, 1, 0, 28, 12, self.blk_sz, self.total_blks, self.total_chunks, 0)
+
+    def add_raw(self, data):
+        if len(data) % self.blk_sz:
+            raise ValueError("Raw chunk data has to be a multiple of the block size")
+        blocks = len(data) // self.blk_sz
+        if blocks == 0:
+            return
+        self.wf.write(pack("<2H2I", CHUNK_TYPE_RAW, 0, blocks, 12 + len(data)))
+        self.wf.write(data)
+        self.total_blks += blocks
+        self.total_chunks += 1
+
+    def add_fill(self, blocks, fill=b"\x00\x00\x00\x00"):
+        if blocks == 0:
+            return
+        self.wf.write(pack("<2H2I", CHUNK_TYPE_FILL, 0, blocks, 16) + fill)
+        self.total_blks += blocks
+        self.total_chunks += 1
+
+    def add_dont_care(self, blocks):
+        if blocks == 0:
+            return
+        self.wf.write(pack("<2H2I", CHUNK_TYPE_DONT_CARE, 0, blocks, 12))
+        self.total_blks += blocks
+        self.total_chunks += 1
+
+    def close(self):
+        pos = self.wf.tell()
+        self.wf.seek(0)
+        self.wf.write(self.header())
+        self.wf.seek(pos)
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 3:
         print("./sparse.py <sparse_partition.img> <outfile>")
@@ -5,19 +5,49 @@
 #
 # !!!!! If you use this code in commercial products, your product is automatically
 # GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
-from struct import pack
+import json
+from collections import deque
+from struct import pack, pack_into, unpack
 from binascii import unhexlify
 from edlclient.Library.utils import *
 from edlclient.Library.hdlc import *
 from edlclient.Library.nand_config import BadFlags, SettingsOpt, nandregs, NandDevice
+from edlclient.Library.nandlayout import LAYOUT_RAW, layout_writer, nand_geometry, \
+    split_block
 from edlclient.Library.utils import progress
 
 STREAMING_DLOAD_PARTITION_TABLE_SIZE = 512
+STREAMING_READ_WINDOW = 8
+QC_READ_CHUNK = 0x200
+QC_READ_MAX_CHUNK = 0x1000
+PATCHED_READ_CHUNK = 1000
+PATCHED_WRITE_CMD = b"\x11\x00" + unhexlify(
+    "380080e224309fe524409fe5044083e0042090e4042083e4040053e1fbffff3a1200a0e30000c1e50140a0e31eff2fe1")
+STREAMING_WRITE_WINDOW = 8
+STREAMING_WRITE_SIZE = 1024
+BBT_FILENAME = "edl_bbt.json"
+BBT_SCAN_WINDOW = 16
+READAHEAD_WINDOW = 2
+"""
+LDR             R3, loc_2C
+LDR             R4, loc_30
+MOV             R0, #0x12
+STR             R0, [R1],#4
+ADD             R0, R3, R4
+LDR             R2, [R3],#4
+STR             R2, [R1],#4
+CMP             R3, R0
+BCC             loc_14
+ADD             R4, R4, #4
+BX              LR
+"""
+PATCHED_READ_CMD = b"\x11\x00" + unhexlify(
+    "24309fe524409fe51200a0e3040081e4040083e0042093e4042081e4000053e1fbffff3a044084e21eff2fe1")
 
 
 class Streaming(metaclass=LogBase):
     def __init__(self, cdc, sahara, loglevel=logging.INFO):
-        self.__logger = self.__logger
+        self.__logger = self._logger
         self.regs = None
         self.cdc = cdc
         self.hdlc = hdlc(self.cdc)
@@ -39,6 +69,12 @@ class Streaming(metaclass=LogBase):
         self.Patched = 1
         self.streaming_mode = None
         self.memread = None
+        self.read_window = STREAMING_READ_WINDOW
+        self.qc_read_chunk = QC_READ_CHUNK
+        self.qc_read_limit = QC_READ_MAX_CHUNK
+        self.write_window = STREAMING_WRITE_WINDOW
+        self.readahead = True
+        self.readahead_window = READAHEAD_WINDOW
 
         if loglevel == logging.DEBUG:
             logfilename = "log.txt"
@@ -157,8 +193,14 @@ class Streaming(metaclass=LogBase):
             return True
         return False
 
+    def invalidate_regs(self):
+        """ The loader's own flash code changes controller registers behind the register shadow """
+        if self.regs is not None:
+            self.regs.invalidate()
+
     def qclose(self, errmode):
         resp = self.send(b"\x15")
+        self.invalidate_regs()
         if len(resp) > 0 and resp[0] == 0x16:
             time.sleep(0.5)
             return True
@@ -169,6 +211,7 @@ class Streaming(metaclass=LogBase):
     def send_section_header(self, name):
         # 0x1b open muliimage, 0xe for user-defined partition
         resp = self.send(b"\x1b\x0e" + bytes("0:" + name, 'utf-8') + b"\x00")
+        self.invalidate_regs()
         if resp[0] == 0x1c:
             return True
         self.error("Error on sending section header")
@@ -187,26 +230,14 @@ class Streaming(metaclass=LogBase):
         return False
 
     def write_flash(self, lba: int = 0, partname="", filename="", info=True):
-        wbsize = 1024
-        filesize = os.stat(filename).st_size
-        total = filesize
+        total = os.stat(filename).st_size
         progbar = progress(1)
         progbar.show_progress(prefix="Write", pos=0, total=total, display=info)
         with open(filename, 'rb') as rf:
             if self.send_section_header(partname):
-                adr = lba
-                while filesize > 0:
-                    subdata = rf.read(wbsize)
-                    if len(subdata) < 1024:
-                        subdata += (1024 - len(subdata)) * b'\xFF'
-                    scmd = b"\x07" + pack("<I", adr) + subdata
-                    resp = self.send(scmd)
-                    if len(resp) == 0 or resp[0] != 0x8:
-                        self.error("Error on sending data at address %08X" % adr)
-                        return False
-                    progbar.show_progress(prefix="Write", pos=adr, total=total, display=info)
-                    adr += 1024
-                    filesize -= len(subdata)
+                if not self.stream_write(rf, lba, total, progbar, info):
+                    self.invalidate_regs()
+                    return False
             progbar.show_progress(prefix="Write", pos=total, total=total, display=info)
             if not self.qclose(1):
                 self.error("Error on closing data stream")
@@ -214,6 +245,78 @@ class Streaming(metaclass=LogBase):
             else:
                 return True
 
+    def stream_write(self, rf, address, total, progbar=None, info=True, window=None, retries=5):
+        """
+        Sends rf as 0x07 stream write packets with up to window packets waiting for their 0x08 ack.
+        Packets are built in place in one buffer per window slot, the last one padded with 0xFF.
+        Acks are matched by address, a NAK or a bad reply resends the oldest unacked packet only,
+        a timeout resends all packets in flight. The window never exceeds the one the loader
+        announced in its hello reply.
+        """
+        wbsize = STREAMING_WRITE_SIZE
+        if window is None:
+            window = self.write_window
+        if self.hp is not None and self.hp.windowSize > 0:
+            window = min(window, self.hp.windowSize)
+        slots = [bytearray(5 + wbsize) for _ in range(window)]
+        for buffer in slots:
+            buffer[0] = 0x07
+        padding = memoryview(b"\xFF" * wbsize)
+        free = list(range(window))
+        pending = {}  # address -> [slot, tries], in send order
+        adr = address
+        written = 0
+        eof = False
+        self.hdlc.reset_receiver()
+        while pending or not eof:
+            while free and not eof:
+                slot = free.pop()
+                buffer = slots[slot]
+                length = rf.readinto(memoryview(buffer)[5:])
+                if not length:
+                    free.append(slot)
+                    eof = True
+                    break
+                if length < wbsize:
+                    buffer[5 + length:] = padding[:wbsize - length]
+                    eof = True
+                pack_into("<I", buffer, 1, adr)
+                self.hdlc.send_packet(buffer)
+                pending[adr] = [slot, 0]
+                adr += wbsize
+            if not pending:
+                break
+            resp = self.hdlc.receive_reply()
+            if resp == -1 or len(resp) == 0:
+                oldest = next(iter(pending))
+                pending[oldest][1] += 1
+                if pending[oldest][1] > retries:
+                    self.error("Error on sending data at address %08X" % oldest)
+                    return False
+                if resp == b"":
+                    # Nothing came back: resend everything in flight
+                    self.hdlc.reset_receiver()
+                    for item in pending.values():
+                        self.hdlc.send_packet(slots[item[0]])
+                continue
+            if resp[0] == 0x08 and len(resp) >= 5:
+                ackaddr = unpack("<I", resp[1:5])[0]
+                item = pending.pop(ackaddr, None)
+                if item is not None:
+                    free.append(item[0])
+                    written += wbsize
+                    if progbar is not None:
+                        progbar.show_progress(prefix="Write", pos=min(written, total), total=total, display=info)
+                continue
+            oldest = next(iter(pending))
+            pending[oldest][1] += 1
+            if pending[oldest][1] > retries:
+                self.error("Error on sending data at address %08X" % oldest)
+                return False
+            self.debug("NAK on address %08X, resending" % oldest)
+            self.hdlc.send_packet(slots[pending[oldest][0]])
+        return True
+
     def read_sectors(self, sector, sectors, filename, info=False):
         old = 0
         sectorsize = self.settings.PAGESIZE // self.settings.sectors_per_page
@@ -256,69 +359,134 @@ class Streaming(metaclass=LogBase):
         self.error("Partition tables do not match - you need to fully flash the modem")
         return False
 
+    def qc_read_request(self, address, size):
+        return b"\x03" + pack("<I", address) + pack("<H", size)
+
+    @staticmethod
+    def qc_read_reply(resp):
+        """ Read reply: 0x04, address, data. Error replies carry no address """
+        if len(resp) >= 6 and resp[1] == 0x04:
+            return unpack("<I", resp[2:6])[0], resp[6:]
+        return None, b""
+
+    def patched_read_request(self, address, size):
+        return PATCHED_READ_CMD + pack("<I", address) + pack("<I", size)
+
+    @staticmethod
+    def patched_read_reply(resp):
+        # The stub doesn't echo the address, replies arrive in request order
+        return None, resp[5:]
+
+    def pipelined_read(self, address, length, request, reply, chunk, adaptive=False, window=None, retries=5):
+        """
+        Yields (address, data) in address order while up to window read requests are in flight.
+        Replies are matched by the address they echo, replies without one belong to the oldest
+        outstanding request. If adaptive, the chunk size doubles after every good reply up to
+        self.qc_read_limit, a rejected size lowers the limit and is requested again in halves.
+        Stops early if a request fails retries times.
+        """
+        if window is None:
+            window = self.read_window
+        end = address + length
+        pending = deque()  # [address, size, tries] in send order
+        resend = deque()
+        done = {}
+        nextaddr = address
+        expect = address
+        self.hdlc.reset_receiver()
+        while expect < end:
+            while len(pending) < window and (resend or nextaddr < end):
+                if resend:
+                    item = resend.popleft()
+                else:
+                    item = [nextaddr, min(chunk, end - nextaddr), 0]
+                    nextaddr += item[1]
+                self.hdlc.send_packet(request(item[0], item[1]))
+                pending.append(item)
+            if not pending:
+                break
+            resp = self.hdlc.receive_reply_nocrc()
+            if len(resp) <= 1:
+                # Nothing came back, the loader may have dropped requests: resend everything in flight.
+                # Late replies are drained first, replies without an address would be matched to
+                # the wrong request otherwise
+                self.hdlc.drain_receiver()
+                pending[0][2] += 1
+                if pending[0][2] > retries:
+                    self.error(f"Error reading memory at addr {hex(pending[0][0])}, no reply")
+                    return
+                resend.extendleft(reversed(pending))
+                pending.clear()
+                continue
+            raddr, data = reply(resp)
+            if raddr is None:
+                item = pending[0]
+            else:
+                item = next((entry for entry in pending if entry[0] == raddr), None)
+                if item is None:
+                    # Late reply to a request that was already resent
+                    continue
+            pending.remove(item)
+            iaddr, size, tries = item
+            if len(data) >= size:
+                done[iaddr] = data[:size]
+                if adaptive and chunk < self.qc_read_limit:
+                    chunk = min(chunk * 2, self.qc_read_limit)
+                    self.qc_read_chunk = chunk
+            elif adaptive and size > QC_READ_CHUNK:
+                self.qc_read_limit = max(QC_READ_CHUNK, size // 2)
+                chunk = min(chunk, self.qc_read_limit)
+                self.qc_read_chunk = chunk
+                self.debug(f"Loader rejected {hex(size)} byte reads, using {hex(chunk)}")
+                half = self.qc_read_limit
+                resend.appendleft([iaddr + half, size - half, 0])
+                resend.appendleft([iaddr, half, 0])
+            else:
+                item[2] += 1
+                if item[2] > retries:
+                    self.error(f"Error reading memory at addr {hex(iaddr)}, {str(size)} bytes required, "
+                               f"{str(len(data))} bytes received.")
+                    return
+                resend.appendleft(item)
+            while expect in done:
+                data = done.pop(expect)
+                yield expect, data
+                expect += len(data)
+
+    def memread_iter(self, address, length):
+        """ Yields (address, data) chunks of a memory range using the pipelined reader of the current mode """
+        if self.memread == self.qc_memread:
+            yield from self.pipelined_read(address, length, self.qc_read_request, self.qc_read_reply,
+                                           self.qc_read_chunk, adaptive=True)
+        elif self.memread == self.patched_memread:
+            yield from self.pipelined_read(address, length, self.patched_read_request, self.patched_read_reply,
+                                           PATCHED_READ_CHUNK)
+        else:
+            for pos in range(0, length, 0x20000):
+                data = self.memread(address + pos, min(0x20000, length - pos))
+                if data == b"":
+                    return
+                yield address + pos, data
+
     def qc_memread(self, address, length):
         self.debug("memread %08X:%08X" % (address, length))
         data = bytearray()
-        cmdbuf = b"\x03"
-        toread = length
-        for i in range(0, length, 512):
-            size = 512
-            if toread < size:
-                size = toread
-            tmp = self.send(cmdbuf + pack("<I", address + i) + pack("<H", size), True)
-            if tmp[1] == 0x04:
-                data.extend(tmp[6:])
-            else:
-                return b""
-            toread -= size
+        for _, chunk in self.pipelined_read(address, length, self.qc_read_request, self.qc_read_reply,
+                                            self.qc_read_chunk, adaptive=True):
+            data.extend(chunk)
+        if len(data) != length:
+            return b""
         return data
 
     def patched_memread(self, address, length):
         self.debug("memread %08X:%08X" % (address, length))
-        result = b""
-        """
-        LDR             R3, loc_2C
-        LDR             R4, loc_30
-        MOV             R0, #0x12
-        STR             R0, [R1],#4
-        ADD             R0, R3, R4
-        LDR             R2, [R3],#4
-        STR             R2, [R1],#4
-        CMP             R3, R0
-        BCC             loc_14
-        ADD             R4, R4, #4
-        BX              LR
-        """
-        readt = unhexlify("24309fe524409fe51200a0e3040081e4040083e0042093e4042081e4000053e1fbffff3a044084e21eff2fe1")
-        cmdbuf = b"\x11\x00" + readt
-        errcount = 0
-        blklen = 1000
-        for i in range(0, length, 1000):
-            tries = 20
-            if (i + 1000) > length:
-                blklen = length - i
-            iolen = 0
-            resp = self.send(cmdbuf + pack("<I", address + i) + pack("<I", blklen), True)
-            while tries > 0:
-                iolen = len(resp) - 1
-                if iolen < (blklen + 4):
-                    tries -= 1
-                    time.sleep(1)
-                    resp += self.hdlc.receive_reply_nocrc()
-                else:
-                    break
-            if tries == 0:
-                self.error(
-                    f"Error reading memory at addr {hex(address)}, {str(blklen)} bytes required, {str(iolen)} bytes "
-                    f"received.")
-                errcount += 1
-                result += b"\xeb" * blklen
-            else:
-                result += resp[5:]
-
-        if errcount > 0:
+        result = bytearray()
+        for _, chunk in self.pipelined_read(address, length, self.patched_read_request, self.patched_read_reply,
+                                            PATCHED_READ_CHUNK):
+            result.extend(chunk)
+        if len(result) != length:
             return b""
-        return result
+        return bytes(result)
 
     def mempeek(self, address):
         res = self.memread(address, 4)
@@ -344,15 +512,15 @@ class Streaming(metaclass=LogBase):
         MOV             R4, #1
         BX              LR
         """
-        writet = unhexlify(
-            "380080e224309fe524409fe5044083e0042090e4042083e4040053e1fbffff3a1200a0e30000c1e50140a0e31eff2fe1")
-        cmdbuf = b"\x11\x00" + writet
         if len(data) > 1000:
             data = data[0:1000]
             length = 1000
-        self.send(cmdbuf + pack("<I", address) + pack("<I", length) + data, True)
+        self.send(self.memwrite_request(address, data), True)
         return True
 
+    def memwrite_request(self, address, data):
+        return PATCHED_WRITE_CMD + pack("<I", address) + pack("<I", len(data)) + data
+
     def cmd_memcpy(self, destaddress, sourceaddress, size):
         data = self.memread(sourceaddress, size)
         if data != b"" and data:
@@ -381,16 +549,29 @@ class Streaming(metaclass=LogBase):
         # self.regs.NAND_FLASH_CHIP_SELECT = 0 | 4  # flash0 + undoc bit
 
     def exec_nand(self, cmd):
-        self.regs.NAND_FLASH_CMD = cmd
-        self.regs.NAND_EXEC_CMD = 1
+        with self.regs.batch():
+            self.regs.NAND_FLASH_CMD = cmd
+            self.regs.NAND_EXEC_CMD = 1
         self.nandwait()
 
+    def wait_buffer_status(self):
+        """ Polls NAND_FLASH_STATUS and NAND_BUFFER_STATUS with one read, returns the buffer status """
+        while True:
+            status = self.regs.read_words("NAND_FLASH_STATUS", 2)
+            if status is None:
+                self.nandwait()
+                return self.regs.NAND_BUFFER_STATUS
+            if status[0] & 0xF == 0:
+                return status[1]
+
     def nand_reset(self):
         self.exec_nand(1)
 
-    def tst_badblock(self):
+    def tst_badblock(self, bs=None):
         badflag = 0
-        st = self.regs.NAND_BUFFER_STATUS & 0xFFFF0000
+        if bs is None:
+            bs = self.regs.NAND_BUFFER_STATUS
+        st = bs & 0xFFFF0000
         if self.settings.IsWideFlash == 0:
             if st != 0xFF0000:
                 badflag = 1
@@ -402,10 +583,131 @@ class Streaming(metaclass=LogBase):
         self.nand_reset()
         self.set_address(block, 0)
         self.regs.NAND_FLASH_CMD = self.nanddevice.NAND_CMD_PAGE_READ_ALL
-        self.regs.NAND_FLASH_EXEC = 0x1
+        self.regs.NAND_EXEC_CMD = 0x1
         self.nandwait()
         return self.tst_badblock()
 
+    def scan_bad_blocks(self, start=0, count=None, window=BBT_SCAN_WINDOW, info=True):
+        """
+        Fills self.bbtbl for count blocks in one pipelined pass. Per block a single memwrite
+        starts the raw read of page 0 and an 8 byte read of NAND_FLASH_STATUS/NAND_BUFFER_STATUS
+        fetches the marker bytes, up to window blocks are in flight. Blocks whose reply is
+        missing or still busy are checked again one by one.
+        """
+        if count is None:
+            count = self.settings.MAXBLOCK - start
+        end = start + count
+        self.nand_reset()
+        chipselect = self.regs.NAND_FLASH_CHIP_SELECT
+        retry = []
+        pending = deque()
+        block = start
+        progbar = progress(1)
+        progbar.show_progress(prefix="Scan", pos=0, total=count, display=info)
+        self.hdlc.reset_receiver()
+        while block < end or pending:
+            while block < end and len(pending) < window:
+                address = block * self.settings.num_pages_per_blk
+                recipe = pack("<5I", self.nanddevice.NAND_CMD_PAGE_READ_ALL, (address << 16) & 0xFFFFFFFF,
+                              (address >> 16) & 0xFF, chipselect, 1)
+                self.hdlc.send_packet(self.memwrite_request(self.nanddevice.NAND_FLASH_CMD, recipe))
+                self.hdlc.send_packet(self.patched_read_request(self.nanddevice.NAND_FLASH_STATUS, 8))
+                pending.append(block)
+                block += 1
+            current = pending.popleft()
+            ack = self.hdlc.receive_reply_nocrc()
+            status = self.hdlc.receive_reply_nocrc()[5:13] if len(ack) > 1 else b""
+            if len(status) < 8 or unpack("<I", status[:4])[0] & 0xF != 0:
+                # Lost track of the replies or the controller was still busy when the blocks queued
+                # behind were started: check everything in flight separately once the link is quiet
+                retry.append(current)
+                retry.extend(pending)
+                pending.clear()
+                self.hdlc.drain_receiver()
+                continue
+            self.bbtbl[current] = self.tst_badblock(unpack("<I", status[4:8])[0])
+            progbar.show_progress(prefix="Scan", pos=current - start, total=count, display=info)
+        # The recipes bypassed the register shadow
+        self.regs.invalidate()
+        for current in retry:
+            self.bbtbl[current] = 1 if self.check_block(current) else 0
+        progbar.show_progress(prefix="Scan", pos=count, total=count, display=info)
+        return [blk for blk in range(start, end) if self.bbtbl.get(blk) == 1]
+
+    def bbt_key(self):
+        """
+        Bad block tables are stored per NAND ID and chip serial. Without a serial (the device was
+        already in streaming mode) there is no key: NAND ID and geometry are shared by every chip
+        of the type, and a table of another chip would hide this chip's factory bad blocks, so
+        the chip is scanned instead.
+        """
+        serial = getattr(self.sahara, "serial", None)
+        if serial is None:
+            return None
+        nandid = self.regs.NAND_READ_ID
+        if nandid == -1:
+            return None
+        return "%08X_%08X" % (nandid, serial)
+
+    def load_bbt(self, filename=None):
+        if filename is None:
+            filename = state_path(BBT_FILENAME)
+        key = self.bbt_key()
+        if key is None or not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, "r") as rf:
+                entry = json.load(rf).get(key)
+        except (OSError, ValueError):
+            return False
+        if entry is None or entry.get("blocks") != self.settings.MAXBLOCK:
+            return False
+        bad = set(entry.get("bad", []))
+        for block in range(entry["blocks"]):
+            self.bbtbl[block] = 1 if block in bad else 0
+        self.info(f"Loaded bad block table for {key} from {filename}: {len(bad)} bad blocks")
+        return True
+
+    def save_bbt(self, filename=None):
+        if filename is None:
+            filename = state_path(BBT_FILENAME)
+        key = self.bbt_key()
+        if key is None:
+            return False
+        tables = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as rf:
+                    tables = json.load(rf)
+            except (OSError, ValueError):
+                tables = {}
+        tables[key] = dict(blocks=self.settings.MAXBLOCK,
+                           bad=sorted(block for block, value in self.bbtbl.items() if value == 1))
+        try:
+            with open(filename, "w") as wf:
+                json.dump(tables, wf)
+        except OSError as e:
+            self.debug(f"Couldn't store bad block table {filename} => {str(e)}")
+            return False
+        return True
+
+    def prepare_bbt(self, block=0, length=None, info=True):
+        """ Makes sure self.bbtbl covers the blocks to read: cached table, else one bulk scan """
+        if self.settings.bad_processing_flag in (BadFlags.BAD_DISABLE.value, BadFlags.BAD_IGNORE.value):
+            return
+        if length is None:
+            length = self.settings.MAXBLOCK - block
+        if all(blk in self.bbtbl for blk in range(block, block + length)):
+            return
+        if self.settings.MAXBLOCK > 0:
+            if self.load_bbt():
+                return
+            bad = self.scan_bad_blocks(0, self.settings.MAXBLOCK, info=info)
+            self.info(f"Bad block scan done: {len(bad)} bad blocks")
+            self.save_bbt()
+        else:
+            self.scan_bad_blocks(block, length, info=info)
+
     """
     def check_block(self, block):
         cwperpage = (self.settings.pagesize >> 9)
@@ -439,8 +741,9 @@ class Streaming(metaclass=LogBase):
         return 0
     """
 
-    def check_ecc_status(self):
-        bs = self.regs.NAND_BUFFER_STATUS
+    def check_ecc_status(self, bs=None):
+        if bs is None:
+            bs = self.regs.NAND_BUFFER_STATUS
         if (bs & 0x100) != 0 and (self.regs.NAND_FLASH_CMD + 0xec) & 0x40 == 0:
             return -1
         return bs & 0x1f
@@ -488,56 +791,141 @@ class Streaming(metaclass=LogBase):
     """
 
     def flash_read(self, block, page, sectors, cwsize=None):
+        raw = self.read_codewords(block, page, sectors, cwsize)
+        if raw is None:
+            return bytearray(b"\xbb" * self.settings.PAGESIZE), bytearray()
+        geometry = nand_geometry(self.settings.PAGESIZE, sectors, cwsize, self.settings.UD_SIZE_BYTES,
+                                 self.settings.OOBSIZE)
+        data, spare, ecc = split_block(raw, geometry)
+        return data, spare
+
+    def page_read_cmd(self, cwsize, ecc=False):
+        """ ECC corrected reads only return the user bytes of a codeword, full codewords need PAGE_READ_ALL """
+        if self.settings.ECC_MODE == 1 and (ecc or cwsize < self.settings.sectorsize + 4):
+            return self.nanddevice.NAND_CMD_PAGE_READ_ECC
+        return self.nanddevice.NAND_CMD_PAGE_READ_ALL
+
+    def read_block_ahead(self, block, cwsize, window=None, ecc=False):
+        """
+        Reads all pages of a block as raw codewords with up to window pages queued at the loader.
+        Per page one memwrite programs command, address and exec, each codeword is fetched with
+        a status read and a buffer read, the next codeword exec is queued right behind it.
+        Pages whose status was still busy or whose replies got lost are read again one by one,
+        together with all pages queued behind them.
+        Returns None for a bad block.
+        """
+        if window is None:
+            window = self.readahead_window
+        pages = self.settings.num_pages_per_blk
+        sectors = self.settings.sectors_per_page
+        flag = self.settings.bad_processing_flag
+        if flag not in (BadFlags.BAD_DISABLE.value, BadFlags.BAD_IGNORE.value):
+            if self.bbtbl.get(block) is None:
+                self.bbtbl[block] = 1 if self.check_block(block) else 0
+            if self.bbtbl[block] == 1:
+                return None
+        cfg0 = self.regs.NAND_DEV0_CFG0
+        if flag == BadFlags.BAD_DISABLE.value:
+            self.hardware_bad_off()
+        readcmd = self.regs.NAND_FLASH_CMD
+        if flag != BadFlags.BAD_IGNORE.value:
+            self.nand_reset()
+            readcmd = self.page_read_cmd(cwsize, ecc)
+            self.bch_reset()
+        chipselect = self.regs.NAND_FLASH_CHIP_SELECT
+        execcmd = self.memwrite_request(self.nanddevice.NAND_EXEC_CMD, pack("<I", 1))
+        statusread = self.patched_read_request(self.nanddevice.NAND_FLASH_STATUS, 8)
+        bufferread = self.patched_read_request(self.nanddevice.NAND_FLASH_BUFFER, cwsize)
+
+        result = [None] * pages
+        failed = []
+        eccerrors = []
+        pending = deque()
+        page = 0
+        self.hdlc.reset_receiver()
+        while page < pages or pending:
+            while page < pages and len(pending) < window:
+                address = block * pages + page
+                recipe = pack("<5I", readcmd, (address << 16) & 0xFFFFFFFF, (address >> 16) & 0xFF, chipselect, 1)
+                self.hdlc.send_packet(self.memwrite_request(self.nanddevice.NAND_FLASH_CMD, recipe))
+                for sector in range(sectors):
+                    if sector:
+                        self.hdlc.send_packet(execcmd)
+                    self.hdlc.send_packet(statusread)
+                    self.hdlc.send_packet(bufferread)
+                pending.append(page)
+                page += 1
+            current = pending.popleft()
+            buffer = bytearray()
+            busy = False
+            insync = True
+            for sector in range(sectors):
+                ack = self.hdlc.receive_reply_nocrc()
+                status = self.hdlc.receive_reply_nocrc()[5:13] if len(ack) > 1 else b""
+                data = self.hdlc.receive_reply_nocrc()[5:] if len(status) == 8 else b""
+                if len(data) < cwsize:
+                    insync = False
+                    break
+                flashstatus, bufferstatus = unpack("<II", status)
+                if flashstatus & 0xF != 0:
+                    busy = True
+                if self.check_ecc_status(bufferstatus) == -1:
+                    eccerrors.append(current)
+                buffer.extend(data[:cwsize])
+            if insync and not busy:
+                result[current] = buffer
+                continue
+            # Replies are out of step or the controller was still busy when the pages queued behind
+            # were started, everything in flight is read again separately once the link is quiet
+            failed.append(current)
+            failed.extend(pending)
+            pending.clear()
+            self.hdlc.drain_receiver()
+        # The recipes bypassed the register shadow
+        self.regs.invalidate()
+        if eccerrors:
+            self.debug("ECC errors at block %08X pages %s" % (block, ",".join(str(pg) for pg in sorted(set(eccerrors)))))
+        if flag == BadFlags.BAD_DISABLE.value:
+            self.hardware_bad_off()
+        self.regs.NAND_DEV0_CFG0 = cfg0
+        for current in failed:
+            result[current] = self.read_codewords(block, current, sectors, cwsize, ecc)
+        return b"".join(result)
+
+    def read_codewords(self, block, page, sectors, cwsize, ecc=False):
+        """ Reads sectors codewords of cwsize bytes of a page as they are, None if the block is bad """
         buffer = bytearray()
-        spare = bytearray()
-        cursize = 0
-        newblock = False
+        recipe = []
         cfg0 = self.regs.NAND_DEV0_CFG0
-        if block not in self.bbtbl:
-            newblock = True
         if self.settings.bad_processing_flag == BadFlags.BAD_DISABLE.value:
             self.hardware_bad_off()
         elif self.settings.bad_processing_flag != BadFlags.BAD_IGNORE.value:
-            if newblock:
-                res = 0
-                if block in self.bbtbl:
-                    res = self.bbtbl[block]
-                else:
-                    if self.check_block(block):
-                        res = 1
-                    self.bbtbl[block] = res
-                if res == 1:
-                    for i in range(0, self.settings.PAGESIZE):
-                        buffer.append(0xbb)
-                    return buffer, spare
+            res = self.bbtbl.get(block)
+            if res is None:
+                res = 1 if self.check_block(block) else 0
+                self.bbtbl[block] = res
+            if res == 1:
+                return None
 
             self.nand_reset()
-            if self.settings.ECC_MODE == 1:
-                if cwsize >= self.settings.sectorsize + 4:
-                    self.regs.NAND_FLASH_CMD = self.nanddevice.NAND_CMD_PAGE_READ_ALL
-                else:
-                    self.regs.NAND_FLASH_CMD = self.nanddevice.NAND_CMD_PAGE_READ_ECC
-            else:
-                self.regs.NAND_FLASH_CMD = self.nanddevice.NAND_CMD_PAGE_READ_ALL
+            readcmd = self.page_read_cmd(cwsize, ecc)
             self.bch_reset()
+            recipe.append(("NAND_FLASH_CMD", readcmd))
 
-        self.set_address(block, page)
+        # Command, address and the first codeword exec go out as one combined register write,
+        # the chip select is only read once to fill the gap
+        address = (block * self.settings.num_pages_per_blk) + page
+        recipe += [("NAND_ADDR0", address << 16), ("NAND_ADDR1", (address >> 16) & 0xFF),
+                   ("NAND_FLASH_CHIP_SELECT", self.regs.NAND_FLASH_CHIP_SELECT), ("NAND_EXEC_CMD", 1)]
+        self.regs.sequence(recipe)
         bad_ecc = False
         for sector in range(0, sectors):
-            self.regs.NAND_EXEC_CMD = 0x1
-            self.nandwait()
-            ecc_status = self.check_ecc_status()
+            if sector:
+                self.regs.NAND_EXEC_CMD = 0x1
+            ecc_status = self.check_ecc_status(self.wait_buffer_status())
             if ecc_status == -1:
                 bad_ecc = True
-            tmp = self.memread(self.nanddevice.NAND_FLASH_BUFFER, cwsize)
-            size = self.settings.UD_SIZE_BYTES
-            if cursize + size > self.settings.PAGESIZE:
-                size = cursize + size - self.settings.PAGESIZE
-                buffer.extend(tmp[:-size])
-                spare.extend(tmp[-size:])
-            else:
-                buffer.extend(tmp)
-            cursize += size
+            buffer.extend(self.memread(self.nanddevice.NAND_FLASH_BUFFER, cwsize))
         if bad_ecc:
             self.debug("ECC error at : Block %08X Page %08X" % (block, page))
 
@@ -545,7 +933,7 @@ class Streaming(metaclass=LogBase):
             self.hardware_bad_off()
 
         self.regs.NAND_DEV0_CFG0 = cfg0
-        return buffer, spare
+        return buffer
 
     def hardware_bad_off(self):
         cfg1 = self.regs.NAND_DEV0_CFG1
@@ -762,6 +1150,7 @@ class Streaming(metaclass=LogBase):
             hp.sectorSizes = data
             hp.featureBits = resp[offset + 4 + hp.numberOfSectors * 4:offset + 4 + hp.numberOfSectors * 4 + 1]
             self.hp = hp
+            self.invalidate_regs()
             """
             self.settings.PAGESIZE=512
             self.settings.UD_SIZE_BYTES=512
@@ -888,23 +1277,12 @@ class Streaming(metaclass=LogBase):
     def memtofile(self, offset, length, filename, info=True):
         old = 0
         pos = 0
-        toread = length
         progbar = progress(1)
         progbar.show_progress(prefix="Read", pos=0, total=length, display=info)
         with open(filename, "wb") as wf:
-            while toread > 0:
-                size = 0x20000
-                if self.streaming_mode == self.Qualcomm:
-                    size = 0x200
-                if toread < size:
-                    size = toread
-                data = self.memread(offset + pos, size)
-                if data != b"":
-                    wf.write(data)
-                else:
-                    break
-                toread -= size
-                pos += size
+            for _, data in self.memread_iter(offset, length):
+                wf.write(data)
+                pos += len(data)
                 progbar.show_progress(prefix="Read", pos=pos, total=length, display=info)
                 if info:
                     prog = round(float(pos) / float(length) * float(100), 1)
@@ -915,85 +1293,64 @@ class Streaming(metaclass=LogBase):
         progbar.show_progress(prefix="Read", pos=length, total=length, display=info)
         return True
 
-    def read_blocks(self, fw, block, length, cwsize, savespare=False, info=True):
+    def read_blocks(self, fw, block, length, cwsize, savespare=False, info=True, layout=LAYOUT_RAW, ecc=False):
+        """
+        Dumps length blocks starting at block to fw. Every block is read as raw codewords (or their
+        ECC corrected user bytes with ecc) and split into data, spare and ecc in one go by the layout writer.
+        """
         badblocks = 0
-        old = 0
         pos = 0
+        pages = self.settings.num_pages_per_blk
         progbar = progress(1)
-        totallength = length * self.settings.num_pages_per_blk * self.settings.PAGESIZE
+        totallength = length * pages * self.settings.PAGESIZE
         progbar.show_progress(prefix="Read", pos=pos, total=totallength, display=info)
+        self.prepare_bbt(block, length, info)
+        writer = layout_writer(fw, nand_geometry.from_settings(self.settings, cwsize), layout, savespare)
 
         for curblock in range(block, block + length):
-            for curpage in range(self.settings.num_pages_per_blk):
-                data, spare = self.flash_read(curblock, curpage, self.settings.sectors_per_page, cwsize)
-                pos = (curblock * self.settings.num_pages_per_blk + curpage) * self.settings.PAGESIZE
-                progbar.show_progress(prefix="Read", pos=pos, total=totallength, display=info)
-                if self.bbtbl[curblock] != 1 or (self.settings.bad_processing_flag != BadFlags.BAD_SKIP.value):
-                    fw.write(data)
-                    if savespare:
-                        fw.write(spare)
-            else:
+            if self.bbtbl.get(curblock) == 1:
                 self.debug("Bad block at block %d" % curblock)
                 badblocks += 1
-            pos += self.settings.PAGESIZE
+                if self.settings.bad_processing_flag == BadFlags.BAD_SKIP.value:
+                    continue
+                writer.write_fill(pages)
+                continue
+            if self.readahead and self.streaming_mode == self.Patched and cwsize <= PATCHED_READ_CHUNK:
+                raw = self.read_block_ahead(curblock, cwsize, ecc=ecc)
+                if raw is not None:
+                    writer.write_block(raw)
+                    pos = (curblock - block + 1) * pages * self.settings.PAGESIZE
+                    progbar.show_progress(prefix="Read", pos=pos, total=totallength, display=info)
+                    continue
+            else:
+                raw = bytearray()
+                for curpage in range(pages):
+                    data = self.read_codewords(curblock, curpage, self.settings.sectors_per_page, cwsize, ecc)
+                    if data is None:
+                        break
+                    raw.extend(data)
+                    pos = ((curblock - block) * pages + curpage) * self.settings.PAGESIZE
+                    progbar.show_progress(prefix="Read", pos=pos, total=totallength, display=info)
+                else:
+                    writer.write_block(raw)
+                    continue
+            badblocks += 1
+            if self.settings.bad_processing_flag != BadFlags.BAD_SKIP.value:
+                writer.write_fill(pages)
 
         progbar.show_progress(prefix="Read", pos=totallength, total=totallength, display=info)
         return badblocks
 
-    """
-    def read_blocks_ext(self, fw, block, length, yaffsmode, info=True):
-        buffer = bytearray()
-        badblocks = 0
-        pos = 0
-        old = 0
-        totallength = length * self.settings.num_pages_per_blk * self.settings.PAGESIZE
-        if info:
-            print_progress(0, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-        for curblock in range(block, block + length):
-            for page in range(0, self.settings.num_pages_per_blk):
-                tmp, spare = self.flash_read(block, page, self.settings.sectors_per_page, self.settings.sectorsize + 4)
-                buffer.extend(tmp)
-                if info:
-                    prog = int(float(pos) / float(totallength) * float(100))
-                    if prog > old:
-                        print_progress(prog, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-                        old = prog
-
-            if self.bbtbl[block] == 1 and (self.settings.bad_processing_flag != BadFlags.BAD_SKIP.value):
-                print("Bad block at block %d" % curblock)
-                badblocks += 1
-            else:
-                for page in range(0, self.settings.num_pages_per_blk):
-                    pgoffset = page * self.settings.sectors_per_page * (self.settings.sectorsize + 4)
-                    for sec in range(0, self.settings.sectors_per_page):
-                        udoffset = pgoffset + sec * (self.settings.sectorsize + 4)
-                        if sec != (self.settings.sectors_per_page - 1):
-                            fw.write(buffer[udoffset:udoffset + self.settings.sectorsize - 4])
-                        else:
-                            fw.write(buffer[udoffset:udoffset + self.settings.sectorsize - 4 * (
-                                    self.settings.sectors_per_page - 1)])
-
-                    if yaffsmode == 1:
-                        extbuf = bytearray()
-                        soff = pgoffset + (self.settings.sectorsize + 4) * (self.settings.sectors_per_page - 1) + (
-                                self.settings.sectorsize - 4 * (self.settings.sectors_per_page - 1))
-                        extbuf.extend(buffer[soff])
-                        for i in range(0, self.settings.OOBSIZE):
-                            extbuf.append(0xff)
-                        fw.write(extbuf)
-        return badblocks
-    """
-
     def read_raw(self, start, length, cwsize, filename):
         with open(filename, 'wb') as fw:
-            if self.settings.rflag == 0:  # normal
-                self.read_blocks(fw, start, length, cwsize)
-            """
-            elif self.settings.rflag == 1:  # linux
-                self.read_blocks_ext(fw, start, length, 0)  # Fixme
-            elif self.settings.rflag == 2:  # yaffs
-                self.read_blocks_ext(fw, start, length, 1)  # Fixme
-            """
+            if self.settings.rflag == LAYOUT_RAW:
+                return self.read_blocks(fw, start, length, cwsize)
+            # linux / yaffs2 layouts are built from ECC corrected reads, which return the user bytes
+            # (page data and free oob) of each codeword, like the Linux MTD driver sees them
+            if self.settings.ECC_MODE != 1:
+                self.warning("ECC is disabled on the controller, the nand layout data is not corrected")
+            return self.read_blocks(fw, start, length, self.settings.UD_SIZE_BYTES, layout=self.settings.rflag,
+                                    ecc=True)
 
     def send(self, cmd, nocrc=False):
         if self.hdlc is not None:
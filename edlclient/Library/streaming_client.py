@@ -11,13 +11,15 @@ import logging
 from binascii import hexlify, unhexlify
 from struct import unpack, pack
 from edlclient.Library.streaming import Streaming
-from edlclient.Library.utils import do_tcp_server, LogBase, getint
+from edlclient.Library.nandlayout import layout_mode
+from edlclient.Library.rpc_server import rpc_server
+from edlclient.Library.utils import LogBase, getint
 
 
 class streaming_client(metaclass=LogBase):
     def __init__(self, arguments, cdc, sahara, loglevel, printer):
         self.cdc = cdc
-        self.__logger = self.__logger
+        self.__logger = self._logger
         self.sahara = sahara
         self.arguments = arguments
         self.streaming = Streaming(cdc, sahara, loglevel)
@@ -67,6 +69,14 @@ class streaming_client(metaclass=LogBase):
             self.printer(
                 f"{name}\t%08X\t%08X\t{hex(attr1)}/{hex(attr2)}/{hex(attr3)}\t{which_flash}" % (offset, length))
 
+    def set_nandlayout(self, options):
+        try:
+            self.streaming.settings.rflag = layout_mode(options.get("--nandlayout"))
+        except ValueError as e:
+            self.error(str(e))
+            return False
+        return True
+
     def handle_streaming(self, cmd, options):
         mode = 0
         """
@@ -81,6 +91,8 @@ class streaming_client(metaclass=LogBase):
         if "<mode>" in options:
             mode = options["<mode>"]
         if self.streaming.connect(mode):
+            # A server session reuses the client across jobs, don't trust register values of the last one
+            self.streaming.invalidate_regs()
             xflag = 0
             self.streaming.hdlc.receive_reply(5)
             if self.streaming.streaming_mode == self.streaming.Patched:
@@ -104,6 +116,8 @@ class streaming_client(metaclass=LogBase):
             elif cmd == "r":
                 partitionname = options["<partitionname>"]
                 filename = options["<filename>"]
+                if not self.set_nandlayout(options):
+                    return
                 filenames = filename.split(",")
                 partitions = partitionname.split(",")
                 if len(partitions) != len(filenames):
@@ -143,6 +157,8 @@ class streaming_client(metaclass=LogBase):
                     self.printer(f"Dumped sector {str(sector)} with sector count {str(sectors)} as {filename}.")
             elif cmd == "rl":
                 directory = options["<directory>"]
+                if not self.set_nandlayout(options):
+                    return
                 if options["--skip"]:
                     skip = options["--skip"].split(",")
                 else:
@@ -452,7 +468,7 @@ class streaming_client(metaclass=LogBase):
                 return False
             ###############################
             elif cmd == "server":
-                return do_tcp_server(self, options, self.handle_streaming)
+                return rpc_server(self, options, self.handle_streaming, self.__logger.level).run()
             elif cmd == "modules":
                 if not self.check_param(["<command>", "<options>"]):
                     return False
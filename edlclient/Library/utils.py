@@ -24,11 +24,11 @@ import colorama
 try:
     from capstone import *
 except ImportError:
-    print("Capstone library is missing (optional).")
+    print("Capstone library is missing (optional).", file=sys.stderr)
 try:
     from keystone import *
 except ImportError:
-    print("Keystone library is missing (optional).")
+    print("Keystone library is missing (optional).", file=sys.stderr)
 
 
 def is_windows():
@@ -255,54 +255,6 @@ class structhelper:
         self.pos = pos
 
 
-def do_tcp_server(client, arguments, handler):
-    def tcpprint(arg):
-        if isinstance(arg, bytes) or isinstance(arg, bytearray):
-            return connection.sendall(arg)
-        else:
-            return connection.sendall(bytes(str(arg), 'utf-8'))
-
-    client.printer = tcpprint
-    import socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    port = int(arguments["--tcpport"])
-    server_address = ('localhost', port)
-    print('starting up on %s port %s' % server_address)
-    sock.bind(server_address)
-    sock.listen(1)
-    response = None
-    while True:
-        print('waiting for a connection')
-        connection, client_address = sock.accept()
-        try:
-            print('connection from', client_address)
-            while True:
-                data = connection.recv(4096).decode('utf-8')
-                if data == '':
-                    break
-                print('received %s' % data)
-                if data:
-                    print('handling request')
-                    lines = data.split("\n")
-                    for line in lines:
-                        if ":" in line:
-                            cmd = line.split(":")[0]
-                            marguments = line.split(":")[1]
-                            try:
-                                opts = parse_args(cmd, marguments, arguments)
-                            except:
-                                response = "Wrong arguments\n<NAK>\n"
-                                opts = None
-                            if opts is not None:
-                                if handler(cmd, opts):
-                                    response = "<ACK>\n"
-                                else:
-                                    response = "<NAK>\n"
-                            connection.sendall(bytes(response, 'utf-8'))
-        finally:
-            connection.close()
-
-
 def parse_args(cmd, args, mainargs):
     options = {}
     opts = None
@@ -469,6 +421,30 @@ class LogBase(type):
         setattr(cls, logger_debuglevel_name, cls.debuglevel)
 
 
+def console_to_stderr():
+    """
+    Sends all text output (print, logging, progress bars) to stderr, so that stdout only carries
+    the binary data of a dump to "-". Use binary_stdout() for the data itself.
+    """
+    sys.stdout = sys.stderr
+    loggers = [logging.getLogger()] + [logger for logger in logging.root.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is sys.__stdout__:
+                handler.setStream(sys.stderr)
+
+
+def binary_stdout():
+    """ The real stdout as binary stream, also after console_to_stderr() """
+    return sys.__stdout__.buffer
+
+
+def state_path(filename):
+    """ Files the tool keeps between runs (loader index, bad block tables) live in the Loaders directory """
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "..", "Loaders", filename)
+
+
 def del_rw(action, name, exc):
     os.chmod(name, stat.S_IWRITE)
     os.remove(name)
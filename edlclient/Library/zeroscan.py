@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# (c) B.Kerler 2018-2024 under GPLv3 license
+# If you use my code, make sure you refer to my name
+#
+# !!!!! If you use this code in commercial products, your product is automatically
+# GPLv3 and has to be open sourced under GPLv3 as well. !!!!!
+
+import os
+
+SCAN_CHUNK_SIZE = 0x100000
+FILL_THRESHOLD = 0x100000
+
+
+def host_data_regions(rf, size):
+    """ Data regions of a sparse host file via SEEK_DATA/SEEK_HOLE, holes read back as zeros """
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+    try:
+        fd = rf.fileno()
+        regions = []
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError:
+                # ENXIO: no more data until eof
+                break
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            regions.append((start, end - start))
+            pos = end
+        return regions
+    except (OSError, AttributeError, ValueError):
+        return [(0, size)]
+    finally:
+        rf.seek(0)
+
+
+def fill_runs_in(data, base, blocksize, fillblock):
+    """ Yields (offset, length) of blocksize aligned fill runs inside data """
+    view = memoryview(data)
+    length = len(data) - len(data) % blocksize
+    if data.count(fillblock[:1], 0, length) == length:
+        if length:
+            yield base, length
+        return
+    start = None
+    for pos in range(0, length, blocksize):
+        if view[pos:pos + blocksize] == fillblock:
+            if start is None:
+                start = pos
+        elif start is not None:
+            yield base + start, pos - start
+            start = None
+    if start is not None:
+        yield base + start, length - start
+
+
+def scan_extents(rf, size, blocksize=4096, threshold=FILL_THRESHOLD, fill=0):
+    """
+    Splits an image into data and fill runs. Returns a list of
+    [offset, length, isfill] sorted by offset, covering the whole image.
+    Fill runs shorter than threshold are kept as data.
+    """
+    fillblock = bytes([fill]) * blocksize
+    chunksize = max(SCAN_CHUNK_SIZE - SCAN_CHUNK_SIZE % blocksize, blocksize)
+    runs = []
+
+    def addfill(offset, length):
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1][1] += length
+        else:
+            runs.append([offset, length])
+
+    pos = 0
+    for start, length in host_data_regions(rf, size):
+        offset = max(pos, start - start % blocksize)
+        if fill == 0 and offset > pos:
+            # Holes of the host file read back as zeros
+            addfill(pos, offset - pos)
+        end = start + length
+        end += (-end) % blocksize
+        rf.seek(offset)
+        while offset < end:
+            data = rf.read(min(chunksize, end - offset))
+            if not data:
+                break
+            for roffset, rlength in fill_runs_in(data, offset, blocksize, fillblock):
+                addfill(roffset, rlength)
+            offset += len(data)
+        pos = offset
+    tail = size - size % blocksize
+    if fill == 0 and tail > pos:
+        addfill(pos, tail - pos)
+    rf.seek(0)
+
+    extents = []
+    pos = 0
+    for offset, length in runs:
+        if length < threshold:
+            continue
+        if offset > pos:
+            extents.append([pos, offset - pos, False])
+        extents.append([offset, length, True])
+        pos = offset + length
+    if pos < size:
+        extents.append([pos, size - pos, False])
+    return extents
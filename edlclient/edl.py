@@ -14,16 +14,17 @@ Usage:
     edl [--debugmode] [--port_name=port_name] [--serial]
     edl [--gpt-num-part-entries=number] [--gpt-part-entry-size=number] [--gpt-part-entry-start-lba=number] [--port_name=port_name] [--serial]
     edl [--memory=memtype] [--skipstorageinit] [--maxpayload=bytes] [--sectorsize==bytes] [--port_name=port_name] [--serial]
-    edl server [--tcpport=portnumber] [--loader=filename] [--debugmode] [--skipresponse] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial]  [--devicemodel=value]
-    edl memorydump [--partitions=partnames] [--debugmode] [--vid=vid] [--pid=pid] [--port_name=port_name] [--serial] [--serial_number=serial_number]
+    edl server [--tcpport=portnumber] [--unixsocket=path] [--loader=filename] [--debugmode] [--skipresponse] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial]  [--devicemodel=value]
+    edl nbd [--lun=lun] [--socket=path] [--cachesize=bytes] [--blocksize=bytes] [--skipwrite] [--memory=memtype] [--sectorsize==bytes] [--loader=filename] [--debugmode] [--skipresponse] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
+    edl memorydump [--partitions=partnames] [--memrange=ranges] [--dumpcompress=method] [--elfcore=filename] [--debugmode] [--vid=vid] [--pid=pid] [--port_name=port_name] [--serial] [--serial_number=serial_number]
     edl printgpt [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--loader=filename] [--debugmode]  [--skipresponse] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
     edl gpt <directory> [--memory=memtype] [--lun=lun] [--genxml] [--loader=filename]  [--skipresponse] [--debugmode] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
-    edl r <partitionname> <filename> [--memory=memtype] [--sectorsize==bytes] [--lun=lun] [--loader=filename]  [--skipresponse] [--debugmode] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
-    edl rl <directory> [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--skip=partnames] [--genxml]  [--skipresponse] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
+    edl r <partitionname> <filename> [--allocated] [--nandlayout=layout] [--memory=memtype] [--sectorsize==bytes] [--lun=lun] [--loader=filename]  [--skipresponse] [--debugmode] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
+    edl rl <directory> [--allocated] [--nandlayout=layout] [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--skip=partnames] [--genxml]  [--skipresponse] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
     edl rf <filename> [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--loader=filename] [--debugmode]  [--skipresponse] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
     edl rs <start_sector> <sectors> <filename> [--lun=lun] [--sectorsize==bytes] [--memory=memtype] [--loader=filename] [--debugmode] [--skipresponse] [--vid=vid] [--pid=pid] [--skipstorageinit] [--port_name=port_name] [--serial] [--devicemodel=value]
-    edl w <partitionname> <filename> [--partitionfilename=filename] [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--skipwrite] [--skipresponse] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid] [--devicemodel=value] [--skipstorageinit] [--port_name=port_name] [--serial]
-    edl wl <directory> [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--skip=partnames] [--skipresponse] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid] [--devicemodel=value] [--skipstorageinit] [--port_name=port_name] [--serial]
+    edl w <partitionname> <filename> [--partitionfilename=filename] [--skipzero] [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--skipwrite] [--skipresponse] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid] [--devicemodel=value] [--skipstorageinit] [--port_name=port_name] [--serial]
+    edl wl <directory> [--skipzero] [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--skip=partnames] [--skipresponse] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid] [--devicemodel=value] [--skipstorageinit] [--port_name=port_name] [--serial]
     edl wf <filename> [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--loader=filename] [--skipresponse] [--debugmode] [--vid=vid] [--pid=pid] [--devicemodel=value] [--skipstorageinit] [--port_name=port_name] [--serial]
     edl ws <start_sector> <filename> [--memory=memtype] [--lun=lun] [--sectorsize==bytes] [--skipwrite] [--skipresponse] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid] [--devicemodel=value] [--skipstorageinit] [--port_name=port_name] [--serial]
     edl e <partitionname> [--memory=memtype] [--skipwrite] [--lun=lun] [--sectorsize==bytes] [--loader=filename] [--debugmode] [--skipresponse] [--vid=vid] [--pid=pid] [--devicemodel=value] [--skipstorageinit] [--port_name=port_name] [--serial]
@@ -57,17 +58,18 @@ Usage:
     edl qfil <rawprogram> <patch> <imagedir> [--loader=filename] [--memory=memtype] [--debugmode] [--skipresponse] [--vid=vid] [--pid=pid] [--port_name=port_name] [--serial]  [--devicemodel=value]
 
 Description:
-    server                      # Run tcp/ip server
+    server                      # Run tcp/ip or unix socket job server
+    nbd                         # Export lun as network block device on a unix socket
     printgpt                    # Print GPT Table information
     gpt                         # Save gpt table to given directory
-    r                           # Read flash to filename
+    r                           # Read flash to filename ("-" writes to stdout)
     rl                          # Read all partitions from flash to a directory
     rf                          # Read whole flash to file
-    rs                          # Read sectors starting at start_sector to filename
-    w                           # Write filename to partition to flash
+    rs                          # Read sectors starting at start_sector to filename ("-" writes to stdout)
+    w                           # Write filename to partition to flash ("-" reads from stdin)
     wl                          # Write all files from directory to flash
     wf                          # Write whole filename to flash
-    ws                          # Write filename to flash at start_sector
+    ws                          # Write filename to flash at start_sector ("-" reads from stdin)
     e                           # Erase partition from flash
     es                          # Erase sectors at start_sector from flash
     ep                          # Erase sector count from flash partition
@@ -118,8 +120,18 @@ Options:
     --gpt-part-entry-size=number       Set GPT entry size [default: 0]
     --gpt-part-entry-start-lba=number  Set GPT entry start lba sector [default: 0]
     --tcpport=portnumber               Set port for tcp server [default: 1340]
+    --unixsocket=path                  Serve on unix socket path instead of tcp port
+    --socket=path                      Set unix socket path for nbd server [default: /tmp/edl-nbd.sock]
+    --cachesize=bytes                  Set block cache size for nbd server [default: 0x2000000]
+    --blocksize=bytes                  Set block cache block size for nbd server [default: 0x4000]
     --skip=partnames                   Skip reading partition with names "partname1,partname2,etc."
     --genxml                           Generate rawprogram[lun].xml
+    --allocated                        Dump only allocated blocks of ext4/f2fs partitions as sparse image
+    --skipzero                         Erase instead of program large zero (NAND: 0xFF) runs of raw images
+    --nandlayout=layout                Output layout of streaming NAND dumps (raw, linux, yaffs2 are ECC corrected)
+    --memrange=ranges                  Only dump memory in "start-end,start+length,etc." of memorydump regions
+    --dumpcompress=method              Compress memorydump regions (gzip, xz, bz2, zstd)
+    --elfcore=filename                 Write all memorydump regions to a single ELF core file (ELF32 on 32-bit)
     --devicemodel=value                Set device model
     --port_name=port_name                Set serial port name (/dev/ttyUSB0 for Linux/MAC; \\\\.\\COM1 for Windows)
     --serial                           Use serial port (port autodetection)
@@ -137,12 +149,14 @@ import time
 from edlclient.Config.usb_ids import default_ids
 from edlclient.Library.Connection.seriallib import SerialDevice
 from edlclient.Library.Connection.usblib import USBClass # TODO: At here
+from edlclient.Library.compressed import check_compressed_writer
 from edlclient.Library.firehose_client import firehose_client
+from edlclient.Library.ramdump import parse_ranges
 from edlclient.Library.sahara import sahara
 from edlclient.Library.sahara_defs import cmd_t, sahara_mode_t
 from edlclient.Library.streaming import Streaming
 from edlclient.Library.streaming_client import streaming_client
-from edlclient.Library.utils import LogBase
+from edlclient.Library.utils import LogBase, console_to_stderr
 from edlclient.Library.utils import is_windows
 from edlclient.Tools import null
 
@@ -185,20 +199,20 @@ class EDL(metaclass=LogBase):
         self.args = args
         self.fh = None
 
-    def _print(self, *args, sep=' ', end='\n', file=sys.stdout, flush=False) -> None:
+    def _print(self, *args, sep=' ', end='\n', file=None, flush=False) -> None:
         """ 自定义输出函数，根据enabled_print来决定是否输出
 
         Args:
             *args: 输出内容
             sep = ' ': 分隔符
             end = '\n': 结尾符
-            file = sys.stdout: 输出目标
+            file = None: 输出目标，None表示当前的sys.stdout（数据输出到"-"时为stderr）
             flush = False: 是否强制刷新缓冲区
 
         """
 
         if self.enabled_print:
-            print(*args, sep=sep, end=end, file=file, flush=flush)
+            print(*args, sep=sep, end=end, file=sys.stdout if file is None else file, flush=flush)
 
     def _stdout_write(self, text: str) -> int:
         """ sys.stdout.write函数改进版，根据enabled_print来决定是否输出
@@ -240,7 +254,7 @@ class EDL(metaclass=LogBase):
             return []
 
         parsed_cmd = []
-        cmds = ["server", "printgpt", "gpt", "r", "rl", "rf", "rs", "w", "wl", "wf", "ws", "e", "es", "ep", "footer",
+        cmds = ["server", "nbd", "printgpt", "gpt", "r", "rl", "rf", "rs", "w", "wl", "wf", "ws", "e", "es", "ep", "footer",
                 "peek", "peekhex", "peekdword", "peekqword", "memtbl", "poke", "pokehex", "pokedword", "pokeqword",
                 "memcpy", "secureboot", "pbl", "qfp", "getstorageinfo", "setbootablestoragedrive", "getactiveslot",
                 "setactiveslot",
@@ -354,6 +368,31 @@ class EDL(metaclass=LogBase):
         else:
             sys.exit(status)
 
+    def next_loader(self, version: int) -> str:
+        """ 上传的loader没有响应时，重置设备并上传下一个候选loader
+
+        Args:
+            version (int): Sahara协议版本
+
+        Return:
+            str: 上传成功返回 "firehose"，没有候选loader、设备未回到sahara模式或上传失败时返回 "error"
+
+        """
+
+        if not self.sahara.loader_candidates:
+            return "error"
+        self.sahara.programmer = self.sahara.loader_candidates.pop(0)
+        self.info(f"Loader didn't answer, resetting device and trying next loader: {self.sahara.programmer}")
+        self.cdc.close(reset=True)
+        self.cdc.timeout = 1500
+        if self.connect(0)["mode"] != "sahara" or self.sahara.cmd_info(version=version) is None:
+            return "error"
+        if self.sahara.connect()["mode"] != "sahara":
+            return "error"
+        mode = self.sahara.upload_ranked_loader(version=version)
+        self.cdc.timeout = None
+        return mode if mode == "firehose" else "error"
+
     def run(self) -> int:
         """ 主执行方法，处理EDL设备连接、协议协商和命令执行
         
@@ -367,6 +406,18 @@ class EDL(metaclass=LogBase):
             if re.findall(r'QCUSB', str(proper_driver)):
                 self.warning(f'Please first install libusb_win32 driver from Zadig')
 
+        if "-" in str(self.args.get("<filename>") or "").split(","):
+            # stdout carries the dump, everything else goes to stderr
+            console_to_stderr()
+
+        # Memory dump options are checked before the device gets switched into memory debug mode
+        try:
+            memranges = parse_ranges(self.args["--memrange"])
+            check_compressed_writer(self.args["--dumpcompress"])
+        except (ValueError, IOError) as err:
+            self.error(str(err))
+            return self.exit(1, cdc_close=False)
+
         loop = 0
         vid = int(self.args["--vid"], 16)
         pid = int(self.args["--pid"], 16)
@@ -433,10 +484,11 @@ class EDL(metaclass=LogBase):
                         if self.args["memorydump"] or self.cdc.pid == 0x900E:
                             time.sleep(0.5)
                             self._print("Device is in memory dump mode, dumping memory")
-                            if self.args["--partitions"]:
-                                self.sahara.debug_mode(self.args["--partitions"].split(","), version=version)
-                            else:
-                                self.sahara.debug_mode(version=version)
+                            partitions = self.args["--partitions"].split(",") if self.args["--partitions"] else None
+                            self.sahara.debug_mode(partitions, version=version,
+                                                   ranges=memranges,
+                                                   compress=self.args["--dumpcompress"],
+                                                   elfcore=self.args["--elfcore"])
                             return self.exit()
                         else:
                             self._print("Device is in streaming mode, uploading loader")
@@ -469,7 +521,7 @@ class EDL(metaclass=LogBase):
                             if "data" in resp:
                                 data = resp["data"]
                             if mode == "sahara":
-                                mode = self.sahara.upload_loader(version=version)
+                                mode = self.sahara.upload_ranked_loader(version=version)
                         else:
                             self._print("Error on sahara handshake, resetting.")
                             self.sahara.cmd_reset()
@@ -480,19 +532,24 @@ class EDL(metaclass=LogBase):
         if mode == "error":
             self._print("Connection detected, quiting.")
             return self.exit(1)
-        elif mode == "firehose":
+        while mode == "firehose":
             if "enprg" in self.sahara.programmer.lower():
                 mode = "enandprg"
             elif "nprg" in self.sahara.programmer.lower():
                 mode = "nandprg"
-            if mode != "firehose":
-                streaming = Streaming(self.cdc, self.sahara, self._logger.level)
-                if streaming.connect(1):
-                    self._print("Successfully uploaded programmer :)")
-                    mode = "nandprg"
-                else:
-                    self._print("No suitable loader found :(")
-                    return self.exit()
+            if mode == "firehose":
+                break
+            streaming = Streaming(self.cdc, self.sahara, self._logger.level)
+            if streaming.connect(1):
+                self.sahara.record_loader_outcome(True)
+                self._print("Successfully uploaded programmer :)")
+                mode = "nandprg"
+                break
+            self.sahara.record_loader_outcome(False)
+            mode = self.next_loader(version)
+            if mode == "error":
+                self._print("No suitable loader found :(")
+                return self.exit()
         if mode != "firehose":
             sc = streaming_client(self.args, self.cdc, self.sahara, self._logger.level, self._print)
             cmd = self.parse_cmd(self.args)
@@ -510,15 +567,19 @@ class EDL(metaclass=LogBase):
                 self.args["--skipstorageinit"] = 1
             self.fh = firehose_client(self.args, self.cdc, self.sahara, self._logger.level, self._print)
             options = self.parse_option(self.args)
-            if cmd != "" or self.imported:
+            while cmd != "" or self.imported:
                 self.info("Trying to connect to firehose loader ...")
                 if self.fh.connect(sahara):
+                    self.sahara.record_loader_outcome(True)
                     if self.imported:
                         return self.exit(cdc_close=False)
                     elif not self.fh.handle_firehose(cmd, options):
                         return self.exit(1)
-                else:
+                    break
+                self.sahara.record_loader_outcome(False)
+                if self.next_loader(version) != "firehose":
                     return self.exit(1)
+                self.fh = firehose_client(self.args, self.cdc, self.sahara, self._logger.level, self._print)
 
 if __name__ == "__main__":
     edl = EDL('test')
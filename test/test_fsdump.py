@@ -0,0 +1,117 @@
+# Dumps small ext4/f2fs images built with the mkfs tools and checks that the sparse
+# output expands to the partition byte for byte, skipped if the tools are missing
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+from edlclient.Library.firehose import response
+from edlclient.Library.fsdump import fsdump
+from edlclient.Library.sparse import sparse_stream_reader
+
+SECTOR_SIZE = 4096
+IMAGE_SIZE = 64 * 1024 * 1024
+
+
+class memory_firehose:
+    """ The firehose calls fsdump uses, backed by an image file """
+
+    class cfg:
+        SECTOR_SIZE_IN_BYTES = SECTOR_SIZE
+        MaxPayloadSizeToTargetInBytes = 0x100000
+
+    def __init__(self, image):
+        with open(image, "rb") as rf:
+            self.disk = rf.read()
+
+    def cmd_read_buffer(self, lun, start_sector, sectors, display=True):
+        return response(True, self.disk[start_sector * SECTOR_SIZE:(start_sector + sectors) * SECTOR_SIZE])
+
+
+def populate(directory):
+    """ Files of different sizes, some of them deleted again so the free space is fragmented """
+    os.makedirs(os.path.join(directory, "sub"))
+    for idx in range(40):
+        with open(os.path.join(directory, "sub" if idx % 3 else "", f"file{idx}"), "wb") as wf:
+            wf.write(os.urandom(1000 + idx * 37000))
+
+
+def run(cmd):
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def check_dump(image):
+    fh = memory_firehose(image)
+    out = image + ".sparse"
+    assert fsdump(fh).dump(0, 0, len(fh.disk) // SECTOR_SIZE, out, display=False)
+    with open(out, "rb") as rf:
+        reader = sparse_stream_reader(rf)
+        assert reader.readheader()
+        assert reader.getsize() == len(fh.disk)
+        data = reader.read(reader.getsize())
+    assert data == fh.disk
+    # Free space has to be left out, otherwise the test proves nothing
+    assert os.path.getsize(out) < len(fh.disk)
+
+
+def make_image(directory, size=IMAGE_SIZE):
+    image = os.path.join(directory, "part.img")
+    with open(image, "wb") as wf:
+        wf.truncate(size)
+    return image
+
+
+@pytest.mark.skipif(shutil.which("mkfs.ext4") is None, reason="mkfs.ext4 not available")
+# 160 groups with 32 byte descriptors need two metagroups, the second one lives in group 128
+@pytest.mark.parametrize("options,size", [([], IMAGE_SIZE),
+                                          (["-O", "meta_bg,^resize_inode,^64bit", "-g", "256"], 160 * 1024 * 1024)],
+                         ids=["default", "meta_bg"])
+def test_ext4_allocated_dump(options, size):
+    directory = tempfile.mkdtemp()
+    populate(os.path.join(directory, "root"))
+    image = make_image(directory, size)
+    run(["mkfs.ext4", "-q", "-F", "-b", "4096", "-E", "nodiscard"] + options +
+        ["-d", os.path.join(directory, "root"), image])
+    check_dump(image)
+
+
+@pytest.mark.skipif(shutil.which("mkfs.f2fs") is None or shutil.which("sload.f2fs") is None,
+                    reason="f2fs-tools not available")
+@pytest.mark.parametrize("options", [[], ["-i"]], ids=["default", "large_nat_bitmap"])
+def test_f2fs_allocated_dump(options):
+    directory = tempfile.mkdtemp()
+    populate(os.path.join(directory, "root"))
+    image = make_image(directory)
+    run(["mkfs.f2fs", "-q", "-f"] + options + [image])
+    run(["sload.f2fs", "-f", os.path.join(directory, "root"), image])
+    check_dump(image)
+
+
+def test_f2fs_sit_bitmap_layout():
+    """ Offsets of the SIT version bitmap as in the kernel's __bitmap_ptr() """
+    from struct import pack_into
+    from edlclient.Library.fsdump import CP_LARGE_NAT_BITMAP_FLAG, f2fs_allocation
+
+    alloc = f2fs_allocation.__new__(f2fs_allocation)
+    alloc.blocksize = 4096
+    alloc.cp_payload = 0
+    cp = bytearray(4096)
+    pack_into("<II", cp, 156, 8, 16)  # sit_ver_bitmap_bytesize, nat_ver_bitmap_bytesize
+    cp[192:192 + 8] = b"S" * 8
+    cp[192 + 8:192 + 8 + 16] = b"N" * 16
+    assert alloc.sit_bitmap(bytes(cp)) == b"S" * 8
+
+    cp = bytearray(4096)
+    pack_into("<I", cp, 132, CP_LARGE_NAT_BITMAP_FLAG)
+    pack_into("<II", cp, 156, 8, 16)
+    cp[192 + 4:192 + 4 + 16] = b"N" * 16
+    cp[192 + 4 + 16:192 + 4 + 16 + 8] = b"S" * 8
+    assert alloc.sit_bitmap(bytes(cp)) == b"S" * 8
+
+    alloc.cp_payload = 1
+    cp = bytearray(8192)
+    pack_into("<II", cp, 156, 8, 16)
+    cp[4096:4096 + 8] = b"S" * 8
+    assert alloc.sit_bitmap(bytes(cp)) == b"S" * 8
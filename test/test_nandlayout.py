@@ -0,0 +1,84 @@
+# Splitting of raw NAND codewords into data/spare/ecc and the dump output layouts
+import io
+
+import pytest
+
+from edlclient.Library.nandlayout import (LAYOUT_LINUX, LAYOUT_RAW, LAYOUT_YAFFS2, layout_mode, layout_writer,
+                                          nand_geometry, split_block)
+
+PAGESIZE = 2048
+SECTORS = 4
+CWSIZE = 528
+UDSIZE = 516
+OOBSIZE = 64
+
+
+def make_page(page):
+    """ Returns (raw codewords, data, spare, ecc) of a page with distinct bytes in every part """
+    data = bytes((page * 7 + idx) & 0xFF for idx in range(PAGESIZE))
+    spare = bytes([0xA0 + page]) * (SECTORS * UDSIZE - PAGESIZE)
+    user = data + spare
+    ecc = b""
+    raw = b""
+    for cw in range(SECTORS):
+        cwecc = bytes([0xE0 + cw]) * (CWSIZE - UDSIZE)
+        raw += user[cw * UDSIZE:(cw + 1) * UDSIZE] + cwecc
+        ecc += cwecc
+    return raw, data, spare, ecc
+
+
+def make_pages(count):
+    pages = [make_page(page) for page in range(count)]
+    return [b"".join(part[idx] for part in pages) for idx in range(4)]
+
+
+def test_split_block():
+    geometry = nand_geometry(PAGESIZE, SECTORS, CWSIZE, UDSIZE, OOBSIZE)
+    assert geometry.userpage == SECTORS * UDSIZE and geometry.sparesize == 16
+    raw, data, spare, ecc = make_pages(3)
+    assert split_block(raw, geometry) == (data, spare, ecc)
+
+
+def test_split_block_user_bytes_only():
+    """ ECC corrected reads return just the user bytes of every codeword """
+    raw, data, spare, _ = make_pages(2)
+    user = b"".join(raw[pos:pos + UDSIZE] for pos in range(0, len(raw), CWSIZE))
+    geometry = nand_geometry(PAGESIZE, SECTORS, UDSIZE, UDSIZE, OOBSIZE)
+    assert split_block(user, geometry) == (data, spare, b"")
+
+
+def test_split_block_drops_partial_codeword():
+    geometry = nand_geometry(PAGESIZE, SECTORS, CWSIZE, UDSIZE, OOBSIZE)
+    raw, data, spare, ecc = make_pages(1)
+    assert split_block(raw + b"\x00" * 100, geometry) == (data, spare, ecc)
+
+
+@pytest.mark.parametrize("layout,savespare", [(LAYOUT_RAW, False), (LAYOUT_RAW, True), (LAYOUT_LINUX, True),
+                                              (LAYOUT_YAFFS2, False)])
+def test_layout_writer(layout, savespare):
+    geometry = nand_geometry(PAGESIZE, SECTORS, CWSIZE, UDSIZE, OOBSIZE)
+    fw = io.BytesIO()
+    writer = layout_writer(fw, geometry, layout, savespare)
+    raw, data, _, _ = make_pages(2)
+    writer.write_block(raw)
+    writer.write_fill(1)
+    pages = [make_page(page) for page in range(2)]
+    if layout == LAYOUT_YAFFS2:
+        expected = b"".join(page[1] + page[2] + b"\xFF" * (OOBSIZE - len(page[2])) for page in pages)
+        expected += b"\xbb" * PAGESIZE + b"\xFF" * OOBSIZE
+    elif layout == LAYOUT_RAW and savespare:
+        expected = b"".join(page[1] + page[2] for page in pages)
+        expected += b"\xbb" * PAGESIZE + b"\xFF" * geometry.sparesize
+    else:
+        expected = data + b"\xbb" * PAGESIZE
+    assert fw.getvalue() == expected
+    assert writer.written == len(expected)
+
+
+def test_layout_mode():
+    assert layout_mode(None) == LAYOUT_RAW
+    assert layout_mode("Linux") == LAYOUT_LINUX
+    assert layout_mode("yaffs") == LAYOUT_YAFFS2
+    assert layout_mode("2") == LAYOUT_YAFFS2
+    with pytest.raises(ValueError):
+        layout_mode("jffs2")
@@ -0,0 +1,113 @@
+# Register shadow and write batching of nandregs against a fake controller, no device needed
+from struct import pack, unpack
+
+from edlclient.Library.nand_config import MAX_BATCH_WORDS, nandregs
+
+BASE = 0x79B0000
+MAPPING = {
+    "NAND_FLASH_CMD": BASE + 0x00,
+    "NAND_ADDR0": BASE + 0x04,
+    "NAND_ADDR1": BASE + 0x08,
+    "NAND_FLASH_CHIP_SELECT": BASE + 0x0C,
+    "NAND_EXEC_CMD": BASE + 0x10,
+    "NAND_FLASH_STATUS": BASE + 0x14,
+    "NAND_DEV0_CFG0": BASE + 0x20,
+    "NAND_DEV0_CFG1": BASE + 0x24,
+}
+
+
+class fake_controller:
+    """ The parent calls nandregs uses, recording every memwrite and mempeek """
+
+    def __init__(self):
+        self.memory = {}
+        self.writes = []
+        self.peeks = []
+
+    def mempeek(self, address):
+        self.peeks.append(address)
+        return self.memory.get(address, 0)
+
+    def memread(self, address, length):
+        return b"".join(pack("<I", self.memory.get(address + pos, 0)) for pos in range(0, length, 4))
+
+    def memwrite(self, address, data):
+        words = list(unpack("<%dI" % (len(data) // 4), data))
+        self.writes.append((address, words))
+        for pos, word in enumerate(words):
+            self.memory[address + pos * 4] = word
+        return True
+
+
+def make_regs(mapping=None):
+    parent = fake_controller()
+    regs = nandregs(parent)
+    regs.register_mapping = dict(MAPPING if mapping is None else mapping)
+    return parent, regs
+
+
+def test_unchanged_writes_are_suppressed():
+    parent, regs = make_regs()
+    regs.NAND_DEV0_CFG0 = 0x1234
+    regs.NAND_DEV0_CFG0 = 0x1234
+    assert parent.writes == [(MAPPING["NAND_DEV0_CFG0"], [0x1234])]
+    # Reads come from the shadow once the value is known
+    assert regs.NAND_DEV0_CFG0 == 0x1234
+    assert parent.peeks == []
+    parent.memory[MAPPING["NAND_DEV0_CFG1"]] = 0x55
+    assert regs.NAND_DEV0_CFG1 == 0x55
+    regs.NAND_DEV0_CFG1 = 0x55
+    assert parent.peeks == [MAPPING["NAND_DEV0_CFG1"]]
+    assert len(parent.writes) == 1
+    # After invalidate the value is written again
+    regs.invalidate()
+    regs.NAND_DEV0_CFG0 = 0x1234
+    assert len(parent.writes) == 2
+
+
+def test_volatile_registers_flush_immediately():
+    parent, regs = make_regs()
+    with regs.batch():
+        regs.NAND_FLASH_CMD = 0x34
+        assert parent.writes == []
+        regs.NAND_EXEC_CMD = 1
+        assert parent.writes == [(MAPPING["NAND_FLASH_CMD"], [0x34]), (MAPPING["NAND_EXEC_CMD"], [1])]
+        regs.NAND_EXEC_CMD = 1
+        assert len(parent.writes) == 3
+    parent.memory[MAPPING["NAND_FLASH_STATUS"]] = 0x20
+    assert regs.NAND_FLASH_STATUS == 0x20
+    parent.memory[MAPPING["NAND_FLASH_STATUS"]] = 0x21
+    assert regs.NAND_FLASH_STATUS == 0x21
+
+
+def test_batch_merges_and_fills_gaps():
+    parent, regs = make_regs()
+    regs.NAND_ADDR1 = 0x7
+    parent.writes.clear()
+    regs.sequence([("NAND_FLASH_CMD", 0x34), ("NAND_ADDR0", 0x10000), ("NAND_FLASH_CHIP_SELECT", 0x0),
+                   ("NAND_EXEC_CMD", 1)])
+    # NAND_ADDR1 sits between ADDR0 and CHIP_SELECT and is filled from its known value
+    assert parent.writes == [(MAPPING["NAND_FLASH_CMD"], [0x34, 0x10000, 0x7, 0x0, 1])]
+
+
+def test_batch_keeps_unknown_gaps():
+    parent, regs = make_regs()
+    with regs.batch():
+        regs.NAND_FLASH_CMD = 0x34
+        regs.NAND_FLASH_CHIP_SELECT = 0x0
+        regs.NAND_DEV0_CFG0 = 0x1
+        regs.NAND_DEV0_CFG1 = 0x2
+    assert parent.writes == [(MAPPING["NAND_FLASH_CMD"], [0x34]), (MAPPING["NAND_FLASH_CHIP_SELECT"], [0x0]),
+                             (MAPPING["NAND_DEV0_CFG0"], [0x1, 0x2])]
+    assert regs.NAND_ADDR0 == 0
+    assert parent.peeks == [MAPPING["NAND_ADDR0"]]
+
+
+def test_batch_splits_at_max_words():
+    count = MAX_BATCH_WORDS * 2 + 10
+    parent, regs = make_regs({f"REG{idx}": BASE + idx * 4 for idx in range(count)})
+    regs.sequence([(f"REG{idx}", idx + 1) for idx in range(count)])
+    assert [len(words) for _, words in parent.writes] == [MAX_BATCH_WORDS, MAX_BATCH_WORDS, 10]
+    assert [address for address, _ in parent.writes] == [BASE, BASE + MAX_BATCH_WORDS * 4,
+                                                        BASE + MAX_BATCH_WORDS * 8]
+    assert [parent.memory[BASE + idx * 4] for idx in range(count)] == list(range(1, count + 1))
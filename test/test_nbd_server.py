@@ -0,0 +1,106 @@
+# Loopback test of the nbd server against an in-memory lun, no device needed
+import os
+import socket
+import tempfile
+import threading
+import time
+from struct import pack, unpack
+
+from edlclient.Library import nbd_server as nbd
+from edlclient.Library.firehose import response
+
+SECTOR_SIZE = 512
+SECTORS = 256
+
+
+class memory_firehose:
+    """ The firehose calls BlockDevice uses, backed by a bytearray """
+
+    class cfg:
+        SECTOR_SIZE_IN_BYTES = SECTOR_SIZE
+
+    supported_functions = ["program", "read", "erase"]
+
+    def __init__(self):
+        self.disk = bytearray(os.urandom(SECTORS * SECTOR_SIZE))
+
+    def getlunsize(self, lun):
+        return SECTORS
+
+    def cmd_read_buffer(self, lun, start_sector, sectors, display=True):
+        return response(True, bytes(self.disk[start_sector * SECTOR_SIZE:(start_sector + sectors) * SECTOR_SIZE]))
+
+    def cmd_program_buffer(self, lun, start_sector, data, display=True):
+        self.disk[start_sector * SECTOR_SIZE:start_sector * SECTOR_SIZE + len(data)] = data
+        return True
+
+    def cmd_erase(self, lun, start_sector, sectors, display=True):
+        self.disk[start_sector * SECTOR_SIZE:(start_sector + sectors) * SECTOR_SIZE] = bytes(sectors * SECTOR_SIZE)
+        return True
+
+
+def recvexactly(conn, length):
+    data = b""
+    while len(data) < length:
+        tmp = conn.recv(length - len(data))
+        assert tmp, "server closed the connection"
+        data += tmp
+    return data
+
+
+def request(conn, cmd, handle, offset, length, data=b""):
+    conn.sendall(pack(nbd.NBD_REQUEST, nbd.NBD_REQUEST_MAGIC, 0, cmd, handle, offset, length) + data)
+    if cmd == nbd.NBD_CMD_DISC:
+        return None
+    magic, err, rhandle = unpack(">IIQ", recvexactly(conn, 16))
+    assert magic == nbd.NBD_REPLY_MAGIC and rhandle == handle
+    assert err == 0
+    if cmd == nbd.NBD_CMD_READ:
+        return recvexactly(conn, length)
+    return b""
+
+
+def connect(socketpath):
+    for _ in range(100):
+        if os.path.exists(socketpath):
+            break
+        time.sleep(0.01)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socketpath)
+    conn.settimeout(5)
+    return conn
+
+
+def test_nbd_loopback():
+    fh = memory_firehose()
+    socketpath = os.path.join(tempfile.mkdtemp(), "nbd.sock")
+    server = nbd.nbd_server(fh, 0, socketpath, blocksize=4096, cachesize=64 * 1024)
+    threading.Thread(target=server.run, daemon=True).start()
+    conn = connect(socketpath)
+
+    # fixed newstyle handshake with NBD_OPT_GO
+    magic, ihaveopt, flags = unpack(">QQH", recvexactly(conn, 18))
+    assert magic == nbd.NBDMAGIC and ihaveopt == nbd.IHAVEOPT
+    assert flags & nbd.NBD_FLAG_FIXED_NEWSTYLE
+    conn.sendall(pack(">I", nbd.NBD_FLAG_C_NO_ZEROES))
+    conn.sendall(pack(">QII", nbd.IHAVEOPT, nbd.NBD_OPT_GO, 0))
+    _, option, reply, length = unpack(">QIII", recvexactly(conn, 20))
+    assert option == nbd.NBD_OPT_GO and reply == nbd.NBD_REP_INFO
+    info_type, size, tflags = unpack(">HQH", recvexactly(conn, length))
+    assert info_type == nbd.NBD_INFO_EXPORT and size == SECTORS * SECTOR_SIZE
+    assert tflags & nbd.NBD_FLAG_SEND_TRIM and not tflags & nbd.NBD_FLAG_READ_ONLY
+    _, option, reply, length = unpack(">QIII", recvexactly(conn, 20))
+    assert reply == nbd.NBD_REP_ACK and length == 0
+
+    # read, unaligned write, read back through the cache, trim and flush
+    assert request(conn, nbd.NBD_CMD_READ, 1, 1000, 9000) == bytes(fh.disk[1000:10000])
+    payload = os.urandom(3000)
+    request(conn, nbd.NBD_CMD_WRITE, 2, 700, len(payload), payload)
+    assert bytes(fh.disk[700:3700]) == payload
+    assert request(conn, nbd.NBD_CMD_READ, 3, 0, 8192) == bytes(fh.disk[0:8192])
+    request(conn, nbd.NBD_CMD_TRIM, 4, 8192, 4096)
+    assert bytes(fh.disk[8192:12288]) == bytes(4096)
+    assert request(conn, nbd.NBD_CMD_READ, 5, 8000, 4500) == bytes(fh.disk[8000:12500])
+    request(conn, nbd.NBD_CMD_FLUSH, 6, 0, 0)
+    request(conn, nbd.NBD_CMD_DISC, 7, 0, 0)
+    conn.close()
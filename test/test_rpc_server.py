@@ -0,0 +1,152 @@
+# Loopback test of the rpc job server against an in-memory lun, no device needed
+import os
+import tempfile
+import threading
+import time
+
+from edlclient.Library import rpc_server as rpc
+from edlclient.Library.firehose import response
+
+SECTOR_SIZE = 512
+SECTORS = 64
+
+
+class partition:
+    sector = 8
+    sectors = 16
+
+
+class memory_firehose:
+    """ The firehose calls the streaming read uses, backed by a bytearray """
+
+    class cfg:
+        SECTOR_SIZE_IN_BYTES = SECTOR_SIZE
+
+    def __init__(self):
+        self.disk = bytes(os.urandom(SECTORS * SECTOR_SIZE))
+
+    def detect_partition(self, arguments, partitionname, send_full=False):
+        if partitionname == "boot":
+            return [True, 0, partition]
+        return [False, {}]
+
+    def cmd_read_buffer(self, lun, start_sector, sectors, display=True):
+        return response(True, self.disk[start_sector * SECTOR_SIZE:(start_sector + sectors) * SECTOR_SIZE])
+
+
+class memory_client:
+    """ Handler side of the server, "e" blocks until released so jobs queue up behind it """
+
+    def __init__(self):
+        self.firehose = memory_firehose()
+        self.printer = print
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def handler(self, cmd, options):
+        name = options.get("<partitionname>")
+        self.calls.append((cmd, name))
+        if name in ["block", "quiet"]:
+            self.started.set()
+            assert self.release.wait(5)
+        elif name == "bug":
+            raise KeyError("handler bug")
+        if name != "quiet":
+            self.printer(f"done {name}")
+        return True
+
+
+def start_server():
+    client = memory_client()
+    socketpath = os.path.join(tempfile.mkdtemp(), "rpc.sock")
+    server = rpc.rpc_server(client, {"--unixsocket": socketpath, "--lun": None}, client.handler)
+    threading.Thread(target=server.run, daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(socketpath):
+            break
+        time.sleep(0.01)
+    return client, rpc.rpc_client(unixsocket=socketpath, timeout=5)
+
+
+def frames_until(conn, jobid, frames):
+    """ Collects frames of all jobs until the result of jobid arrives """
+    while True:
+        ftype, fjobid, payload = conn.read_frame()
+        frames.setdefault(fjobid, []).append((ftype, payload))
+        if ftype == rpc.FRAME_RESULT and fjobid == jobid:
+            return payload
+
+
+def test_rpc_queue_and_cancel():
+    client, conn = start_server()
+    frames = {}
+    blocking = conn.submit("e", "block")
+    assert client.started.wait(5)
+    low = conn.submit("e", "low", priority=1)
+    high = conn.submit("e", "high", priority=0)
+    dropped = conn.submit("e", "dropped", priority=0)
+    conn.cancel(dropped)
+    assert frames_until(conn, dropped, frames) == dict(status=rpc.JOB_CANCELLED)
+    assert [payload for ftype, payload in frames[low] if ftype == rpc.FRAME_QUEUED] == [dict(position=1)]
+    assert [payload for ftype, payload in frames[high] if ftype == rpc.FRAME_QUEUED] == [dict(position=2)]
+
+    client.release.set()
+    assert frames_until(conn, low, frames) == dict(status=rpc.JOB_OK)
+    assert frames[blocking][-1] == (rpc.FRAME_RESULT, dict(status=rpc.JOB_OK))
+    assert (rpc.FRAME_LOG, "done high") in frames[high]
+    # Lower priority value runs first, the cancelled job never reaches the handler
+    assert [name for _, name in client.calls] == ["block", "high", "low"]
+
+    # A cancel that only arrives once the handler is busy doesn't undo the work done
+    client.started.clear()
+    client.release.clear()
+    running = conn.submit("e", "quiet")
+    assert client.started.wait(5)
+    conn.cancel(running)
+    # The server handles frames in order, so the cancel went through once this is queued
+    after = conn.submit("e", "after")
+    while not any(ftype == rpc.FRAME_QUEUED for ftype, _ in frames.get(after, [])):
+        ftype, fjobid, payload = conn.read_frame()
+        frames.setdefault(fjobid, []).append((ftype, payload))
+    client.release.set()
+    assert frames_until(conn, running, frames) == dict(status=rpc.JOB_OK)
+    assert frames_until(conn, after, frames) == dict(status=rpc.JOB_OK)
+    conn.close()
+
+
+def test_rpc_errors():
+    client, conn = start_server()
+    assert conn.run("rs", "0") == dict(status=rpc.JOB_ERROR, error="Wrong arguments")
+    result = conn.run("e", "bug")
+    assert result["status"] == rpc.JOB_ERROR and "handler bug" in result["error"]
+    assert conn.run("server") == dict(status=rpc.JOB_ERROR, error="Rejected request")
+    conn.close()
+
+
+def test_rpc_stream_read():
+    client, conn = start_server()
+    disk = client.firehose.disk
+
+    class collector:
+        data = b""
+
+        def write(self, data):
+            self.data += data
+
+    wf = collector()
+    progress = []
+    result = conn.run("r", "boot,-", wf=wf, progress=lambda pos, total: progress.append((pos, total)))
+    assert result == dict(status=rpc.JOB_OK)
+    assert wf.data == disk[partition.sector * SECTOR_SIZE:(partition.sector + partition.sectors) * SECTOR_SIZE]
+    assert progress[-1] == (partition.sectors * SECTOR_SIZE, partition.sectors * SECTOR_SIZE)
+
+    wf = collector()
+    assert conn.run("rs", "4,20,-", wf=wf) == dict(status=rpc.JOB_OK)
+    assert wf.data == disk[4 * SECTOR_SIZE:24 * SECTOR_SIZE]
+
+    lines = []
+    assert conn.run("r", "missing,-", printer=lines.append) == dict(status=rpc.JOB_ERROR, error="Command failed")
+    assert lines == ["Couldn't detect partition: missing"]
+    assert client.calls == []
+    conn.close()